@@ -0,0 +1,218 @@
+import numpy as np
+import math
+
+import kernels
+
+# Open circuit voltage of a Li-ion cell (V) every 10% of state of charge, scaled to the nominal voltage of the pack
+CELL_OPEN_CIRCUIT_VOLTAGE = [3.00, 3.45, 3.55, 3.62, 3.67, 3.72, 3.78, 3.85, 3.93, 4.02, 4.12]
+TEMPERATURES = [-20., 0., 25., 45.]    # °C
+
+
+class LookupTable:
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, values: np.ndarray, resolution=(256, 256)):
+
+        # Bilinear table given on any breakpoints, resampled once on a dense uniform grid so that a lookup is
+        # an index computation instead of a search
+        x, y, values = np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(values, dtype=float)
+        self.x = np.linspace(x[0], x[-1], resolution[0])
+        self.y = np.linspace(y[0], y[-1], resolution[1])
+
+        rows = np.array([np.interp(self.y, y, row) for row in values])
+        self.table = np.ascontiguousarray(np.array([np.interp(self.x, x, column) for column in rows.T]).T)
+
+        self.x_start, self.x_scale = self.x[0], (len(self.x) - 1) / (self.x[-1] - self.x[0])
+        self.y_start, self.y_scale = self.y[0], (len(self.y) - 1) / (self.y[-1] - self.y[0])
+
+    def __call__(self, x, y) -> np.ndarray:
+
+        # Values outside of the grid are clamped on its edges, NaN inputs give NaN
+        n_x, n_y = self.table.shape
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        missing = np.isnan(x) | np.isnan(y)
+        position_x = np.clip(np.nan_to_num((x - self.x_start) * self.x_scale), 0, n_x - 1)
+        position_y = np.clip(np.nan_to_num((y - self.y_start) * self.y_scale), 0, n_y - 1)
+
+        i = np.minimum(position_x.astype(int), n_x - 2)
+        j = np.minimum(position_y.astype(int), n_y - 2)
+        u, v = position_x - i, position_y - j
+
+        table = self.table
+        values = (1 - u) * ((1 - v) * table[i, j] + v * table[i, j + 1]) + \
+            u * ((1 - v) * table[i + 1, j] + v * table[i + 1, j + 1])
+        return np.where(missing, np.nan, values)
+
+
+def _cell(position_x: float, position_y: float, n_x: int, n_y: int) -> tuple:
+
+    # Cell of the grid and weights of the inner loop lookups, positions already in grid units
+    position_x = min(max(position_x, 0.), n_x - 1.)
+    position_y = min(max(position_y, 0.), n_y - 1.)
+    i, j = min(int(position_x), n_x - 2), min(int(position_y), n_y - 2)
+    return i, j, position_x - i, position_y - j
+
+
+def _interpolate(table: list, i: int, j: int, u: float, v: float) -> float:
+
+    return (1 - u) * ((1 - v) * table[i][j] + v * table[i][j + 1]) + \
+        u * ((1 - v) * table[i + 1][j] + v * table[i + 1][j + 1])
+
+
+class BatteryModel:
+
+    def __init__(self, open_circuit_voltage: LookupTable, resistance: LookupTable, polarization_resistance: LookupTable,
+                 time_constant: float, capacity: float):
+
+        # Equivalent circuit: open circuit voltage, series resistance and one RC pair, functions of (soc, °C)
+        # on the same grid
+        for table in (resistance, polarization_resistance):
+            if table.table.shape != open_circuit_voltage.table.shape or \
+                    not (np.array_equal(table.x, open_circuit_voltage.x) and
+                         np.array_equal(table.y, open_circuit_voltage.y)):
+                raise ValueError("Battery tables must share the same grid")
+
+        self.open_circuit_voltage = open_circuit_voltage
+        self.resistance = resistance
+        self.polarization_resistance = polarization_resistance
+        self.time_constant = time_constant
+        self.capacity = capacity
+
+    @classmethod
+    def from_vehicle(cls, vehicle, time_constant=30., activation_temperature=3500., resolution=(256, 256)):
+
+        # Generic Li-ion pack: nominal voltage and resistance of the vehicle at 50% and 25°C, resistance rising
+        # at low state of charge and (Arrhenius) at low temperature, polarization resistance half of it
+        soc = np.linspace(0., 1., len(CELL_OPEN_CIRCUIT_VOLTAGE))
+        temperatures = np.asarray(TEMPERATURES)
+        cell = np.asarray(CELL_OPEN_CIRCUIT_VOLTAGE)
+
+        open_circuit_voltage = cell[:, None] / np.interp(0.5, soc, cell) * vehicle.voltage_nominal * \
+            (1 + 3e-5 * (temperatures[None, :] - 25.))
+        temperature_factor = np.exp(activation_temperature * (1 / (temperatures + 273.15) - 1 / 298.15))
+        soc_factor = (1 + 0.6 * (1 - soc) ** 3) / (1 + 0.6 * 0.5 ** 3)
+        resistance = vehicle.resistance * soc_factor[:, None] * temperature_factor[None, :]
+
+        return cls(LookupTable(soc, temperatures, open_circuit_voltage, resolution),
+                   LookupTable(soc, temperatures, resistance, resolution),
+                   LookupTable(soc, temperatures, 0.5 * resistance, resolution),
+                   time_constant, vehicle.capacity)
+
+    def simulate(self, power_battery: np.ndarray, soc_initial=0.5, temperature=25., dt=0.5) -> tuple:
+
+        # Current (A), terminal voltage (V) and state of charge drawing power_battery (W) at every step,
+        # current of the maximum power point where the demand is above it, previous current and voltage held where
+        # the demand or the temperature is missing (as get_state_of_charge)
+        power_battery = np.ascontiguousarray(power_battery, dtype=float)
+        n_steps = power_battery.shape[0]
+        temperature = np.ascontiguousarray(np.broadcast_to(np.asarray(temperature, dtype=float), (n_steps,)))
+
+        current = np.zeros(n_steps)
+        voltage = np.zeros(n_steps)
+        state_of_charge = np.zeros(n_steps)
+        state_of_charge[0] = soc_initial
+        limited = np.zeros(n_steps, dtype=np.bool_)
+
+        grid = self.open_circuit_voltage
+        arguments = (grid.x_start, grid.x_scale, grid.y_start, grid.y_scale, self.time_constant, self.capacity, dt)
+
+        if kernels.compiled():
+            kernels.equivalent_circuit_kernel(power_battery, temperature, current, voltage, state_of_charge, limited,
+                                              self.open_circuit_voltage.table, self.resistance.table,
+                                              self.polarization_resistance.table, *arguments)
+            return current, voltage, state_of_charge, limited
+
+        soc_start, soc_scale, temperature_start, temperature_scale, time_constant, capacity, dt = arguments
+        ocv_table, resistance_table = self.open_circuit_voltage.table.tolist(), self.resistance.table.tolist()
+        polarization_table = self.polarization_resistance.table.tolist()
+        n_soc, n_temperatures = self.open_circuit_voltage.table.shape
+        decay = math.exp(-dt / time_constant)
+
+        soc, polarization_voltage = float(soc_initial), 0.
+        battery_current, terminal_voltage = 0., np.nan
+        for t, (p, temperature_t) in enumerate(zip(power_battery.tolist(), temperature.tolist())):
+
+            if math.isfinite(p) and math.isfinite(temperature_t):
+                position_soc = (soc - soc_start) * soc_scale
+                position_temperature = (temperature_t - temperature_start) * temperature_scale
+                i, j, u, v = _cell(position_soc, position_temperature, n_soc, n_temperatures)
+                ocv = _interpolate(ocv_table, i, j, u, v)
+                r0 = _interpolate(resistance_table, i, j, u, v)
+                r1 = _interpolate(polarization_table, i, j, u, v)
+
+                # Terminal power: (ocv - v1 - r0 i) i = p
+                electromotive_force = ocv - polarization_voltage
+                discriminant = electromotive_force ** 2 - 4 * r0 * p
+                if discriminant >= 0:
+                    battery_current = (electromotive_force - math.sqrt(discriminant)) / (2 * r0)
+                else:
+                    battery_current = electromotive_force / (2 * r0)
+                    limited[t] = True
+                terminal_voltage = electromotive_force - r0 * battery_current
+
+                # RC pair
+                polarization_voltage = decay * polarization_voltage + (1 - decay) * r1 * battery_current
+
+            current[t] = battery_current
+            voltage[t] = terminal_voltage
+
+            # State of charge, first sample kept at its initial value
+            if t > 0:
+                soc -= battery_current * dt / 3600 / capacity
+                state_of_charge[t] = soc
+
+        return current, voltage, state_of_charge, limited
+
+
+class MotorMap:
+
+    def __init__(self, efficiency: LookupTable, gear_ratio=3.87, wheel_radius=0.31):
+
+        # Efficiency over (|torque| in N.m, speed in rad/s) of the motor, the same in traction and regeneration
+        self.efficiency = efficiency
+        self.gear_ratio = gear_ratio
+        self.wheel_radius = wheel_radius
+
+    @classmethod
+    def from_vehicle(cls, vehicle, torque_max=360., speed_max=470., gear_ratio=3.87, wheel_radius=0.31,
+                     resolution=(256, 256)):
+
+        # Copper (torque^2), iron (speed), windage (speed^3) and constant losses, the best point of the map being
+        # the constant efficiency_motor of the vehicle
+        torque = np.linspace(0., torque_max, 37)
+        speed = np.linspace(0., speed_max, 48)
+        power = torque[:, None] * speed[None, :]
+        losses = 0.02 * torque[:, None] ** 2 + 5. * speed[None, :] + 1e-5 * speed[None, :] ** 3 + 200.
+
+        efficiency = power / (power + losses)
+        efficiency = np.maximum(efficiency * vehicle.efficiency_motor / efficiency.max(), 0.05)
+
+        return cls(LookupTable(torque, speed, efficiency, resolution), gear_ratio, wheel_radius)
+
+    def __call__(self, speed: np.ndarray, force_wheel: np.ndarray) -> np.ndarray:
+
+        # Efficiency at the operating points of the wheel: speed (m/s) and traction force (N)
+        torque = np.abs(force_wheel) * self.wheel_radius / self.gear_ratio
+        motor_speed = np.abs(speed) * self.gear_ratio / self.wheel_radius
+        return self.efficiency(torque, motor_speed)
+
+
+def equivalent_circuit_state_of_charge(vehicle, speed: np.ndarray, acceleration: np.ndarray, battery=None,
+                                       motor=None, temperature=25.) -> tuple:
+
+    # Same outputs as get_state_of_charge: battery power (W) and state of charge, with the motor map in the
+    # drivetrain and the equivalent circuit in the battery
+    battery = battery if battery is not None else BatteryModel.from_vehicle(vehicle)
+    motor = motor if motor is not None else MotorMap.from_vehicle(vehicle)
+
+    speed, acceleration = np.asarray(speed, dtype=float), np.asarray(acceleration, dtype=float)
+    force_road_load, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+    force_wheel = 1.03 * vehicle.test_weight * acceleration + force_road_load
+
+    efficiency_drivetrain = vehicle.efficiency_transmission * motor(speed, force_wheel)
+    power_demand = np.where(power_wheel >= 0, power_wheel / efficiency_drivetrain,
+                            efficiency_drivetrain * power_wheel) + vehicle.standby_losses
+
+    current, voltage, state_of_charge, _ = battery.simulate(power_demand, soc_initial=vehicle.soc_initial,
+                                                            temperature=temperature, dt=vehicle.dt)
+
+    return current * voltage, state_of_charge
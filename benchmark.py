@@ -0,0 +1,266 @@
+import numpy as np
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import kernels
+from preprocess import DATASET_DIRECTORY, preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from vehicles import AutonomousVehicle
+
+# Next to the sources rather than in the working directory, ignored by git
+HISTORY_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_history.jsonl")
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+SEGMENT_LENGTH = 100    # samples of the source cycle kept together in a synthetic cycle
+
+# Modules imported by the simulation workers, which must not pull the heavy optional ones at import
+STARTUP_MODULES = ["numpy", "kernels", "vehicles", "sweep", "platoon", "uncertainty", "streaming", "pipeline"]
+HEAVY_MODULES = ["pandas", "matplotlib", "numba"]
+STARTUP_BUDGET = 0.25    # seconds
+
+
+def synthetic_drive_cycle(n_samples: int, source="UDDS.txt", seed=0) -> "pd.DataFrame":
+
+    import pandas as pd
+
+    # Random concatenation of segments of an EPA cycle: same speeds and accelerations statistics, any length
+    source_df = pd.read_csv(os.path.join(DATASET_DIRECTORY, source), delimiter="\t")
+    speed = pd.to_numeric(source_df[source_df.columns[1]], errors="coerce").fillna(0.).values
+
+    # Every segment starts where the source cycle drives at the speed ending the previous one (within 1 mph)
+    generator = np.random.default_rng(seed)
+    starts = np.argsort(speed[:-SEGMENT_LENGTH], kind="stable")
+    sorted_speed = speed[starts]
+
+    segments = []
+    speed_end = 0.
+    for _ in range(-(-n_samples // SEGMENT_LENGTH)):
+        low, high = np.searchsorted(sorted_speed, [speed_end - 1, speed_end + 1])
+        if high <= low:
+            low = min(low, len(starts) - 1)
+            high = low + 1
+        start = starts[generator.integers(low, high)]
+        segments.append(speed[start:start + SEGMENT_LENGTH])
+        speed_end = segments[-1][-1]
+
+    synthetic_speed = np.concatenate(segments)[:n_samples]
+
+    return pd.DataFrame({"time": np.arange(n_samples), "mph": synthetic_speed})
+
+
+def _measure(function, repeat: int) -> tuple:
+
+    # Best wall time over the repetitions, then peak memory of a separate traced run
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak_memory
+
+
+def benchmark_cases(n_samples: int, directory: str, source="UDDS.txt") -> dict:
+
+    # Synthetic cycle written in a scratch directory (absolute path, so preprocess_dataframe reads and writes its
+    # csv there rather than in the dataset directory)
+    filename = os.path.join(directory, f"synthetic_{n_samples}.txt")
+    synthetic_drive_cycle(n_samples, source=source).to_csv(filename, sep="\t", index=False)
+
+    df = preprocess_dataframe(filename, filtering="none", use_cache=False)
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    speed, acceleration = df[df.columns[1]].values, df[df.columns[2]].values
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    _, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+
+    return {
+        "preprocess_dataframe": lambda: preprocess_dataframe(filename, filtering="1hz", use_cache=False),
+        "computing_absolute_distance": lambda: computing_absolute_distance(df, vehicle.dt),
+        "get_power_wheel": lambda: vehicle.get_power_wheel(speed, acceleration),
+        "get_state_of_charge": lambda: vehicle.get_state_of_charge(power_wheel),
+        "control_drive_cycle": lambda: vehicle.control_drive_cycle(lead_distance, kp=0.1, kd=1, df=df),
+        "adaptive_cruise_control_drive_cycle": lambda: vehicle.adaptive_cruise_control_drive_cycle(lead_distance,
+                                                                                                  df=df),
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_benchmarks(sizes=SIZES, functions=None, repeat=3, history_filepath=HISTORY_FILEPATH) -> list:
+
+    run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    run = {"run_id": run_id, "kind": "run", "commit": _commit(), "backend": kernels.BACKEND}
+    records = []
+
+    for n_samples in sizes:
+        with tempfile.TemporaryDirectory(prefix="benchmark_") as directory:
+            cases = benchmark_cases(n_samples, directory)
+            for name, function in cases.items():
+                if functions is not None and name not in functions:
+                    continue
+
+                # Compilation of the optional kernels kept out of the measures
+                function()
+                seconds, peak_memory = _measure(function, repeat)
+
+                record = {**run, "function": name, "n_samples": n_samples, "seconds": seconds,
+                          "throughput": n_samples / seconds, "peak_memory": peak_memory}
+                records.append(record)
+                print(f"{name:40s} {n_samples:>10d} samples {seconds:10.4f} s {record['throughput']:14.0f} samples/s "
+                      f"{peak_memory / 1024 ** 2:10.1f} MB")
+
+    # Scaling exponent of the time with the number of samples (1 = linear)
+    for name, exponent in scaling_exponents(records).items():
+        print(f"{name:40s} time ~ n^{exponent:.2f}")
+
+    with open(history_filepath, "a") as history_file:
+        for record in records:
+            history_file.write(json.dumps(record) + "\n")
+
+    return records
+
+
+def startup_times(modules=STARTUP_MODULES, repeat=5, history_filepath=HISTORY_FILEPATH) -> list:
+
+    run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    run = {"run_id": run_id, "kind": "startup", "commit": _commit(), "backend": kernels.BACKEND}
+    records = []
+
+    # Import time of every module in a fresh interpreter (median of the repetitions), and heavy modules it loaded
+    for module in modules:
+        script = (f"import json, sys, time\nstart = time.perf_counter()\nimport {module}\n"
+                  f"seconds = time.perf_counter() - start\n"
+                  f"print(json.dumps([seconds, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))")
+
+        measures = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            measures.append(json.loads(output.stdout))
+
+        seconds = float(np.median([seconds for seconds, _ in measures]))
+        record = {**run, "function": f"import {module}", "n_samples": 0, "seconds": seconds, "throughput": None,
+                  "peak_memory": None, "heavy_modules": measures[0][1]}
+        records.append(record)
+        print(f"{record['function']:40s} {seconds * 1000:10.1f} ms {', '.join(record['heavy_modules'])}")
+
+    with open(history_filepath, "a") as history_file:
+        for record in records:
+            history_file.write(json.dumps(record) + "\n")
+
+    return records
+
+
+def scaling_exponents(records: list) -> dict:
+
+    import pandas as pd
+
+    exponents = {}
+    df = pd.DataFrame(records)
+    for name, group in df.groupby("function"):
+        if group["n_samples"].nunique() > 1:
+            exponents[name] = np.polyfit(np.log(group["n_samples"]), np.log(group["seconds"]), 1)[0]
+
+    return exponents
+
+
+def compare_runs(history_filepath=HISTORY_FILEPATH, baseline=None, candidate=None, threshold=0.1,
+                 kind="run") -> "pd.DataFrame":
+
+    import pandas as pd
+
+    # Relative change of time between two runs of the same kind ("run" or "startup"), the last two by default.
+    # Records written before the kind was stored are told apart by their function
+    history = pd.read_json(history_filepath, lines=True, dtype={"run_id": str})
+    inferred = pd.Series(np.where(history["function"].str.startswith("import "), "startup", "run"),
+                         index=history.index)
+    history["kind"] = history["kind"].fillna(inferred) if "kind" in history else inferred
+    history = history[history["kind"] == kind]
+
+    run_ids = list(dict.fromkeys(history["run_id"]))
+    if len(run_ids) < 2 and (baseline is None or candidate is None):
+        raise ValueError(f"At least two {kind} benchmark runs are needed for a comparison")
+
+    baseline = baseline or run_ids[-2]
+    candidate = candidate or run_ids[-1]
+
+    keys = ["function", "n_samples"]
+    comparison = history[history["run_id"] == baseline].set_index(keys)[["seconds"]].join(
+        history[history["run_id"] == candidate].set_index(keys)[["seconds"]], lsuffix="_baseline",
+        rsuffix="_candidate", how="inner")
+    if comparison.empty:
+        raise ValueError(f"No {kind} measure in common between the runs {baseline} and {candidate}")
+
+    comparison["change"] = comparison["seconds_candidate"] / comparison["seconds_baseline"] - 1
+    comparison["regression"] = comparison["change"] > threshold
+
+    return comparison.reset_index()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the preprocessing, controllers and battery model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    run_parser.add_argument("--functions", nargs="+")
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--backend", choices=kernels.BACKENDS)
+    run_parser.add_argument("--history", default=HISTORY_FILEPATH)
+
+    startup_parser = subparsers.add_parser("startup")
+    startup_parser.add_argument("--modules", nargs="+", default=STARTUP_MODULES)
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    startup_parser.add_argument("--budget", type=float, default=STARTUP_BUDGET)
+    startup_parser.add_argument("--history", default=HISTORY_FILEPATH)
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("--baseline")
+    compare_parser.add_argument("--candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    compare_parser.add_argument("--kind", choices=["run", "startup"], default="run")
+    compare_parser.add_argument("--history", default=HISTORY_FILEPATH)
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.backend is not None:
+            kernels.set_backend(args.backend)
+        run_benchmarks(args.sizes, args.functions, args.repeat, args.history)
+
+    elif args.command == "startup":
+        records = startup_times(args.modules, args.repeat, args.history)
+
+        # Non zero exit code for CI when an import got over the budget or loads a heavy module
+        if any(record["seconds"] > args.budget or record["heavy_modules"] for record in records):
+            raise SystemExit(1)
+
+    else:
+        try:
+            comparison = compare_runs(args.history, args.baseline, args.candidate, args.threshold, args.kind)
+        except ValueError as error:
+            parser.error(str(error))
+        print(comparison.to_string(index=False))
+
+        # Non zero exit code for CI when a function got slower than the threshold
+        if comparison["regression"].any():
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
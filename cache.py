@@ -0,0 +1,90 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+# Bumped when the preprocessing changes so that stale entries are never loaded
+CACHE_VERSION = 1
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset", "cache")
+CACHE_SIZE_LIMIT = 512 * 1024 ** 2    # bytes
+
+
+def file_hash(filepath: str) -> str:
+
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as source_file:
+        for block in iter(lambda: source_file.read(1024 ** 2), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cache_key(filepath: str, **parameters) -> str:
+
+    # Content of the source file + processing parameters
+    description = json.dumps({"version": CACHE_VERSION, "source": file_hash(filepath), **parameters}, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+
+def load_arrays(key: str, names: list, mmap_mode="r"):
+
+    # Memory mapped columns of a cache entry, None on a miss
+    entry_directory = os.path.join(CACHE_DIRECTORY, key)
+    try:
+        arrays = [np.load(os.path.join(entry_directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in names]
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # Recently used entries are evicted last
+    os.utime(entry_directory)
+
+    return arrays
+
+
+def store_arrays(key: str, names: list, arrays: list, size_limit=CACHE_SIZE_LIMIT):
+
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+
+    # Writing in a temporary directory renamed at the end, so readers never see a partial entry
+    entry_directory = os.path.join(CACHE_DIRECTORY, key)
+    temporary_directory = f"{entry_directory}.{os.getpid()}.tmp"
+    os.makedirs(temporary_directory, exist_ok=True)
+
+    for name, array in zip(names, arrays):
+        np.save(os.path.join(temporary_directory, f"{name}.npy"), np.asarray(array))
+
+    try:
+        os.replace(temporary_directory, entry_directory)
+    except OSError:
+        # Entry written concurrently by another process
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    evict(size_limit)
+
+
+def evict(size_limit=CACHE_SIZE_LIMIT):
+
+    if not os.path.isdir(CACHE_DIRECTORY):
+        return
+
+    # Entries sorted from the least recently used
+    entries = []
+    for key in os.listdir(CACHE_DIRECTORY):
+        entry_directory = os.path.join(CACHE_DIRECTORY, key)
+        if key.endswith(".tmp") or not os.path.isdir(entry_directory):
+            continue
+        size = sum(entry.stat().st_size for entry in os.scandir(entry_directory))
+        entries.append((os.stat(entry_directory).st_mtime, size, entry_directory))
+    entries.sort()
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_directory in entries:
+        if total_size <= size_limit:
+            break
+        shutil.rmtree(entry_directory, ignore_errors=True)
+        total_size -= size
+
+
+def clear():
+    shutil.rmtree(CACHE_DIRECTORY, ignore_errors=True)
@@ -0,0 +1,266 @@
+import numpy as np
+import functools
+import importlib.util
+import os
+
+# Optional compiled backend for the sequential loops: numba when installed, the Python loops of vehicles.py otherwise.
+# numba is only imported by the first call of a kernel, importing this module stays cheap
+NUMBA_INSTALLED = importlib.util.find_spec("numba") is not None
+
+BACKENDS = ("numba", "python")
+BACKEND = os.environ.get("DRIVE_CYCLE_BACKEND", "numba" if NUMBA_INSTALLED else "python")
+if BACKEND not in BACKENDS:
+    raise ValueError(f"Unknown DRIVE_CYCLE_BACKEND {BACKEND}, expected one of {BACKENDS}")
+
+# Python functions of the kernels, compiled together at the first call of any of them
+_kernels = {}
+_dispatchers = {}
+
+
+def set_backend(backend: str):
+
+    global BACKEND
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if backend == "numba" and not NUMBA_INSTALLED:
+        raise ImportError("numba is not installed, only the python backend is available")
+
+    BACKEND = backend
+
+
+def compiled() -> bool:
+    return BACKEND == "numba" and NUMBA_INSTALLED
+
+
+def _compile():
+
+    # Every kernel replaced by its numba dispatcher in the module, so that kernels calling each other resolve to
+    # compiled functions (numba compiles each signature at its first call)
+    if _dispatchers:
+        return
+
+    import numba
+    from numba.extending import overload, register_jitable
+
+    # Laws compiled inline in the kernels, their selections between scalars
+    overload(_select)(lambda condition, a, b: lambda condition, a, b: a if condition else b)
+    for law in (acc_acceleration, ccc_speed):
+        register_jitable(law)
+
+    for name, function in _kernels.items():
+        _dispatchers[name] = numba.njit(cache=True)(function)
+    globals().update(_dispatchers)
+
+
+def _jit(function):
+
+    # Kernels stay plain Python functions without numba
+    if not NUMBA_INSTALLED:
+        return function
+
+    _kernels[function.__name__] = function
+
+    # Python function itself with the python backend, so that callers carrying a state between chunks run on both
+    @functools.wraps(function)
+    def kernel(*args):
+        if not compiled():
+            return function(*args)
+        _compile()
+        return _dispatchers[function.__name__](*args)
+
+    return kernel
+
+
+def _select(condition, a, b):
+
+    # Branch of the per sample loops, elementwise selection for arrays of followers
+    if isinstance(condition, (bool, np.bool_)):
+        return a if condition else b
+    return np.where(condition, a, b)
+
+
+def acc_acceleration(gap, follow_speed, lead_speed, safe, headway, gap_target, gap_min, headway_target, headway_min,
+                     acceleration_min, acceleration_max, dt):
+
+    # ACC law of one step: acceleration reaching the minimum gap (safe, under gap_min) or the target one at the next
+    # step, the gap being imposed by space (gap_min, gap_target) or time (headway_min, headway_target) with headway.
+    # Scalars or arrays of followers, the same function being compiled in the kernels
+    gap_constraint = _select(headway, np.maximum(gap_min, follow_speed * headway_min), gap_min)
+    acceleration_safe = gap / (dt ** 2) + (lead_speed - follow_speed) / dt - gap_constraint / (dt ** 2)
+    acceleration_target = _select(headway,
+                                  ((gap + (lead_speed - follow_speed) * dt) * headway_target - follow_speed) /
+                                  (1 + (dt ** 2) * headway_target),
+                                  gap / (dt ** 2) + (lead_speed - follow_speed) / dt - gap_target / (dt ** 2))
+
+    acceleration = _select(safe, acceleration_safe, acceleration_target)
+    return np.maximum(np.minimum(acceleration, acceleration_max), acceleration_min)
+
+
+def ccc_speed(gap, follow_speed, lead_speed, e_prev, kp, kd, gap_target, acceleration_max, dt) -> tuple:
+
+    # CCC law of one step from the gap integrated to the next step: next speed and gap error, the lead vehicle moving.
+    # Scalars or arrays of followers, the same function being compiled in the kernels
+    tw = gap_target / lead_speed
+    e = gap - tw * follow_speed
+    e_dot = (e - e_prev) / dt
+
+    speed = follow_speed + kp * e + kd * e_dot
+
+    # Acceleration bounds
+    speed = _select(speed - follow_speed < - 0.5 * acceleration_max * dt, follow_speed - 0.5 * acceleration_max * dt,
+                    _select(speed - follow_speed > acceleration_max * dt, follow_speed + 0.5 * acceleration_max * dt,
+                            speed))
+
+    return speed, e
+
+
+@_jit
+def state_of_charge_kernel(power_wheel, power_battery, capacity_supplied, state_of_charge, voltage_nominal, resistance,
+                           capacity, efficiency_drivetrain, standby_losses, dt):
+
+    for t in range(power_wheel.shape[0]):
+
+        p_w = power_wheel[t]
+        if p_w >= 0:
+            power_battery[t] = (1 / efficiency_drivetrain) * p_w + standby_losses
+        else:
+            power_battery[t] = efficiency_drivetrain * p_w + standby_losses
+
+        # Battery current (A), previous value when the discriminant is negative
+        if voltage_nominal ** 2 - 4 * resistance * power_battery[t] >= 0:
+            battery_current = (voltage_nominal - np.sqrt(voltage_nominal ** 2 - 4 * resistance * power_battery[t])) \
+                              / (2 * resistance)
+        else:
+            battery_current = 3600 * capacity_supplied[t - 1] / dt
+
+        capacity_supplied[t] = battery_current * dt / 3600
+
+        if t > 0:
+            state_of_charge[t] = state_of_charge[t - 1] - capacity_supplied[t] / capacity
+
+
+@_jit
+def control_drive_cycle_kernel(lead_vehicle_speed, following_speed, following_acceleration, gap_vehicles, kp, kd,
+                               gap_target, acceleration_max, dt, e_prev):
+
+    # e_prev: error of the sample before the first one, the last error being returned for a next chunk
+    for s in range(lead_vehicle_speed.shape[0] - 1):
+
+        lead_speed = lead_vehicle_speed[s]
+        if lead_speed == 0.:
+            continue
+
+        gap_vehicles[s + 1] = gap_vehicles[s] + (lead_speed - following_speed[s]) * dt
+
+        following_speed[s + 1], e = ccc_speed(gap_vehicles[s + 1], following_speed[s], lead_speed, e_prev, kp, kd,
+                                              gap_target, acceleration_max, dt)
+        following_acceleration[s] = (following_speed[s + 1] - following_speed[s]) / dt
+
+        e_prev = e
+
+    return e_prev
+
+
+@_jit
+def adaptive_cruise_control_kernel(lead_distance, lead_speed, follow_distance, follow_speed, follow_acceleration, gap,
+                                   headway, gap_target, gap_min, headway_target, headway_min, acceleration_min,
+                                   acceleration_max, dt):
+
+    for d in range(lead_distance.shape[0] - 1):
+
+        follow_acceleration[d + 1] = acc_acceleration(gap[d], follow_speed[d], lead_speed[d], gap[d] < gap_min, headway,
+                                                      gap_target, gap_min, headway_target, headway_min,
+                                                      acceleration_min, acceleration_max, dt)
+
+        follow_speed[d + 1] = follow_speed[d] + follow_acceleration[d + 1] * dt
+        follow_distance[d + 1] = follow_distance[d] + follow_speed[d + 1] * dt
+        gap[d + 1] = lead_distance[d + 1] - follow_distance[d + 1]
+
+
+@_jit
+def _interpolate_kernel(table, i, j, u, v):
+
+    return (1 - u) * ((1 - v) * table[i, j] + v * table[i, j + 1]) + \
+        u * ((1 - v) * table[i + 1, j] + v * table[i + 1, j + 1])
+
+
+@_jit
+def equivalent_circuit_kernel(power_battery, temperature, current, voltage, state_of_charge, limited, ocv_table,
+                              resistance_table, polarization_table, soc_start, soc_scale, temperature_start,
+                              temperature_scale, time_constant, capacity, dt):
+
+    n_soc, n_temperatures = ocv_table.shape
+    decay = np.exp(-dt / time_constant)
+    soc, polarization_voltage = state_of_charge[0], 0.
+    battery_current, terminal_voltage = 0., np.nan
+
+    for t in range(power_battery.shape[0]):
+
+        # Previous current and voltage held where the demand or the temperature is missing
+        if np.isfinite(power_battery[t]) and np.isfinite(temperature[t]):
+            position_soc = (soc - soc_start) * soc_scale
+            position_temperature = (temperature[t] - temperature_start) * temperature_scale
+            position_soc = min(max(position_soc, 0.), n_soc - 1.)
+            position_temperature = min(max(position_temperature, 0.), n_temperatures - 1.)
+            i, j = min(int(position_soc), n_soc - 2), min(int(position_temperature), n_temperatures - 2)
+            u, v = position_soc - i, position_temperature - j
+
+            ocv = _interpolate_kernel(ocv_table, i, j, u, v)
+            r0 = _interpolate_kernel(resistance_table, i, j, u, v)
+            r1 = _interpolate_kernel(polarization_table, i, j, u, v)
+
+            # Current of the maximum power point when the demand is above it
+            electromotive_force = ocv - polarization_voltage
+            discriminant = electromotive_force ** 2 - 4 * r0 * power_battery[t]
+            if discriminant >= 0:
+                battery_current = (electromotive_force - np.sqrt(discriminant)) / (2 * r0)
+            else:
+                battery_current = electromotive_force / (2 * r0)
+                limited[t] = True
+            terminal_voltage = electromotive_force - r0 * battery_current
+
+            polarization_voltage = decay * polarization_voltage + (1 - decay) * r1 * battery_current
+
+        current[t] = battery_current
+        voltage[t] = terminal_voltage
+
+        if t > 0:
+            soc -= battery_current * dt / 3600 / capacity
+            state_of_charge[t] = soc
+
+
+def check_parity(lead_distance: np.ndarray, vehicle_parameters: tuple, df=None, kp=0.1, kd=1) -> dict:
+
+    from battery import equivalent_circuit_state_of_charge
+    from vehicles import AutonomousVehicle
+
+    # Running every kernel with both backends and reporting the largest absolute difference
+    vehicle = AutonomousVehicle(*vehicle_parameters)
+    runs = {
+        "control_drive_cycle": lambda: vehicle.control_drive_cycle(lead_distance, kp=kp, kd=kd, df=df),
+        "adaptive_cruise_control_drive_cycle": lambda: vehicle.adaptive_cruise_control_drive_cycle(lead_distance,
+                                                                                                  df=df),
+        "adaptive_cruise_control_drive_cycle_headway":
+            lambda: vehicle.adaptive_cruise_control_drive_cycle(lead_distance, headway=True, df=df),
+        "get_state_of_charge": lambda: vehicle.get_state_of_charge(vehicle.get_power_wheel(
+            *vehicle.compute_speed_acceleration(lead_distance))[1]),
+        "equivalent_circuit_state_of_charge": lambda: equivalent_circuit_state_of_charge(
+            vehicle, *vehicle.compute_speed_acceleration(lead_distance)),
+    }
+
+    backend = BACKEND
+    differences = {}
+    try:
+        for name, run in runs.items():
+            set_backend("python")
+            expected = run()
+            set_backend("numba")
+            result = run()
+            differences[name] = max(float(np.nanmax(np.abs(e - r), initial=0.))
+                                    if np.array_equal(np.isnan(e), np.isnan(r)) else np.inf
+                                    for e, r in zip(expected, result))
+    finally:
+        set_backend(backend)
+
+    return differences
@@ -0,0 +1,72 @@
+import numpy as np
+
+INTEGRATION_SCHEMES = ("rectangle", "trapezoidal", "hermite")
+DIFFERENTIATION_SCHEMES = ("backward", "forward", "central")
+
+
+def _steps(n: int, dt=None, time=None) -> np.ndarray:
+
+    # Time steps between consecutive samples, uniform (dt) or from time stamps
+    if time is not None:
+        return np.diff(np.asarray(time, dtype=float))
+    if dt is None:
+        raise ValueError("dt or time is needed")
+    return np.full(max(n - 1, 0), float(dt))
+
+
+def integrate(values: np.ndarray, dt=None, time=None, scheme="rectangle", initial=0.) -> np.ndarray:
+
+    values = np.asarray(values, dtype=float)
+
+    # Sum of values[p] * dt up to p included, the first step being taken equal to the second one
+    if scheme == "rectangle":
+        if time is not None:
+            time = np.asarray(time, dtype=float)
+            steps = np.diff(time, prepend=2 * time[0] - time[1] if len(time) > 1 else time[0])
+            return initial + np.cumsum(values * steps)
+        return initial + np.cumsum(values * dt)
+
+    if scheme not in INTEGRATION_SCHEMES:
+        raise ValueError(f"Unknown integration scheme {scheme}")
+
+    steps = _steps(len(values), dt, time)
+    increments = steps * (values[1:] + values[:-1]) / 2
+
+    # Cubic Hermite correction, slopes from second order differences
+    if scheme == "hermite" and len(values) > 2:
+        slopes = np.gradient(values, time if time is not None else dt, edge_order=2)
+        increments += steps ** 2 * (slopes[:-1] - slopes[1:]) / 12
+
+    integral = np.empty(values.shape)
+    integral[0] = initial
+    integral[1:] = initial + np.cumsum(increments)
+
+    return integral
+
+
+def differentiate(values: np.ndarray, dt=None, time=None, scheme="backward") -> np.ndarray:
+
+    values = np.asarray(values, dtype=float)
+    derivative = np.zeros(values.shape)
+
+    if len(values) < 2:
+        return derivative
+
+    steps = _steps(len(values), dt, time)
+
+    # First sample kept at zero
+    if scheme == "backward":
+        derivative[1:] = np.diff(values) / steps
+
+    # Last sample kept at zero
+    elif scheme == "forward":
+        derivative[:-1] = np.diff(values) / steps
+
+    # Second order on uniform and non uniform time stamps
+    elif scheme == "central":
+        derivative = np.gradient(values, time if time is not None else dt, edge_order=2 if len(values) > 2 else 1)
+
+    else:
+        raise ValueError(f"Unknown differentiation scheme {scheme}")
+
+    return derivative
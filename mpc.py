@@ -0,0 +1,224 @@
+import numpy as np
+
+# Optional Cholesky solver of scipy, the inverse of the numpy factor applied twice otherwise
+try:
+    from scipy.linalg import cho_factor, cho_solve
+except ImportError:
+    cho_factor = cho_solve = None
+
+# Weights of the gap tracking, comfort (acceleration and jerk) and battery energy terms
+WEIGHTS = {"gap": 1., "acceleration": 0.5, "jerk": 1., "energy": 1e-5}
+
+# ADMM step of the constraints once scaled to unit rows and over-relaxation of the constraint values, fewest
+# iterations to the tolerance on the EPA cycles with and without headway
+RHO = 5.
+RELAXATION = 1.6
+
+
+class ModelPredictiveController:
+
+    def __init__(self, vehicle, horizon=20, headway=False, weights=None, tolerance=1e-3, max_iterations=2000,
+                 rho=RHO, sigma=1e-6, check_every=5, relaxation=RELAXATION):
+
+        # Quadratic program over the accelerations of the horizon, solved by ADMM until its residuals are below the
+        # tolerance: min 1/2 u'Pu + q'u  s.t.  l <= Au <= u_bound, P and A constant so that the system is
+        # factorized once
+        self.vehicle = vehicle
+        self.horizon = horizon
+        self.headway = headway
+        self.weights = {**WEIGHTS, **(weights or {})}
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.check_every = check_every
+        self.rho, self.sigma = rho, sigma
+        self.relaxation = relaxation
+
+        dt, h = vehicle.dt, horizon
+        self.steps = np.arange(1, h + 1)
+
+        # Speeds and gaps of the horizon are affine in the accelerations u:
+        # v = v0 + dt L u,  gap = gap0 + i dt (v_lead - v0) - dt^2 M u
+        lower = np.tril(np.ones((h, h)))
+        self.speed_matrix = dt * lower
+        self.gap_matrix = dt ** 2 * lower @ lower
+        difference = np.eye(h) - np.eye(h, k=-1)
+
+        w = self.weights
+        self.hessian = 2 * (w["gap"] * self.gap_matrix.T @ self.gap_matrix + w["acceleration"] * np.eye(h) +
+                            w["jerk"] * difference.T @ difference)
+        self.difference = difference
+
+        # Constraints: acceleration bounds, speed >= 0, gap >= gap_min (and gap - headway_min v >= 0)
+        rows = [np.eye(h), self.speed_matrix, -self.gap_matrix]
+        if headway:
+            rows.append(-self.gap_matrix - vehicle.headway_min * self.speed_matrix)
+        constraints = np.vstack(rows)
+
+        # Rows scaled to a unit norm: the gap rows grow as the square of the horizon, and ADMM converges slowly on
+        # badly scaled constraints
+        self.row_scale = 1 / np.linalg.norm(constraints, axis=1)
+        self.constraints = self.row_scale[:, None] * constraints
+        n_constraints = constraints.shape[0]
+        self.lower = np.full(n_constraints, float(vehicle.acceleration_min))
+        self.upper = self.row_scale * np.concatenate([np.full(h, vehicle.acceleration_max),
+                                                      np.full(n_constraints - h, np.inf)])
+
+        # ADMM linear system factorized once. Its solution is affine in the previous solution and in the scaled
+        # slack and multipliers w = rho slack - multipliers: the iteration matrix maps [solution, w / rho, 1] to the
+        # next solution and its relaxed constraint values, its last column set by the linear term of every step
+        system = self.hessian + sigma * np.eye(h) + rho * self.constraints.T @ self.constraints
+        if cho_factor is not None:
+            self.factor = cho_factor(system)
+        else:
+            self.factor = np.linalg.cholesky(system)
+            self.factor_inverse = np.linalg.solve(self.factor, np.eye(h))
+        update = self._solve(np.hstack([sigma * np.eye(h), rho * self.constraints.T]))
+        self.iteration_matrix = np.zeros((h + n_constraints, h + n_constraints + 1))
+        self.iteration_matrix[:, :-1] = np.vstack([update, relaxation * self.constraints @ update])
+
+        self.reset()
+
+    def _solve(self, rhs: np.ndarray) -> np.ndarray:
+
+        # Solution of the ADMM linear system from its Cholesky factor
+        if cho_solve is not None:
+            return cho_solve(self.factor, rhs, check_finite=False)
+        return self.factor_inverse.T @ (self.factor_inverse @ rhs)
+
+    def reset(self):
+
+        # Solver statistics: convergence and iterations of the last solve, solves and solves stopped at
+        # max_iterations
+        self.converged = True
+        self.n_iterations = 0
+        self.n_solves = 0
+        self.n_not_converged = 0
+
+        self._reset_warm_start()
+
+    def _reset_warm_start(self):
+
+        # Warm start of the solver: previous solution, constraint values and multipliers
+        self.solution = np.zeros(self.horizon)
+        self.slack = self.constraints @ self.solution
+        self.multipliers = np.zeros(self.constraints.shape[0])
+        self.acceleration_previous = 0.
+        self.lead_speed_previous = None
+
+    def _energy_gradient(self, follow_speed: float) -> np.ndarray:
+
+        # Gradient of the battery energy of the warm start trajectory, from get_power_wheel
+        vehicle = self.vehicle
+        a, b, c = vehicle.target_abc
+        mass = 1.03 * vehicle.test_weight
+
+        accelerations = self.solution
+        speeds = np.maximum(follow_speed + self.speed_matrix @ accelerations, 0.)
+        speed_mph = 2.23694 * speeds
+        force_road_load = (a + b * speed_mph + c * speed_mph ** 2) * 4.44822
+        force_derivative = (b + 2 * c * speed_mph) * 4.44822 * 2.23694
+        power_wheel = (mass * accelerations + force_road_load) * speeds
+
+        # Traction drawn with the drivetrain losses, regeneration recovered with them
+        efficiency_drivetrain = vehicle.efficiency_transmission * vehicle.efficiency_motor
+        factor = np.where(power_wheel >= 0, 1 / efficiency_drivetrain, efficiency_drivetrain)
+
+        power_speed = factor * (mass * accelerations + force_road_load + force_derivative * speeds)
+        return vehicle.dt * (factor * mass * speeds + self.speed_matrix.T @ power_speed)
+
+    def control(self, gap: float, follow_speed: float, lead_speed: float) -> float:
+
+        vehicle, h = self.vehicle, self.horizon
+        w = self.weights
+
+        # Lead vehicle predicted at the acceleration of its last two speeds, until it stops
+        lead_acceleration = 0.
+        if self.lead_speed_previous is not None and np.isfinite(self.lead_speed_previous):
+            lead_acceleration = (lead_speed - self.lead_speed_previous) / vehicle.dt
+        self.lead_speed_previous = lead_speed
+        lead_speeds = np.maximum(lead_speed + self.steps * vehicle.dt * lead_acceleration, 0.)
+        gap_free = gap + vehicle.dt * np.cumsum(lead_speeds - follow_speed)
+        gap_reference = max(vehicle.gap_min, vehicle.headway_target * lead_speed) if self.headway \
+            else vehicle.gap_target
+
+        jerk_reference = np.zeros(h)
+        jerk_reference[0] = self.acceleration_previous
+        linear = -2 * (w["gap"] * self.gap_matrix.T @ (gap_free - gap_reference) +
+                       w["jerk"] * self.difference.T @ jerk_reference) + \
+            w["energy"] * self._energy_gradient(follow_speed)
+
+        # Bounds of the scaled constraints, the upper ones constant
+        lower = self.lower
+        lower[h:2 * h] = -follow_speed
+        lower[2 * h:3 * h] = vehicle.gap_min - gap_free
+        if self.headway:
+            lower[3 * h:] = vehicle.headway_min * follow_speed - gap_free
+        lower = self.row_scale * lower
+        upper = self.upper
+
+        # ADMM iterations from the shifted previous solution, with the multipliers scaled by rho: one product of the
+        # iteration matrix per iteration, residuals checked every check_every iterations
+        constraints, rho = self.constraints, self.rho
+        matrix = self.iteration_matrix
+        offset = self._solve(linear)
+        matrix[:h, -1] = -offset
+        matrix[h:, -1] = -self.relaxation * constraints @ offset
+
+        slack, scaled = self.slack.copy(), self.multipliers / rho
+        shifted = np.empty_like(slack)
+        current, following = np.empty((2, matrix.shape[1]))
+        current[:h], current[h:-1], current[-1] = self.solution, slack - scaled, 1.
+        following[-1] = 1.
+
+        converged = False
+        for iteration in range(1, self.max_iterations + 1):
+            np.dot(matrix, current, out=following[:-1])
+            constrained = following[h:-1]
+            check = iteration % self.check_every == 0
+            if check:
+                slack_previous = slack.copy()
+
+            # Over-relaxed constraint values shifted by the scaled multipliers, projected on the bounds
+            np.multiply(slack, 1 - self.relaxation, out=shifted)
+            shifted += scaled
+            shifted += constrained
+            np.minimum(np.maximum(shifted, lower, out=slack), upper, out=slack)
+
+            if check:
+                primal = np.max(np.abs(constrained / self.relaxation - slack))
+                dual = rho * np.max(np.abs(constraints.T @ (slack - slack_previous)))
+
+            # Next multipliers, then the slack and multipliers term of the next product in place of the constraints
+            np.subtract(shifted, slack, out=scaled)
+            np.subtract(slack, scaled, out=constrained)
+            current, following = following, current
+
+            if check:
+                if primal <= self.tolerance and dual <= self.tolerance:
+                    converged = True
+                    break
+                if not np.isfinite(primal):
+                    break
+
+        solution = current[:h].copy()
+
+        # Missing lead measurements: no warm start kept for the next step
+        if not np.all(np.isfinite(solution)):
+            self._reset_warm_start()
+            return np.nan
+
+        # Solves stopped at max_iterations reported by the drive cycles, their solution still used
+        self.converged = converged
+        self.n_iterations = iteration
+        self.n_solves += 1
+        self.n_not_converged += not converged
+
+        acceleration = min(max(solution[0], vehicle.acceleration_min), vehicle.acceleration_max)
+
+        # Warm start of the next step
+        self.solution = np.append(solution[1:], solution[-1])
+        self.slack = constraints @ self.solution
+        self.multipliers = rho * scaled
+        self.acceleration_previous = acceleration
+
+        return acceleration
@@ -0,0 +1,144 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Cost of the infeasible states, finite so that interpolations stay defined: values above FEASIBLE_MAX are
+# interpolated with infeasible states, no charge (Ah) reaching it
+INFEASIBLE = 1e9
+FEASIBLE_MAX = 1e6
+
+
+def step_charge(vehicle, speed: np.ndarray, acceleration: np.ndarray) -> np.ndarray:
+
+    # Capacity supplied by the battery (Ah) during one step, battery model of get_state_of_charge
+    _, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+
+    efficiency_drivetrain = vehicle.efficiency_transmission * vehicle.efficiency_motor
+    power_battery = np.where(power_wheel >= 0, power_wheel / efficiency_drivetrain,
+                             efficiency_drivetrain * power_wheel) + vehicle.standby_losses
+
+    discriminant = vehicle.voltage_nominal ** 2 - 4 * vehicle.resistance * power_battery
+    battery_current = (vehicle.voltage_nominal - np.sqrt(np.maximum(discriminant, 0.))) / (2 * vehicle.resistance)
+
+    return np.where(discriminant >= 0, battery_current * vehicle.dt / 3600, INFEASIBLE)
+
+
+def energy_optimal_trajectory(vehicle, lead_distance: np.ndarray, headway=False, gap_max=40., n_gaps=21,
+                              acceleration_step=0.5, initial_gap=1.) -> tuple:
+
+    # Dynamic programming over (gap, speed) grids, backward in time
+    dt = vehicle.dt
+    lead_distance = np.asarray(lead_distance, dtype=float)
+
+    # Missing positions hold the last known one
+    known = np.where(np.isnan(lead_distance), 0, np.arange(len(lead_distance)))
+    lead_distance = np.nan_to_num(lead_distance[np.maximum.accumulate(known)])
+    lead_step = np.diff(lead_distance)
+    n_steps = len(lead_distance)
+
+    gaps = np.linspace(vehicle.gap_min, gap_max, n_gaps)
+    gap_resolution = gaps[1] - gaps[0]
+    speed_step = acceleration_step * dt
+    speed_max = np.max(lead_step, initial=0.) / dt * 1.2 + speed_step
+    speeds = np.arange(0., speed_max + speed_step, speed_step)
+    n_speeds = len(speeds)
+
+    # Controls: accelerations in steps of acceleration_step within the bounds, i.e. next speed index offsets
+    offsets = np.arange(int(np.ceil(vehicle.acceleration_min / acceleration_step - 1e-9)),
+                        int(np.floor(vehicle.acceleration_max / acceleration_step + 1e-9)) + 1)
+    next_index = np.arange(n_speeds)[None, :] + offsets[:, None]
+    valid_control = (next_index >= 0) & (next_index < n_speeds)
+    next_index = np.clip(next_index, 0, n_speeds - 1)
+
+    # Stage cost of every (control, speed), the same at every step
+    acceleration = offsets[:, None] * acceleration_step
+    stage_cost = np.where(valid_control, step_charge(vehicle, speeds[next_index], acceleration), INFEASIBLE)
+
+    # Minimum gap of every state: space (gap_min) or time (headway_min)
+    gap_constraint = np.maximum(vehicle.gap_min, speeds * vehicle.headway_min) if headway \
+        else np.full(n_speeds, vehicle.gap_min)
+    state_penalty = np.where(gaps[:, None] >= gap_constraint[None, :] - 1e-9, 0., INFEASIBLE)
+
+    # Values of every step kept for the rollout, in single precision as the whole backward pass: costs are compared,
+    # not accumulated, and the control search moves half the bytes
+    values = np.empty((n_steps, n_gaps, n_speeds), dtype=np.float32)
+    values[-1] = state_penalty
+    stage_cost_single, state_penalty_single = stage_cost.astype(np.float32), state_penalty.astype(np.float32)
+
+    # Next gap rows shifted by a whole number of rows per speed, padded with infeasible rows so that every shift
+    # stays in the array: interpolations with them are penalized, and infeasible beyond half a row
+    n_padding = int(np.ceil((np.max(np.abs(lead_step), initial=0.) + speeds[-1] * dt) / gap_resolution)) + 2
+    value_padded = np.full((n_gaps + 2 * n_padding, n_speeds), INFEASIBLE, dtype=np.float32)
+    flat = value_padded.ravel()
+    flat_above = flat[n_speeds:]
+    flat_index = (np.arange(n_gaps)[:, None] + n_padding) * n_speeds + np.arange(n_speeds)[None, :]
+    speed_shift = speeds * dt / gap_resolution
+
+    # Arriving values padded on the speed axis: the next speeds of the controls are a (control, gap, speed) view
+    padding = int(np.max(np.abs(offsets)))
+    arriving_padded = np.full((n_gaps, n_speeds + 2 * padding), INFEASIBLE, dtype=np.float32)
+    arriving = arriving_padded[:, padding:padding + n_speeds]
+    controlled = sliding_window_view(arriving_padded, n_speeds, axis=1)[:, padding + offsets[0]:
+                                                                         padding + offsets[-1] + 1].transpose(1, 0, 2)
+    total = np.empty((len(offsets), n_gaps, n_speeds), dtype=np.float32)
+
+    for k in range(n_steps - 2, -1, -1):
+
+        # Value of arriving at next speed j from gap g: gap' = g + lead step - v_j dt, the same shift of the gap grid
+        # for every g, interpolated between the rows around it
+        value_padded[n_padding:n_padding + n_gaps] = values[k + 1]
+        shift = lead_step[k] / gap_resolution - speed_shift
+        lower = np.floor(shift)
+        index = flat_index + lower.astype(int) * n_speeds
+        below = flat.take(index)
+        np.subtract(flat_above.take(index), below, out=arriving)
+        arriving *= shift - lower
+        arriving += below
+
+        # Best control of every state
+        value = values[k]
+        np.add(controlled, stage_cost_single[:, None, :], out=total)
+        np.minimum.reduce(total, axis=0, out=value)
+        value += state_penalty_single
+        np.minimum(value, INFEASIBLE, out=value)
+
+    # Forward rollout from the initial state, the best control being evaluated at the actual gap
+    gap = np.zeros(n_steps)
+    follow_speed = np.zeros(n_steps)
+    follow_acceleration = np.zeros(n_steps)
+    follow_distance = np.zeros(n_steps)
+
+    gap[0] = max(initial_gap, vehicle.gap_min)
+    follow_distance[0] = lead_distance[0] - gap[0]
+    speed_index = 0
+
+    if _value(values[0], gaps, gap[:1], next_index[:1, 0])[0] >= FEASIBLE_MAX:
+        raise ValueError("No trajectory satisfies the gap and acceleration constraints, increase gap_max")
+
+    distance_steps = speeds * dt
+    for k in range(n_steps - 1):
+        candidates = next_index[:, speed_index]
+        next_gap = (gap[k] + lead_step[k]) - distance_steps[candidates]
+        total = stage_cost[:, speed_index] + _value(values[k + 1], gaps, next_gap, candidates)
+        total[next_gap < gap_constraint[candidates] - 1e-9] = INFEASIBLE
+
+        # Hardest braking when no control is feasible from a gap between grid gaps
+        c = total.argmin()
+        if total[c] >= FEASIBLE_MAX:
+            c = np.where(valid_control[:, speed_index], next_gap, -np.inf).argmax()
+        speed_index = candidates[c]
+
+        follow_speed[k + 1] = speeds[speed_index]
+        follow_acceleration[k + 1] = (follow_speed[k + 1] - follow_speed[k]) / dt
+        follow_distance[k + 1] = follow_distance[k] + follow_speed[k + 1] * dt
+        gap[k + 1] = lead_distance[k + 1] - follow_distance[k + 1]
+
+    return follow_distance, follow_speed, follow_acceleration, gap
+
+
+def _value(value: np.ndarray, gaps: np.ndarray, gap: np.ndarray, speed_indices: np.ndarray) -> np.ndarray:
+
+    # Values at off grid gaps of the given speed columns, gaps above the grid valued at its last gap
+    position = np.minimum(np.maximum((gap - gaps[0]) / (gaps[1] - gaps[0]), 0.), len(gaps) - 1)
+    lower = np.minimum(position.astype(int), len(gaps) - 2)
+    below = value[lower, speed_indices]
+    return below + (position - lower) * (value[lower + 1, speed_indices] - below)
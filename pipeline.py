@@ -0,0 +1,289 @@
+import numpy as np
+import hashlib
+import inspect
+import json
+import os
+from collections import namedtuple
+
+import cache
+import profiling
+from preprocess import DATASET_DIRECTORY, COLUMNS, load_drive_cycle, computing_absolute_distance
+from registry import FIELDS, load_vehicle_file, validate
+from vehicles import AutonomousVehicle
+
+# Parameters of the autonomous vehicle used by the controllers
+AUTONOMOUS_FIELDS = ["gap_target", "gap_min", "headway_target", "headway_min", "acceleration_min", "acceleration_max"]
+
+# Fields of the vehicle file read by each stage: a stage is recomputed only when one of its own fields changes
+ROAD_LOAD_FIELDS = ["test_weight", "a", "b", "c"]
+BATTERY_FIELDS = ["nominal_voltage", "resistance", "capacity", "efficiency_transmission", "efficiency_motor",
+                  "standby_losses"]
+CONTROLLER_FIELDS = {"baseline": [], "ccc": [], "acc": [], "mpc": FIELDS}
+
+# Outputs of a stage: key of its inputs and parameters, tuple of arrays
+StageResult = namedtuple("StageResult", ["key", "values"])
+
+DEFAULT_CONFIG = {
+    "cycle": "HWY.txt",
+    "filtering": "1hz",
+    "vehicle": "spark.json5",
+    "vehicle_parameters": {},
+    "dt": 0.5,
+    "soc_initial": 0.5,
+    "controllers": [
+        {"name": "ccc", "type": "ccc", "parameters": {"kp": 0.1, "kd": 1},
+         "title": "Classical Cruise Control", "histogram_title": "Acceleration inputs CCC",
+         "legend": " Autonomous DC - CCC"},
+        {"name": "acc", "type": "acc", "parameters": {"headway": False},
+         "title": "Adaptive Cruise Control", "histogram_title": "Acceleration inputs ACC",
+         "legend": " Autonomous DC - ACC"},
+    ],
+    "titles": {"drive_cycle": "Drive Cycle", "soc": "State of charge", "comparison": "Comparison drive cycle"},
+    "baseline_legend": "Standard DC",
+}
+
+
+def _vehicle(fields: dict, dt: float) -> AutonomousVehicle:
+
+    # Vehicle built from the fields of a stage only, the others being NaN so that a stage reading a field it did
+    # not declare gives NaN results instead of stale ones
+    values = {field: fields.get(field, np.nan) for field in FIELDS}
+    vehicle = AutonomousVehicle(values["test_weight"], [values["a"], values["b"], values["c"]],
+                                values["nominal_voltage"], values["resistance"], values["capacity"],
+                                values["efficiency_transmission"], values["efficiency_motor"], values["standby_losses"],
+                                dt=dt)
+    for name in AUTONOMOUS_FIELDS:
+        if name in fields:
+            setattr(vehicle, name, fields[name])
+    if "soc_initial" in fields:
+        vehicle.soc_initial = fields["soc_initial"]
+
+    return vehicle
+
+
+def _dataframe(cycle: tuple) -> "pd.DataFrame":
+
+    import pandas as pd
+    return pd.DataFrame(dict(zip(COLUMNS, cycle)))
+
+
+def _preprocess_stage(cycle: str, filtering: str, source: str) -> tuple:
+
+    # source: hash of the cycle file, only part of the key
+    return tuple(np.asarray(array) for array in load_drive_cycle(cycle, filtering))
+
+
+def _kinematics_stage(cycle: tuple, dt: float) -> tuple:
+    return computing_absolute_distance(_dataframe(cycle), dt)
+
+
+def _controller_stage(cycle: tuple, kinematics: tuple, controller: str, dt: float, headway=False, kp=0.1, kd=1,
+                      horizon=20, **fields) -> tuple:
+
+    # Trajectory of the vehicle: absolute distance, speed, acceleration (and gap to the lead)
+    df = _dataframe(cycle)
+    lead_distance, _ = kinematics
+    vehicle = _vehicle(fields, dt)
+
+    if controller == "baseline":
+        speed, acceleration = cycle[1], cycle[2]
+        return lead_distance, speed, acceleration, np.zeros(len(speed))
+    if controller == "ccc":
+        speed, acceleration, gap = vehicle.control_drive_cycle(lead_distance, kp=kp, kd=kd, df=df)
+        return lead_distance - gap, speed, acceleration, gap
+    if controller == "acc":
+        _, speed, acceleration, gap = vehicle.adaptive_cruise_control_drive_cycle(lead_distance, headway=headway,
+                                                                                 df=df)
+        return lead_distance - gap, speed, acceleration, gap
+    if controller == "mpc":
+        _, speed, acceleration, gap = vehicle.model_predictive_drive_cycle(lead_distance, horizon=horizon,
+                                                                           headway=headway, df=df)
+        return lead_distance - gap, speed, acceleration, gap
+
+    raise ValueError(f"Unknown controller {controller}")
+
+
+def _wheel_power_stage(trajectory: tuple, dt: float, **fields) -> tuple:
+
+    _, speed, acceleration, _ = trajectory
+    _, power_wheel = _vehicle(fields, dt).get_power_wheel(speed, acceleration)
+    return (power_wheel,)
+
+
+def _state_of_charge_stage(wheel_power: tuple, dt: float, **fields) -> tuple:
+    return _vehicle(fields, dt).get_state_of_charge(wheel_power[0])
+
+
+def _mpge_stage(cycle: tuple, trajectory: tuple, state_of_charge: tuple) -> tuple:
+
+    follow_distance = trajectory[0]
+    power_battery, _ = state_of_charge
+    return (np.asarray(AutonomousVehicle.get_mpge(cycle[0], follow_distance, power_battery)),)
+
+
+class Pipeline:
+
+    def __init__(self, persistent=False):
+
+        # Outputs of the stages by key, in memory and in the arrays cache when persistent
+        self.persistent = persistent
+        self.results = {}
+        self.computed, self.reused = [], []
+        self._figures = []
+
+    @staticmethod
+    def key(name: str, inputs=(), parameters=None) -> str:
+
+        # Key of a stage: its name, its parameters and the keys of its inputs (which already cover everything
+        # upstream), so that nothing but the parameters is hashed
+        description = json.dumps({"version": cache.CACHE_VERSION, "stage": name, "parameters": parameters or {},
+                                  "inputs": [result.key for result in inputs]}, sort_keys=True, default=str)
+        return f"stage-{hashlib.sha256(description.encode()).hexdigest()[:32]}"
+
+    def _load(self, key: str):
+
+        values = self.results.get(key)
+        if values is None and self.persistent:
+            n_values = cache.load_arrays(key, ["n_values"])
+            if n_values is not None:
+                values = tuple(cache.load_arrays(key, [str(i) for i in range(int(n_values[0][0]))]))
+                self.results[key] = values
+
+        return values
+
+    def _store(self, key: str, values: tuple):
+
+        self.results[key] = values
+        if self.persistent:
+            cache.store_arrays(key, ["n_values", *[str(i) for i in range(len(values))]],
+                               [np.array([len(values)]), *values])
+
+    def run(self, name: str, function, inputs=(), parameters=None) -> StageResult:
+
+        # Output of the stage, computed only when no output is stored under its key
+        parameters = parameters or {}
+        key = self.key(name, inputs, parameters)
+
+        values = self._load(key)
+        if values is not None:
+            self.reused.append(name)
+            return StageResult(key, values)
+
+        n_samples = next((len(value) for result in inputs for value in result.values if np.ndim(value) > 0), None)
+        with profiling.stage(name, n_samples=n_samples):
+            values = tuple(function(*[result.values for result in inputs], **parameters))
+
+        self._store(key, values)
+        self.computed.append(name)
+
+        return StageResult(key, values)
+
+    def figure(self, function: str, inputs: list, build, parameters=None, **kwargs):
+
+        # Figure job queued for render(), skipped when the figure was rendered from the same data, parameters
+        # (not passed as kwargs, as the legends) and kwargs
+        import plotting_saving
+
+        name = f"figure:{function}"
+        key = self.key(name, inputs, {"parameters": parameters or {}, "kwargs": kwargs})
+
+        title = kwargs.get("title", inspect.signature(getattr(plotting_saving, function)).parameters["title"].default)
+        saved = os.path.isdir(plotting_saving.FIGURES_DIRECTORY) and \
+            any(os.path.splitext(filename)[0] == title for filename in os.listdir(plotting_saving.FIGURES_DIRECTORY))
+
+        if saved and self._load(key) is not None:
+            self.reused.append(name)
+            return
+
+        self._figures.append((key, name, (function, build(*[result.values for result in inputs]), kwargs)))
+
+    def render(self, n_workers=None):
+
+        from plotting_saving import render_figures
+
+        if self._figures:
+            render_figures([job for _, _, job in self._figures], n_workers=n_workers)
+
+        for key, name, _ in self._figures:
+            self._store(key, (np.array(True),))
+            self.computed.append(name)
+        self._figures = []
+
+
+def run_pipeline(pipeline: Pipeline, config=None, render=True, store=None) -> dict:
+
+    # main.py chain as stages: preprocess -> kinematics -> controller -> wheel power -> soc -> mpge -> figures,
+    # series of every controller written in the results store when given
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    pipeline.computed, pipeline.reused = [], []
+    dt = config["dt"]
+
+    vehicle_fields = load_vehicle_file(os.path.join(DATASET_DIRECTORY, config["vehicle"]))
+    vehicle_fields = validate({**vehicle_fields, **config["vehicle_parameters"]}, source=config["vehicle"])
+
+    cycle_filepath = os.path.join(DATASET_DIRECTORY, config["cycle"])
+    cycle = pipeline.run("preprocess", _preprocess_stage, (), {"cycle": config["cycle"],
+                                                               "filtering": config["filtering"],
+                                                               "source": cache.file_hash(cycle_filepath)})
+    kinematics = pipeline.run("kinematics", _kinematics_stage, (cycle,), {"dt": dt})
+
+    road_load = {field: vehicle_fields[field] for field in ROAD_LOAD_FIELDS}
+    battery = {**{field: vehicle_fields[field] for field in BATTERY_FIELDS}, "soc_initial": config["soc_initial"]}
+
+    titles = config["titles"]
+    pipeline.figure("plotting_drive_cycle", [cycle], lambda values: [_dataframe(values)], title=titles["drive_cycle"])
+
+    controllers = [{"name": "baseline", "type": "baseline", "parameters": {}}] + config["controllers"]
+    outputs = {}
+    for controller in controllers:
+
+        parameters = dict(controller.get("parameters", {}))
+        fields = {field: vehicle_fields[field] for field in CONTROLLER_FIELDS[controller["type"]]}
+        fields.update({name: parameters.pop(name) for name in AUTONOMOUS_FIELDS if name in parameters})
+
+        trajectory = pipeline.run(f"controller:{controller['name']}", _controller_stage, (cycle, kinematics),
+                                  {"controller": controller["type"], "dt": dt, **parameters, **fields})
+        wheel_power = pipeline.run(f"wheel_power:{controller['name']}", _wheel_power_stage, (trajectory,),
+                                   {"dt": dt, **road_load})
+        state_of_charge = pipeline.run(f"state_of_charge:{controller['name']}", _state_of_charge_stage,
+                                       (wheel_power,), {"dt": dt, **battery})
+        mpge = pipeline.run(f"mpge:{controller['name']}", _mpge_stage, (cycle, trajectory, state_of_charge))
+
+        outputs[controller["name"]] = {"trajectory": trajectory, "state_of_charge": state_of_charge, "mpge": mpge}
+
+        if controller["type"] != "baseline":
+            # Title, and so file name, of the speeds naming the headway when the controller considers it
+            title = controller["title"] + (" considering headway" if parameters.get("headway") else "")
+            pipeline.figure("plotting_speed_lead_follow", [cycle, kinematics, trajectory],
+                            lambda c, k, t: [c[0], k[1], t[1], t[3]], title=title)
+            pipeline.figure("plotting_acceleration_decisions", [trajectory], lambda t: [t[2]],
+                            title=controller["histogram_title"])
+
+    # Comparison of the vehicles
+    names = list(outputs)
+    legends = [config["baseline_legend"]] + [controller["legend"] for controller in config["controllers"]]
+    pipeline.figure("plotting_soc", [outputs[name]["state_of_charge"] for name in names],
+                    lambda *socs: [[soc[1] for soc in socs], legends], {"legends": legends}, title=titles["soc"])
+
+    speed_legends = ["lead_speed"] + [f"following_speed_{name}" for name in names[1:]]
+    pipeline.figure("plotting_comparison", [kinematics] + [outputs[name]["trajectory"] for name in names[1:]],
+                    lambda k, *trajectories: [[k[1]] + [t[1] for t in trajectories], speed_legends],
+                    {"legends": speed_legends}, title=titles["comparison"])
+
+    if store is not None:
+        for controller in controllers:
+            distance, speed, acceleration, gap = outputs[controller["name"]]["trajectory"].values
+            power_battery, state_of_charge = outputs[controller["name"]]["state_of_charge"].values
+            columns = {"distance": distance, "speed": speed, "acceleration": acceleration, "gap": gap,
+                       "power_battery": power_battery, "state_of_charge": state_of_charge}
+            store.write(columns, cycle.values[0], config["cycle"], config["vehicle"], controller["type"],
+                        controller.get("parameters", {}), dt=dt, name=controller["name"],
+                        filtering=config["filtering"], vehicle_parameters=config["vehicle_parameters"],
+                        soc_initial=config["soc_initial"])
+
+    if render:
+        with profiling.stage("plotting"):
+            pipeline.render()
+
+    return {name: {"mpge": float(output["mpge"].values[0]), "state_of_charge": output["state_of_charge"].values[1],
+                   "speed": output["trajectory"].values[1]} for name, output in outputs.items()}
@@ -0,0 +1,205 @@
+import numpy as np
+import warnings
+
+import kernels
+from mpc import ModelPredictiveController
+from profiling import profiled
+from vehicles import Vehicle, batch_state_of_charge
+
+CONTROLLERS = ("ccc", "acc", "mpc")
+
+
+def _controllers(controllers, n_followers: int) -> list:
+
+    # "acc" or {"type": "acc", "headway": True} for every follower, a single one being shared by the platoon
+    if isinstance(controllers, (str, dict)):
+        controllers = [controllers] * n_followers
+    if len(controllers) != n_followers:
+        raise ValueError(f"{len(controllers)} controllers for {n_followers} followers")
+
+    specs = []
+    for controller in controllers:
+        spec = {"type": controller} if isinstance(controller, str) else dict(controller)
+        if spec["type"] not in CONTROLLERS:
+            raise ValueError(f"Unknown controller {spec['type']}")
+        specs.append(spec)
+
+    return specs
+
+
+@profiled()
+def simulate_platoon(lead_distance: np.ndarray, vehicles: list, controllers="acc", df=None) -> tuple:
+
+    # Followers from the front to the back of the platoon, each one following the vehicle ahead of it:
+    # the lead cycle for the first one, the previous follower otherwise.
+    # The ACC and CCC laws only see the vehicle ahead at the previous step: a gap error of one follower is passed
+    # amplified to the next one (string instability), so that long ACC platoons saturate their acceleration bounds
+    # and collide within a few positions. Speeds are kept non negative and collisions are warned, not prevented
+    n_followers = len(vehicles)
+    specs = _controllers(controllers, n_followers)
+    if n_followers == 0:
+        raise ValueError("Empty platoon")
+
+    dt = vehicles[0].dt
+    if any(vehicle.dt != dt for vehicle in vehicles):
+        raise ValueError("Followers of a platoon share the same time step")
+
+    # Followers parameters as arrays of n_followers
+    def column(name):
+        return np.array([getattr(vehicle, name) for vehicle in vehicles], dtype=float)
+
+    gap_target, gap_min = column("gap_target"), column("gap_min")
+    headway_target, headway_min = column("headway_target"), column("headway_min")
+    acceleration_min, acceleration_max = column("acceleration_min"), column("acceleration_max")
+
+    kinds = np.array([spec["type"] for spec in specs])
+    ccc, mpc = kinds == "ccc", kinds == "mpc"
+    headway = np.array([bool(spec.get("headway", False)) for spec in specs])
+    kp = np.array([spec.get("kp", 0.1) for spec in specs], dtype=float)
+    kd = np.array([spec.get("kd", 1) for spec in specs], dtype=float)
+
+    # Model predictive followers are solved one by one, all the others in lockstep
+    predictive = {k: ModelPredictiveController(vehicles[k], horizon=specs[k].get("horizon", 20),
+                                               headway=headway[k], weights=specs[k].get("weights"))
+                  for k in np.flatnonzero(mpc)}
+
+    # Lead speed, true one when df is given
+    if df is None:
+        lead_speed, _ = vehicles[0].compute_speed_acceleration(lead_distance)
+    else:
+        lead_speed = df[df.columns[1]].values
+
+    # Time major arrays (n_steps, 1 + n_followers), column 0 being the lead vehicle: the vehicle ahead of every
+    # follower is the previous column and every step writes one contiguous row
+    n_steps = lead_speed.shape[0]
+    distance = np.zeros((n_steps, n_followers + 1))
+    speed = np.zeros((n_steps, n_followers + 1))
+    acceleration = np.zeros((n_steps, n_followers + 1))
+    gap = np.zeros((n_steps, n_followers + 1))
+
+    distance[:, 0] = lead_distance
+    speed[:, 0] = lead_speed
+    gap[0, 1:] = 1    # gap initial in meter
+    distance[0, 1:] = lead_distance[0] - np.arange(1, n_followers + 1) * gap[0, 1:]
+    e_prev = np.ones(n_followers)
+
+    # CCC followers have no position of their own, only a gap: they are placed behind the closest vehicle ahead
+    # which is not a CCC follower (anchor), minus the gaps in between
+    behind_ccc = np.concatenate([[False], ccc])
+    anchor = np.maximum.accumulate(np.where(behind_ccc, 0, np.arange(n_followers + 1)))
+
+    for d in range(n_steps - 1):
+
+        ahead_speed, follow_speed, gap_d = speed[d, :-1], speed[d, 1:], gap[d, 1:]
+
+        # ACC of every follower, each with its own headway mode
+        acceleration_next = kernels.acc_acceleration(gap_d, follow_speed, ahead_speed, gap_d < gap_min, headway,
+                                                     gap_target, gap_min, headway_target, headway_min,
+                                                     acceleration_min, acceleration_max, dt)
+
+        for k, controller in predictive.items():
+            acceleration_next[k] = controller.control(gap_d[k], follow_speed[k], ahead_speed[k])
+
+        # Braking down to a stop at most, never driving backwards
+        acceleration_next = np.maximum(acceleration_next, - follow_speed / dt)
+
+        acceleration[d + 1, 1:] = np.where(ccc, 0., acceleration_next)
+        speed[d + 1, 1:] = follow_speed + acceleration_next * dt
+        distance[d + 1, 1:] = distance[d, 1:] + speed[d + 1, 1:] * dt
+
+        if ccc.any():
+            # CCC: nothing is controlled while the vehicle ahead is stopped
+            moving = ccc & (ahead_speed != 0.)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                gap_ccc = gap_d + (ahead_speed - follow_speed) * dt
+                speed_ccc, e = kernels.ccc_speed(gap_ccc, follow_speed, ahead_speed, e_prev, kp, kd, gap_target,
+                                                 acceleration_max, dt)
+            speed_ccc = np.maximum(speed_ccc, 0.)
+
+            # Acceleration of the current step, as in control_drive_cycle
+            acceleration[d, 1:] = np.where(moving, (speed_ccc - follow_speed) / dt, acceleration[d, 1:])
+            speed[d + 1, 1:] = np.where(ccc, np.where(moving, speed_ccc, 0.), speed[d + 1, 1:])
+            gap[d + 1, 1:] = np.where(ccc, np.where(moving, gap_ccc, 0.), 0.)
+            e_prev = np.where(moving, e, e_prev)
+
+            gap_behind = np.where(behind_ccc, gap[d + 1], 0.).cumsum()
+            distance[d + 1] = distance[d + 1, anchor] - (gap_behind - gap_behind[anchor])
+
+        # Gaps of the followers with a position of their own
+        gap[d + 1, 1:] = np.where(ccc, gap[d + 1, 1:], distance[d + 1, :-1] - distance[d + 1, 1:])
+
+    collision = np.any(gap[:, 1:] < 0, axis=0)
+    if collision.any():
+        warnings.warn(f"Collision in the platoon: {int(collision.sum())} of {n_followers} followers reach a negative "
+                      f"gap, the first one at position {int(np.argmax(collision))} "
+                      f"(min {np.nanmin(gap[:, 1:]):.2f} m)", RuntimeWarning)
+
+    # Arrays of shape (n_followers, n_steps)
+    return distance[:, 1:].T, speed[:, 1:].T, acceleration[:, 1:].T, gap[:, 1:].T
+
+
+def platoon_energy(vehicles: list, time: np.ndarray, follow_distance: np.ndarray, follow_speed: np.ndarray,
+                   follow_acceleration: np.ndarray) -> tuple:
+
+    # Power at the wheel of every position with its own road load and mass
+    a, b, c = (np.array([vehicle.target_abc[i] for vehicle in vehicles], dtype=float)[:, None] for i in range(3))
+    modeled_mass = 1.03 * np.array([vehicle.test_weight for vehicle in vehicles], dtype=float)[:, None]
+
+    speed_mph = 2.23694 * follow_speed
+    force_road_load = (a + b * speed_mph + c * speed_mph ** 2) * 4.44822
+    power_wheel = (modeled_mass * follow_acceleration + force_road_load) * follow_speed
+
+    def column(name):
+        return np.array([getattr(vehicle, name) for vehicle in vehicles], dtype=float)
+
+    power_battery, state_of_charge = batch_state_of_charge(
+        power_wheel, column("voltage_nominal"), column("resistance"), column("capacity"),
+        column("efficiency_transmission"), column("efficiency_motor"), column("standby_losses"),
+        soc_initial=column("soc_initial"), dt=vehicles[0].dt)
+
+    mpge = np.array([Vehicle.get_mpge(time, distance, power) for distance, power in
+                     zip(follow_distance, power_battery)])
+
+    return power_battery, state_of_charge, mpge
+
+
+def string_stability(lead_acceleration: np.ndarray, follow_acceleration: np.ndarray, gap: np.ndarray,
+                     dt=0.5, tolerance=1e-3) -> dict:
+
+    # L2 gain of the accelerations from one position to the next: the string is stable when no follower
+    # amplifies the oscillations of the vehicle ahead of it
+    accelerations = np.nan_to_num(np.vstack([lead_acceleration, follow_acceleration]))
+    norms = np.sqrt(np.sum(accelerations ** 2, axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gains = np.where(norms[:-1] > 0, norms[1:] / norms[:-1], np.where(norms[1:] > 0, np.inf, 1.))
+
+    jerk = np.diff(follow_acceleration, axis=1) / dt
+
+    return {
+        "acceleration_gain": gains,
+        "max_gain": float(np.max(gains)),
+        "string_stable": bool(np.all(gains <= 1 + tolerance)),
+        "min_gap": np.nanmin(gap, axis=1),
+        "collision": np.any(gap < 0, axis=1),
+        "jerk_rms": np.sqrt(np.nanmean(jerk ** 2, axis=1)),
+    }
+
+
+def run_platoon(df, lead_distance: np.ndarray, vehicles: list, controllers="acc") -> dict:
+
+    # Trajectories, consumption and string stability of every position of the platoon
+    follow_distance, follow_speed, follow_acceleration, gap = simulate_platoon(lead_distance, vehicles,
+                                                                               controllers, df=df)
+    time = df[df.columns[0]].values
+    _, state_of_charge, mpge = platoon_energy(vehicles, time, follow_distance, follow_speed, follow_acceleration)
+
+    return {
+        "speed": follow_speed,
+        "acceleration": follow_acceleration,
+        "gap": gap,
+        "state_of_charge": state_of_charge,
+        "soc_drop": state_of_charge[:, 0] - state_of_charge[:, -1],
+        "mpge": mpge,
+        **string_stability(df[df.columns[2]].values, follow_acceleration, gap, dt=vehicles[0].dt),
+    }
@@ -1,105 +1,138 @@
-import matplotlib.pyplot as plt
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import os
 
-BLOCK = False
-FIGURES_DIRECTORY = f"figures"
-if FIGURES_DIRECTORY not in os.listdir():
-    os.mkdir(FIGURES_DIRECTORY)
+# Next to the sources rather than in the working directory, created by setup() and not at import
+FIGURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "figures")
 
 
-def plotting_drive_cycle(dataframe: pd.DataFrame, title=f"Drive Cycle"):
+def setup():
+    os.makedirs(FIGURES_DIRECTORY, exist_ok=True)
+
+
+def _figure(**kwargs):
+
+    # matplotlib imported by the first figure only
+    from matplotlib.figure import Figure
+    return Figure(**kwargs)
+
+
+def decimate(x: np.ndarray, y: np.ndarray, n_columns: int) -> tuple:
+
+    # Min/max decimation: the min and max of the samples falling in each pixel column, in their original order
+    n = len(y)
+    if n <= 2 * n_columns:
+        return x, y
+
+    bucket = -(-n // n_columns)
+    padded = np.pad(np.asarray(y, dtype=float), (0, n_columns * bucket - n), mode="edge").reshape(n_columns, bucket)
+
+    start = np.arange(n_columns)[:, None] * bucket
+    extrema = start + np.stack([np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1),
+                                np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)], axis=1)
+    indices = np.minimum(np.sort(extrema, axis=1).ravel(), n - 1)
+
+    return np.asarray(x)[indices], np.asarray(y)[indices]
+
+
+def _plot(axes, x, y, **kwargs):
+
+    # Line decimated to the pixel width of the axes
+    figure = axes.get_figure()
+    n_columns = int(np.ceil(axes.get_position().width * figure.get_figwidth() * figure.dpi))
+    x_decimated, y_decimated = decimate(np.arange(len(y)) if x is None else x, y, n_columns)
+    axes.plot(x_decimated, y_decimated, **kwargs)
+
+
+def _save(fig: "Figure", title: str):
+
+    filepath_figure = os.path.join(FIGURES_DIRECTORY, title)
+    fig.savefig(filepath_figure)
+
+
+def plotting_drive_cycle(dataframe: "pd.DataFrame", title=f"Drive Cycle"):
 
     # Plot Speed vs time steps
-    fig, axes = plt.subplots(nrows=1, ncols=1)
+    fig = _figure()
+    axes = fig.subplots(nrows=1, ncols=1)
     fig.suptitle(title)
-    plt.grid()
+    axes.grid()
     speed = dataframe[dataframe.columns[1]].values
     time = dataframe[dataframe.columns[0]].values
-    axes.plot(time, speed)
+    _plot(axes, time, speed)
     axes.set_ylabel('Speed')
     axes.set_xlabel('Time')
 
-    plt.show(block=BLOCK)
-
-    filepath_figure = os.path.join(FIGURES_DIRECTORY, title)
-    plt.savefig(filepath_figure)
-    plt.close()
+    _save(fig, title)
 
 
 def plotting_speed_lead_follow(time: np.ndarray, lead_speed: np.ndarray, following_speed: np.ndarray,
                                gap_vehicles: np.ndarray, title="Speed comparison"):
 
     # Plot Speed and gaps
-
-    fig, axes = plt.subplots(nrows=2, ncols=1)
+    fig = _figure()
+    axes = fig.subplots(nrows=2, ncols=1)
     fig.suptitle(title)
 
-    axes[0].plot(time, lead_speed, color='b')
-    axes[0].plot(time, following_speed, color='r', alpha=0.5)
+    _plot(axes[0], time, lead_speed, color='b')
+    _plot(axes[0], time, following_speed, color='r', alpha=0.5)
     axes[0].set_ylabel('Speed [m/s]')
     axes[0].grid()
     axes[0].legend(["Leading", "Following"], loc="upper left")
 
-    axes[1].plot(gap_vehicles[:-10])
+    _plot(axes[1], None, gap_vehicles[:-10])
     axes[1].set_ylabel('Gap [m]')
     axes[1].set_xlabel('Time [s]')
 
     axes[1].grid()
 
-    plt.show(block=BLOCK)
-
-    filepath_figure = os.path.join(FIGURES_DIRECTORY, title)
-    plt.savefig(filepath_figure)
-    plt.close()
+    _save(fig, title)
 
 
 def plotting_powers(powers: list, title=f"Powers"):
 
     # Plot loss vs epochs
-    fig, axes = plt.subplots(nrows=1, ncols=1)
+    fig = _figure()
+    axes = fig.subplots(nrows=1, ncols=1)
     fig.suptitle(title)
-    plt.grid()
+    axes.grid()
 
     for power in powers:
-        axes.plot(power)
+        _plot(axes, None, power)
 
     axes.set_ylabel('Powers')
     axes.set_xlabel('Time')
 
-    plt.show(block=BLOCK)
-
-    filepath_figure = os.path.join(FIGURES_DIRECTORY, title)
-    plt.savefig(filepath_figure)
-    plt.close()
+    _save(fig, title)
 
 
 def plotting_acceleration_decisions(accelerations: np.ndarray, title="Acceleration Decisions Histogram"):
 
-    fig, axes = plt.subplots(nrows=1, ncols=1)
+    fig = _figure()
+    axes = fig.subplots(nrows=1, ncols=1)
     fig.suptitle(title)
-    plt.grid()
-    plt.show(block=BLOCK)
+    axes.grid()
 
-    plt.hist(accelerations, bins=150, density=True)
+    # Histogram computed once, only the bins are drawn
+    accelerations = np.asarray(accelerations)
+    counts, edges = np.histogram(accelerations[np.isfinite(accelerations)], bins=150, density=True)
+    axes.stairs(counts, edges, fill=True)
     axes.set_ylabel('Decisions')
     axes.set_xlabel('Accelerations [m/s^2]')
-    filepath_figure = os.path.join(FIGURES_DIRECTORY, title)
-    plt.savefig(filepath_figure)
-    plt.close()
+
+    _save(fig, title)
 
 
 def plotting_soc(soc: list, legend_handles: list, title=f"State of charge"):
 
-    fig, axes = plt.subplots(nrows=1, ncols=1)
+    fig = _figure()
+    axes = fig.subplots(nrows=1, ncols=1)
     fig.suptitle(title)
-    plt.grid()
-    plt.show(block=BLOCK)
+    axes.grid()
 
     alpha = 1
     for s in soc:
-        axes.plot(s, alpha=alpha)
+        _plot(axes, None, s, alpha=alpha)
         alpha -= 0.2
 
     axes.set_ylabel('State of charge')
@@ -107,29 +140,36 @@ def plotting_soc(soc: list, legend_handles: list, title=f"State of charge"):
     axes.set_ylim([0.25, 0.75])
     axes.legend(legend_handles)
 
-    plt.show(block=BLOCK)
-    filepath_figure = os.path.join(FIGURES_DIRECTORY, title)
-    plt.savefig(filepath_figure)
-    plt.close()
+    _save(fig, title)
 
 
 def plotting_comparison(speeds: list, legend_handles: list, title="Comparison drive cycle"):
 
-    fig, axes = plt.subplots(nrows=1, ncols=1, dpi=500)
+    fig = _figure(dpi=500)
+    axes = fig.subplots(nrows=1, ncols=1)
     fig.suptitle(title)
-    plt.grid()
-    plt.show(block=BLOCK)
+    axes.grid()
 
     for s, speed in enumerate(speeds):
-        axes.plot(speed, linewidth=0.4)
+        _plot(axes, None, speed, linewidth=0.4)
 
     axes.set_ylabel('Speed')
     axes.set_xlabel('Time')
     axes.legend(legend_handles)
 
-    plt.show(block=BLOCK)
-    filepath_figure = os.path.join(FIGURES_DIRECTORY, title)
-    plt.savefig(filepath_figure)
-    plt.close()
+    _save(fig, title)
+
+
+def _render(job: tuple):
+
+    function, args, kwargs = job
+    globals()[function](*args, **kwargs)
+
 
+def render_figures(jobs: list, n_workers=None):
 
+    # Figure jobs (function name, args, kwargs) rendered in worker processes
+    jobs = [(function, tuple(args), dict(kwargs)) for function, args, kwargs in jobs]
+    setup()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(_render, jobs))
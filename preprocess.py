@@ -1,85 +1,263 @@
-import pandas as pd
 import numpy as np
 import os
-import json
 
-DATASET_DIRECTORY = f"dataset"
-if DATASET_DIRECTORY not in os.listdir():
-    os.mkdir(DATASET_DIRECTORY)
+import cache
+from kinematics import integrate, differentiate
+from registry import load_vehicle_file
 
+# Next to the sources rather than in the working directory, created by setup() and not at import
+DATASET_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset")
 
-def preprocess_dataframe(filename: str, filtering: str):
+COLUMNS = ["Time [s]", "Speed [m/s]", "Acceleration [m/s^2]"]
+FILTERINGS = ("1hz", "none", "<rate>hz")
 
-    # Importing Cycles
+
+def setup():
+    os.makedirs(DATASET_DIRECTORY, exist_ok=True)
+
+
+def preprocess_dataframe(filename: str, filtering: str, dt=None, interpolation="linear", use_cache=True):
+
+    import pandas as pd
+
+    time, speed, acceleration, cached = load_drive_cycle(filename, filtering, dt=dt, interpolation=interpolation,
+                                                         use_cache=use_cache, return_cached=True)
+
+    new_df = pd.DataFrame({COLUMNS[0]: time, COLUMNS[1]: speed, COLUMNS[2]: acceleration})
+
+    # Saving csv, only when the cycle was actually preprocessed
+    if not cached:
+        csv_filename = "".join([filename.rstrip("txt"), "csv"])
+        filepath = os.path.join(DATASET_DIRECTORY, csv_filename)
+        new_df.to_csv(filepath)
+
+    return new_df
+
+
+def load_drive_cycle(filename: str, filtering: str, dt=None, interpolation="linear", use_cache=True,
+                     return_cached=False) -> tuple:
+
+    # Time, speed and acceleration arrays, memory mapped from the cache on warm runs
     filepath = os.path.join(DATASET_DIRECTORY, filename)
+    filtering_time_step(filtering, dt)
+    key = cache.cache_key(filepath, filtering=filtering, dt=dt, interpolation=interpolation)
+    names = ["time", "speed", "acceleration"]
+
+    arrays = cache.load_arrays(key, names) if use_cache else None
+    cached = arrays is not None
+
+    if not cached:
+        arrays = preprocess_arrays(filepath, filtering, dt=dt, interpolation=interpolation)
+        if use_cache:
+            cache.store_arrays(key, names, arrays)
+
+    if return_cached:
+        return (*arrays, cached)
+    return tuple(arrays)
+
+
+def filtering_time_step(filtering: str, dt=None):
+
+    # Resampling time step of a filtering, None when the samples are kept ("none") or upsampled ("1hz")
+    if dt is not None or filtering in ("1hz", "none"):
+        return dt
+
+    rate = None
+    if isinstance(filtering, str) and filtering.endswith("hz"):
+        try:
+            rate = float(filtering[:-2])
+        except ValueError:
+            pass
+
+    if rate is None or not np.isfinite(rate) or rate <= 0:
+        raise ValueError(f"Unknown filtering {filtering!r}, expected one of {', '.join(FILTERINGS)} (e.g. '2hz')")
+
+    return 1 / rate
+
+
+def preprocess_arrays(filepath: str, filtering: str, dt=None, interpolation="linear") -> tuple:
+
+    import pandas as pd
+
+    # Target time step: "1hz" keeps the midpoint upsampling of the 1 Hz EPA cycles, "<rate>hz" or dt resamples
+    dt = filtering_time_step(filtering, dt)
+
+    # Importing Cycles
     df = pd.read_csv(filepath, delimiter="\t")
 
     # Converting speed column to numeric values
     columns = df.columns
-    df[columns[1]] = pd.to_numeric(df[columns[1]], errors='coerce')
+    time = df[columns[0]].values
+    speed = pd.to_numeric(df[columns[1]], errors='coerce').values.astype(float)
 
-    # Adding rows to create new time and new speed
-    new_df = df.copy()
+    if dt is not None:
+        time, speed = resample_drive_cycle(time, speed, dt, interpolation=interpolation)
 
     # 1Hz filtering
-    if filtering == "1hz":
-        for index, data in df.iterrows():
-            if index < len(df) - 1:
-                columns = df.columns
-                new_time = (df.iloc[index + 1][columns[0]] + df.iloc[index][columns[0]]) / 2
-                new_speed = (df.iloc[index + 1][columns[1]] + df.iloc[index][columns[1]]) / 2
+    elif filtering == "1hz":
+        time, speed = midpoint_upsampling(time.astype(float), speed)
+
+    # Conversion mph to m/s
+    speed = speed * 0.44704
 
-                inserting_row = [new_time, new_speed]
+    # Calculate acceleration
+    acceleration = compute_acceleration(time, speed)
 
-                new_df = pd.DataFrame(np.insert(new_df.values, 2 * index + 1, inserting_row, axis=0))
+    return time, speed, acceleration
 
-    # Conversion mph to m/s
-    new_df_columns = new_df.columns
 
-    new_df.loc[:, new_df_columns[1]] *= 0.44704
+def preprocess_chunks(filepath: str, filtering: str, dt=None, chunk_size=1 << 20):
 
-    # Renaming columns
-    columns = ["Time [s]", "Speed [m/s]"]
-    new_df = new_df.rename({new_df_columns[0]: columns[0], new_df_columns[1]: columns[1]}, axis='columns')
+    # Generator of (time, speed, acceleration) blocks with the samples of preprocess_arrays (linear interpolation),
+    # reading chunk_size lines at a time: memory bounded whatever the length of the file
+    import pandas as pd
 
-    # Calculate acceleration
-    columns.append(["Acceleration [m/s^2]"])
-    new_df[columns[2]] = np.zeros((len(new_df), 1))
+    dt = filtering_time_step(filtering, dt)
 
-    for index, data in new_df.iterrows():
-        if 0 < index < len(new_df) - 1:
-            dv = (new_df.iloc[index][columns[1]] - new_df.iloc[index - 1][columns[1]])
-            dt = (new_df.iloc[index][columns[0]] - new_df.iloc[index - 1][columns[0]])
+    previous = None    # last line read (time, speed in mph)
+    held = None    # last sample, its acceleration being zero when it ends the cycle
+    time_start, n_emitted = None, 0
 
-            new_df.loc[index, columns[2]] = dv / dt
+    for df in pd.read_csv(filepath, delimiter="\t", chunksize=chunk_size):
 
-    # Saving csv
-    csv_filename = "".join([filename.rstrip("txt"), "csv"])
-    filepath = os.path.join(DATASET_DIRECTORY, csv_filename)
-    new_df.to_csv(filepath)
+        columns = df.columns
+        time = df[columns[0]].values.astype(float)
+        speed = pd.to_numeric(df[columns[1]], errors='coerce').values.astype(float)
 
-    return new_df
+        # Lines of the chunk after the last one of the previous chunk
+        if previous is not None:
+            time, speed = np.concatenate([[previous[0]], time]), np.concatenate([[previous[1]], speed])
+        previous = time[-1], speed[-1]
+
+        if dt is not None:
+            # Grid points strictly before the last line, the others coming with the next chunk (or the end)
+            time_start = time[0] if time_start is None else time_start
+            n_samples = int(np.ceil((time[-1] - time_start) / dt))
+            new_time = time_start + dt * np.arange(n_emitted, max(n_samples, n_emitted))
+            new_time = new_time[new_time < time[-1]]
+            new_speed = np.interp(new_time, time, speed)
+            n_emitted += len(new_time)
+
+        elif filtering == "1hz":
+            new_time, new_speed = midpoint_upsampling(time, speed)
+            new_time, new_speed = (new_time[1:], new_speed[1:]) if held is not None else (new_time, new_speed)
+
+        else:
+            new_time, new_speed = (time[1:], speed[1:]) if held is not None else (time, speed)
+
+        block = _accelerated(held, new_time, new_speed * 0.44704)
+        if block is not None:
+            held = tuple(column[-1] for column in block)
+            yield tuple(column[:-1] for column in block)
+
+    # Grid points from the last line to the end of the cycle
+    if dt is not None and previous is not None:
+        n_samples = int(np.floor((previous[0] - time_start) / dt + 1e-9)) + 1
+        new_time = time_start + dt * np.arange(n_emitted, n_samples)
+        block = _accelerated(held, new_time, np.full(len(new_time), previous[1] * 0.44704))
+        if block is not None:
+            held = tuple(column[-1] for column in block)
+            yield tuple(column[:-1] for column in block)
+
+    if held is not None:
+        yield np.array([held[0]]), np.array([held[1]]), np.zeros(1)
+
+
+def _accelerated(held, time: np.ndarray, speed: np.ndarray):
+
+    # Held sample followed by the new ones, with their backward difference acceleration (zero for the first
+    # sample of the cycle)
+    if held is None and len(time) == 0:
+        return None
+    if held is not None:
+        time, speed = np.concatenate([[held[0]], time]), np.concatenate([[held[1]], speed])
+
+    acceleration = np.zeros(len(time))
+    acceleration[1:] = np.diff(speed) / np.diff(time)
+    if held is not None:
+        acceleration[0] = held[2]
+
+    return time, speed, acceleration
+
+
+def midpoint_upsampling(time: np.ndarray, speed: np.ndarray) -> tuple:
+
+    # Inserting the midpoint between every pair of consecutive samples
+    new_time = np.empty(2 * len(time) - 1)
+    new_speed = np.empty(2 * len(speed) - 1)
+
+    new_time[0::2], new_speed[0::2] = time, speed
+    new_time[1::2] = (time[1:] + time[:-1]) / 2
+    new_speed[1::2] = (speed[1:] + speed[:-1]) / 2
+
+    return new_time, new_speed
+
+
+def resample_drive_cycle(time: np.ndarray, speed: np.ndarray, dt: float, interpolation="linear") -> tuple:
+
+    # Uniform time grid covering the cycle
+    time = np.asarray(time, dtype=float)
+    n_samples = int(np.floor((time[-1] - time[0]) / dt + 1e-9)) + 1
+    new_time = time[0] + dt * np.arange(n_samples)
+
+    if interpolation == "linear":
+        new_speed = np.interp(new_time, time, speed)
+
+    elif interpolation == "cubic":
+        new_speed = cubic_hermite_interpolation(new_time, time, speed)
+
+    else:
+        raise ValueError(f"Unknown interpolation {interpolation}")
+
+    return new_time, new_speed
+
+
+def cubic_hermite_interpolation(new_time: np.ndarray, time: np.ndarray, values: np.ndarray) -> np.ndarray:
+
+    # Slopes at the knots: centered finite differences (one-sided at the edges)
+    slopes = np.gradient(values, time)
+
+    # Interval containing each new sample
+    k = np.clip(np.searchsorted(time, new_time, side="right") - 1, 0, len(time) - 2)
+    h = time[k + 1] - time[k]
+    s = (new_time - time[k]) / h
+
+    # Hermite basis
+    h00 = (1 + 2 * s) * (1 - s) ** 2
+    h10 = s * (1 - s) ** 2
+    h01 = s ** 2 * (3 - 2 * s)
+    h11 = s ** 2 * (s - 1)
+
+    return h00 * values[k] + h10 * h * slopes[k] + h01 * values[k + 1] + h11 * h * slopes[k + 1]
+
+
+def compute_acceleration(time: np.ndarray, speed: np.ndarray) -> np.ndarray:
+
+    # Backward difference, first and last samples kept at zero
+    acceleration = differentiate(speed, time=time, scheme="backward")
+    acceleration[-1:] = 0.
+
+    return acceleration
 
 
-def computing_absolute_distance(df: pd.DataFrame, time_step: float) -> tuple:
+def computing_absolute_distance(df: "pd.DataFrame", time_step: float, scheme="rectangle") -> tuple:
 
     lead_speed = np.array(df[df.columns[1]])
-    lead_pose = lead_speed * time_step  # Distance from origin
 
-    lead_absolute_distance = np.zeros(lead_pose.shape)
-    for p, _ in enumerate(lead_pose[1:]):
-        lead_absolute_distance[p] = lead_pose[p] + lead_absolute_distance[p - 1]
+    # Distance from origin, integrated on the time stamps of the cycle when no time step is given
+    if time_step is None:
+        lead_absolute_distance = integrate(lead_speed, time=df[df.columns[0]].values, scheme=scheme)
+    else:
+        lead_absolute_distance = integrate(lead_speed, dt=time_step, scheme=scheme)
 
     return lead_absolute_distance, lead_speed
 
 
 def parameters_vehicle(vehicle_filename: str) -> tuple:
 
-    # Defining the vehicle studied
+    # Defining the vehicle studied (JSON5 file, validated)
     vehicle_filepath = os.path.join(DATASET_DIRECTORY, vehicle_filename)
-    with open(vehicle_filepath, 'r') as vehicle_file:
-        data = vehicle_file.read()
-        vehicle_parameters = json.loads(data)
+    vehicle_parameters = load_vehicle_file(vehicle_filepath)
 
     test_weight = vehicle_parameters["test_weight"]
     abc = [vehicle_parameters["a"], vehicle_parameters["b"], vehicle_parameters["c"]]
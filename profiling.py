@@ -0,0 +1,155 @@
+import numpy as np
+import contextlib
+import functools
+import json
+import os
+import time
+import tracemalloc
+
+# Instrumentation is off unless enabled, then stages cost a single flag check
+ENABLED = os.environ.get("DRIVE_CYCLE_PROFILE", "0") == "1"
+MEMORY = True
+
+# Stages currently open, innermost last
+_stack = []
+_records = {}
+_disabled_stage = contextlib.nullcontext()
+
+# Memory tracing started by enable(), the only tracing stopped by disable()
+_tracing = False
+
+
+def enable(memory=True):
+
+    global ENABLED, MEMORY, _tracing
+
+    ENABLED, MEMORY = True, memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _tracing = True
+
+
+def disable():
+
+    global ENABLED, _tracing
+
+    ENABLED = False
+    if _tracing and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _tracing = False
+
+
+if ENABLED:
+    enable()
+
+
+def reset():
+    _stack.clear()
+    _records.clear()
+
+
+class _Stage:
+
+    def __init__(self, name: str, n_samples):
+        self.name = name
+        self.n_samples = n_samples
+
+    def __enter__(self):
+
+        # Peak of the memory traced since the stage opened: the peak of the parent is saved before being reset
+        self.memory_start = self.memory_peak = 0
+        if tracemalloc.is_tracing():
+            self.memory_start, peak = tracemalloc.get_traced_memory()
+            if _stack:
+                _stack[-1].memory_peak = max(_stack[-1].memory_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_peak = self.memory_start
+
+        _stack.append(self)
+        self.children_wall_time = 0.
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = time.process_time() - self.cpu_start
+        if tracemalloc.is_tracing():
+            self.memory_peak = max(self.memory_peak, tracemalloc.get_traced_memory()[1])
+
+        # Aggregated by call stack: "main;ccc;get_power_wheel"
+        path = ";".join(opened.name for opened in _stack)
+        _stack.pop()
+
+        record = _records.setdefault(path, {"calls": 0, "wall_time": 0., "cpu_time": 0., "self_time": 0.,
+                                            "peak_bytes": 0, "n_samples": 0})
+        record["calls"] += 1
+        record["wall_time"] += wall_time
+        record["cpu_time"] += cpu_time
+        record["self_time"] += wall_time - self.children_wall_time
+        record["peak_bytes"] = max(record["peak_bytes"], self.memory_peak - self.memory_start)
+        record["n_samples"] += self.n_samples or 0
+
+        # Time of the children removed from the self time of the parent, their peak being part of its own
+        if _stack:
+            _stack[-1].children_wall_time += wall_time
+            _stack[-1].memory_peak = max(_stack[-1].memory_peak, self.memory_peak)
+
+        return False
+
+
+def stage(name: str, n_samples=None):
+
+    # with stage("preprocess", n_samples=len(df)): ...
+    if not ENABLED:
+        return _disabled_stage
+    return _Stage(name, n_samples)
+
+
+def profiled(name=None):
+
+    # Decorator recording every call of a function, the samples being the length of its first array argument
+    def decorator(function):
+
+        stage_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+
+            if not ENABLED:
+                return function(*args, **kwargs)
+
+            n_samples = next((len(arg) for arg in args if isinstance(arg, np.ndarray) and arg.ndim > 0), None)
+            with _Stage(stage_name, n_samples):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def report() -> dict:
+
+    stages = {}
+    for path, record in _records.items():
+        stages[path] = dict(record)
+        stages[path]["throughput"] = record["n_samples"] / record["wall_time"] \
+            if record["n_samples"] and record["wall_time"] > 0 else None
+
+    return {"memory": MEMORY, "stages": stages}
+
+
+def folded_stacks() -> str:
+
+    # Flame graph input (flamegraph.pl, speedscope): one line per stack with its self time in microseconds
+    return "\n".join(f"{path} {max(int(record['self_time'] * 1e6), 0)}" for path, record in _records.items())
+
+
+def save_report(filepath: str):
+
+    with open(f"{filepath}.json", "w") as report_file:
+        json.dump(report(), report_file, indent=2)
+
+    with open(f"{filepath}.folded", "w") as stacks_file:
+        stacks_file.write(folded_stacks() + "\n")
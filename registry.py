@@ -0,0 +1,217 @@
+import numpy as np
+import hashlib
+import json
+import os
+import re
+
+import cache
+from vehicles import Vehicle, AutonomousVehicle, batch_state_of_charge
+
+# Optional JSON5 parser, a converter of the usual JSON5 extensions to JSON otherwise
+try:
+    import json5
+except ImportError:
+    json5 = None
+
+# Parameters of a vehicle: (lower bound, upper bound, lower bound included), None when unbounded. Zero is only
+# allowed where it is physical: no standby losses, whereas the battery model divides by the resistance and the
+# efficiencies
+SCHEMA = {
+    "test_weight": (0, None, False),
+    "a": (None, None, False),
+    "b": (None, None, False),
+    "c": (None, None, False),
+    "nominal_voltage": (0, None, False),
+    "resistance": (0, None, False),
+    "capacity": (0, None, False),
+    "efficiency_transmission": (0, 1, False),
+    "efficiency_motor": (0, 1, False),
+    "standby_losses": (0, None, True),
+}
+FIELDS = list(SCHEMA.keys())
+
+_JSON5_TOKENS = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')
+  | (?P<trailing>,(?=\s*(?://[^\n]*\s*|/\*.*?\*/\s*)*[}\]]))
+  | (?P<hexadecimal>[+-]?0[xX][0-9a-fA-F]+)
+  | (?P<number>[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<identifier>[A-Za-z_$][\w$]*)
+""", re.VERBOSE | re.DOTALL)
+
+
+def _json5_to_json(text: str) -> str:
+
+    def convert(match) -> str:
+        kind, token = match.lastgroup, match.group()
+
+        if kind in ("comment", "trailing"):
+            return ""
+        if kind == "string" and token.startswith("'"):
+            return json.dumps(json.loads('"' + token[1:-1].replace('\\\'', "'").replace('"', '\\"') + '"'))
+        if kind == "hexadecimal":
+            return str(int(token, 16))
+        if kind == "number":
+            number = token.lstrip("+")
+            if number.startswith("."):
+                number = "0" + number
+            elif number.startswith("-."):
+                number = "-0" + number[1:]
+            return re.sub(r"\.(?=$|[eE])", ".0", number)
+        if kind == "identifier" and token not in ("true", "false", "null", "Infinity", "NaN"):
+            return json.dumps(token)
+        return token
+
+    return _JSON5_TOKENS.sub(convert, text)
+
+
+def load_json5(text: str):
+
+    if json5 is not None:
+        return json5.loads(text)
+    return json.loads(_json5_to_json(text))
+
+
+def out_of_bounds(name: str, values):
+
+    # Values of a parameter outside of its schema bounds, scalars or arrays
+    lower, upper, lower_included = SCHEMA[name]
+    values = np.asarray(values, dtype=float)
+
+    outside = np.zeros(values.shape, dtype=bool)
+    if lower is not None:
+        outside |= values < lower if lower_included else values <= lower
+    if upper is not None:
+        outside |= values > upper
+    return outside
+
+
+def _bounds(name: str) -> str:
+    lower, upper, lower_included = SCHEMA[name]
+    return f"{'[' if lower_included else '('}{lower}, {upper}]"
+
+
+def validate(parameters: dict, source="vehicle") -> dict:
+
+    errors = []
+    for name in SCHEMA:
+        value = parameters.get(name)
+
+        if value is None:
+            errors.append(f"missing {name}")
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            errors.append(f"{name} is not a number: {value!r}")
+        elif out_of_bounds(name, value):
+            errors.append(f"{name}={value} out of {_bounds(name)}")
+
+    if errors:
+        raise ValueError(f"Invalid parameters in {source}: {', '.join(errors)}")
+
+    return {name: float(parameters[name]) for name in FIELDS}
+
+
+def load_vehicle_file(filepath: str) -> dict:
+
+    with open(filepath, "r") as vehicle_file:
+        return validate(load_json5(vehicle_file.read()), source=filepath)
+
+
+class VehicleRegistry:
+
+    def __init__(self, names: list, columns: dict):
+
+        # Struct of arrays: one array of n_vehicles per parameter
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        for field in FIELDS:
+            setattr(self, field, np.asarray(columns[field], dtype=float))
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_directory(cls, directory: str, use_cache=True):
+
+        # Every *.json5 / *.json file of the directory, named after the file
+        filenames = sorted(f for f in os.listdir(directory) if f.endswith((".json5", ".json")))
+        filepaths = [os.path.join(directory, filename) for filename in filenames]
+
+        def parse():
+            specs = [load_vehicle_file(filepath) for filepath in filepaths]
+            return {field: [spec[field] for spec in specs] for field in FIELDS}
+
+        return cls._cached([os.path.splitext(f)[0] for f in filenames], filepaths, parse, use_cache)
+
+    @classmethod
+    def from_table(cls, filepath: str, use_cache=True):
+
+        # One vehicle per row of a CSV table: a name column and one column per parameter
+        import pandas as pd
+
+        table = pd.read_csv(filepath)
+        names = table["name"].astype(str).tolist()
+
+        def parse():
+            columns = {}
+            for field in SCHEMA:
+                if field not in table.columns:
+                    raise ValueError(f"Invalid parameters in {filepath}: missing {field}")
+                values = pd.to_numeric(table[field], errors="coerce").values.astype(float)
+                invalid = np.isnan(values) | out_of_bounds(field, values)
+                if invalid.any():
+                    rows = [names[i] for i in np.flatnonzero(invalid)[:5]]
+                    raise ValueError(f"Invalid parameters in {filepath}: {field} of {rows} out of {_bounds(field)}")
+                columns[field] = values
+            return columns
+
+        return cls._cached(names, [filepath], parse, use_cache)
+
+    @classmethod
+    def _cached(cls, names: list, filepaths: list, parse, use_cache: bool):
+
+        # Parsed columns cached under the hash of all the source files
+        digest = hashlib.sha256()
+        for filepath in filepaths:
+            digest.update(cache.file_hash(filepath).encode())
+        key = f"vehicles-{digest.hexdigest()[:32]}"
+
+        columns = cache.load_arrays(key, FIELDS) if use_cache else None
+        if columns is not None:
+            return cls(names, dict(zip(FIELDS, columns)))
+
+        columns = parse()
+        if use_cache:
+            cache.store_arrays(key, FIELDS, [np.asarray(columns[field], dtype=float) for field in FIELDS])
+
+        return cls(names, columns)
+
+    def parameters(self, name: str) -> tuple:
+
+        # Same tuple as preprocess.parameters_vehicle
+        i = self.index[name]
+        return (self.test_weight[i], [self.a[i], self.b[i], self.c[i]], self.nominal_voltage[i], self.resistance[i],
+                self.capacity[i], self.efficiency_transmission[i], self.efficiency_motor[i], self.standby_losses[i])
+
+    def vehicle(self, name: str, autonomous=False, dt=0.5) -> Vehicle:
+
+        vehicle_class = AutonomousVehicle if autonomous else Vehicle
+        return vehicle_class(*self.parameters(name), dt=dt)
+
+    def get_power_wheel(self, speed: np.ndarray, acceleration: np.ndarray) -> tuple:
+
+        # Road load of every vehicle on the same (n_steps,) or their own (n_vehicles, n_steps) speeds
+        speed, acceleration = np.atleast_2d(speed), np.atleast_2d(acceleration)
+
+        speed_mph = 2.23694 * speed
+        force_road_load = (self.a[:, None] + self.b[:, None] * speed_mph + self.c[:, None] * speed_mph ** 2) * 4.44822
+
+        modeled_mass = 1.03 * self.test_weight[:, None]
+        power_wheel = (modeled_mass * acceleration + force_road_load) * speed
+
+        return force_road_load, power_wheel
+
+    def get_state_of_charge(self, power_wheel: np.ndarray, soc_initial=0.5, dt=0.5) -> tuple:
+
+        return batch_state_of_charge(power_wheel, self.nominal_voltage, self.resistance, self.capacity,
+                                     self.efficiency_transmission, self.efficiency_motor, self.standby_losses,
+                                     soc_initial=soc_initial, dt=dt)
@@ -0,0 +1,331 @@
+import numpy as np
+import contextlib
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+import cache
+from preprocess import DATASET_DIRECTORY
+from vehicles import Vehicle
+
+# Layout of a run: magic, header length (uint64), JSON header, then the compressed chunks of every column
+MAGIC = b"ADCRESLT"
+VERSION = 2
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset", "results")
+INDEX_FILENAME = "index.jsonl"
+LOCK_FILENAME = "index.lock"
+CHUNK_SIZE = 4096    # samples
+DTYPE = "<f4"
+TIME_DTYPE = "<f8"    # float32 loses the sub-second steps of long cycles
+COMPRESSION_LEVEL = 6
+
+# Columns of every run (time stored in addition) and aggregates computed once when it is written, so that queries never read the series
+SERIES = ["distance", "speed", "acceleration", "gap", "power_battery", "state_of_charge"]
+GAP_PERCENTILES = (5, 50, 95)
+SUMMARY = ["mpge", "soc_drop", "energy", "min_gap", *[f"gap_p{p}" for p in GAP_PERCENTILES], "collision",
+           "jerk_rms"]
+
+
+def summarize(time: np.ndarray, columns: dict, dt=0.5) -> dict:
+
+    # Aggregates of a run from its full precision columns: MPGe as get_mpge, energy drawn in kWh
+    gap = np.asarray(columns["gap"], dtype=float)
+    state_of_charge = np.asarray(columns["state_of_charge"], dtype=float)
+    power_battery = np.asarray(columns["power_battery"], dtype=float)
+    jerk = np.diff(np.asarray(columns["acceleration"], dtype=float)) / dt
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        summary = {
+            "mpge": float(Vehicle.get_mpge(time, columns["distance"], power_battery)),
+            "soc_drop": float(state_of_charge[0] - state_of_charge[-1]),
+            "energy": float(np.nansum(power_battery) * dt / 3.6e6),
+            "min_gap": float(np.nanmin(gap)),
+            **{f"gap_p{p}": float(value) for p, value in zip(GAP_PERCENTILES,
+                                                             np.nanpercentile(gap, GAP_PERCENTILES))},
+            "collision": bool(np.any(gap < 0)),
+            "jerk_rms": float(np.sqrt(np.nanmean(jerk ** 2))),
+        }
+
+    return summary
+
+
+def _compress(values: np.ndarray) -> bytes:
+
+    # Bytes of the float32 samples grouped by significance (shuffle) before deflate: the exponent bytes of
+    # neighbouring samples are alike and compress far better together
+    shuffled = np.ascontiguousarray(np.frombuffer(values.tobytes(), dtype=np.uint8).reshape(-1, values.itemsize).T)
+    return zlib.compress(shuffled.tobytes(), COMPRESSION_LEVEL)
+
+
+def _decompress(data: bytes, dtype: np.dtype) -> np.ndarray:
+
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(shuffled.T).view(dtype).ravel()
+
+
+def _matches(record: dict, filters: dict) -> bool:
+
+    # Filters on the metadata or the parameters of a run: a value, or a list of accepted values
+    for name, accepted in filters.items():
+        value = record[name] if name in record else record["parameters"].get(name)
+        if isinstance(accepted, (list, tuple, set)):
+            if value not in accepted:
+                return False
+        elif value != accepted:
+            return False
+
+    return True
+
+
+class ResultsStore:
+
+    def __init__(self, directory=RESULTS_DIRECTORY, chunk_size=CHUNK_SIZE, dtype=DTYPE):
+
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+
+        # Index read again only when the file changed, content hash of a source again only when its stat changed
+        self._index = None
+        self._index_stat = None
+        self._sources = {}
+
+    @property
+    def index_filepath(self) -> str:
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    def filepath(self, run_id: str) -> str:
+        return os.path.join(self.directory, f"{run_id}.run")
+
+    def source_hash(self, filename):
+
+        # Content of a cycle or vehicle file of the dataset, None when the run does not come from one
+        if filename is None:
+            return None
+        filepath = os.path.join(DATASET_DIRECTORY, filename)
+        if not os.path.isfile(filepath):
+            return None
+
+        stat = os.stat(filepath)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self._sources.get(filepath, (None, None))[0] != signature:
+            self._sources[filepath] = (signature, cache.file_hash(filepath))
+        return self._sources[filepath][1]
+
+    @contextlib.contextmanager
+    def _locked(self):
+
+        # Exclusive lock on the index between the processes writing in the store
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILENAME), "a+b") as lock_file:
+            if os.name == "nt":
+                import msvcrt
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if os.name == "nt":
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_index(self, records):
+
+        # Whole index written in a temporary file renamed at the end
+        temporary_filepath = f"{self.index_filepath}.{os.getpid()}.tmp"
+        with open(temporary_filepath, "w") as index_file:
+            index_file.writelines(json.dumps(record, default=float) + "\n" for record in records)
+        os.replace(temporary_filepath, self.index_filepath)
+        self._index = None
+
+    @staticmethod
+    def run_id(metadata: dict) -> str:
+
+        # Same cycle and vehicle files (names and contents), controller and parameters: same run, overwritten when
+        # written again
+        description = json.dumps({"version": VERSION, **metadata}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+    def write(self, columns: dict, time: np.ndarray, cycle: str, vehicle: str, controller: str, parameters=None,
+              dt=0.5, **metadata) -> str:
+
+        missing = set(SERIES) - set(columns)
+        if missing:
+            raise ValueError(f"Missing columns {sorted(missing)}")
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) != 1:
+            raise ValueError(f"Columns of different lengths {lengths}")
+        n_samples = lengths.pop()
+
+        if len(time) != n_samples:
+            raise ValueError(f"Time of {len(time)} samples for columns of {n_samples}")
+
+        metadata = {"cycle": cycle, "vehicle": vehicle, "controller": controller,
+                    "parameters": dict(parameters or {}),
+                    "sources": {"cycle": self.source_hash(cycle), "vehicle": self.source_hash(vehicle)}, **metadata}
+        run_id = self.run_id(metadata)
+        record = {"run_id": run_id, **metadata, "dt": dt, "n_samples": n_samples,
+                  **summarize(time, columns, dt=dt)}
+
+        # Chunks of every column, offsets from the end of the header
+        columns = {"time": time, **{name: values for name, values in columns.items() if name != "time"}}
+        names = list(columns)
+        dtypes = {name: np.dtype(TIME_DTYPE if name == "time" else self.dtype) for name in names}
+        blocks, chunks, offset = [], {}, 0
+        for name in names:
+            values = np.asarray(columns[name], dtype=dtypes[name])
+            chunks[name] = []
+            for start in range(0, n_samples, self.chunk_size):
+                block = _compress(values[start:start + self.chunk_size])
+                chunks[name].append([offset, len(block)])
+                blocks.append(block)
+                offset += len(block)
+
+        header = {"version": VERSION, "dtype": self.dtype.str, "chunk_size": self.chunk_size, "columns": names,
+                  "dtypes": {name: dtype.str for name, dtype in dtypes.items()}, "chunks": chunks, "record": record}
+        encoded = json.dumps(header, default=float).encode()
+
+        # Written in a temporary file renamed at the end, so readers never see a partial run
+        os.makedirs(self.directory, exist_ok=True)
+        filepath = self.filepath(run_id)
+        temporary_filepath = f"{filepath}.{os.getpid()}.tmp"
+        with open(temporary_filepath, "wb") as run_file:
+            run_file.write(MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+            for block in blocks:
+                run_file.write(block)
+        os.replace(temporary_filepath, filepath)
+
+        # One line per run: appended for a new run, replaced for a run written again
+        with self._locked():
+            records = self.index()
+            if run_id in records:
+                self._write_index([*(other for other in records.values() if other["run_id"] != run_id), record])
+            else:
+                with open(self.index_filepath, "a") as index_file:
+                    index_file.write(json.dumps(record, default=float) + "\n")
+
+        return run_id
+
+    def _header(self, run_file) -> dict:
+
+        if run_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{run_file.name} is not a results run")
+        header_length, = struct.unpack("<Q", run_file.read(8))
+        header = json.loads(run_file.read(header_length))
+        header["data_offset"] = len(MAGIC) + 8 + header_length
+
+        return header
+
+    def index(self) -> dict:
+
+        # Last record of every run, by run id
+        try:
+            stat = os.stat(self.index_filepath)
+        except FileNotFoundError:
+            return {}
+
+        if self._index is None or self._index_stat != (stat.st_size, stat.st_mtime_ns):
+            self._index = {}
+            with open(self.index_filepath, "r") as index_file:
+                for line in index_file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._index[record["run_id"]] = record
+            self._index_stat = (stat.st_size, stat.st_mtime_ns)
+
+        return self._index
+
+    def reindex(self):
+
+        # Index rebuilt from the headers of the runs, after a crash between a run and its index line
+        with self._locked():
+            records = []
+            for filename in sorted(os.listdir(self.directory)):
+                if filename.endswith(".run"):
+                    with open(os.path.join(self.directory, filename), "rb") as run_file:
+                        records.append(self._header(run_file)["record"])
+
+            self._write_index(records)
+
+    def runs(self, **filters) -> list:
+
+        # Records of the runs matching the filters: runs(controller="acc", kp=[0.1, 0.2])
+        return [record for record in self.index().values() if _matches(record, filters)]
+
+    def table(self, **filters) -> "pd.DataFrame":
+
+        # One row per run, parameters as columns
+        import pandas as pd
+
+        rows = [{**{name: value for name, value in record.items() if name != "parameters"}, **record["parameters"]}
+                for record in self.runs(**filters)]
+        return pd.DataFrame(rows)
+
+    def aggregate(self, metrics=None, by=("controller",), percentiles=(5, 50, 95), **filters) -> dict:
+
+        # Statistics of the summaries of the matching runs by group: {(controller,): {"mpge": {...}}}
+        metrics = metrics or SUMMARY
+        groups = {}
+        for record in self.runs(**filters):
+            key = tuple(record[name] if name in record else record["parameters"].get(name) for name in by)
+            groups.setdefault(key, []).append(record)
+
+        aggregates = {}
+        for key, records in groups.items():
+            aggregates[key] = {"count": len(records)}
+            for metric in metrics:
+                values = np.array([record[metric] for record in records], dtype=float)
+                aggregates[key][metric] = {
+                    "mean": float(np.nanmean(values)),
+                    "std": float(np.nanstd(values)),
+                    "min": float(np.nanmin(values)),
+                    "max": float(np.nanmax(values)),
+                    "percentiles": dict(zip(percentiles, np.nanpercentile(values, percentiles).tolist())),
+                }
+
+        return aggregates
+
+    def load(self, run_id: str, columns=None, start=0, stop=None) -> dict:
+
+        # Samples [start, stop) of the columns of a run, decompressing only the chunks they cover
+        with open(self.filepath(run_id), "rb") as run_file:
+            header = self._header(run_file)
+            chunk_size = header["chunk_size"]
+            n_samples = header["record"]["n_samples"]
+            stop = n_samples if stop is None else min(stop, n_samples)
+
+            first, last = start // chunk_size, -(-stop // chunk_size)
+            series = {}
+            for name in columns or header["columns"]:
+                dtype = np.dtype(header.get("dtypes", {}).get(name, header["dtype"]))
+                blocks = []
+                for offset, length in header["chunks"][name][first:last]:
+                    run_file.seek(header["data_offset"] + offset)
+                    blocks.append(_decompress(run_file.read(length), dtype))
+                values = np.concatenate(blocks) if blocks else np.zeros(0, dtype=dtype)
+                series[name] = values[start - first * chunk_size:stop - first * chunk_size]
+
+        return series
+
+    def scan(self, column: str, **filters):
+
+        # Generator of (record, column) over the matching runs, one series in memory at a time, for aggregates
+        # that were not computed when writing
+        for record in self.runs(**filters):
+            yield record, self.load(record["run_id"], [column])[column]
+
+    def remove(self, **filters):
+
+        removed = {record["run_id"] for record in self.runs(**filters)}
+        for run_id in removed:
+            if os.path.exists(self.filepath(run_id)):
+                os.remove(self.filepath(run_id))
+        if removed:
+            self.reindex()
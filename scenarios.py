@@ -0,0 +1,219 @@
+import numpy as np
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from preprocess import preprocess_dataframe, load_drive_cycle, computing_absolute_distance, parameters_vehicle
+from results import ResultsStore
+from sweep import parameter_grid, run_simulation
+from vehicles import Vehicle, AutonomousVehicle
+
+DEFAULT_FILTERING = "1hz"
+DT = 0.5    # s, time step of the vehicles
+OUTPUT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Outputs of a task passed to the tasks depending on it, not written in the results
+SHARED = ("lead_distance", "vehicle_parameters")
+
+
+def _preprocess_task(cycle: str, filtering: str) -> dict:
+
+    # Warms the cache of the cycle, the following tasks loading it memory mapped, and integrates the lead distance
+    # once for all of them
+    time_cycle, _, _ = load_drive_cycle(cycle, filtering)
+    lead_distance, _ = computing_absolute_distance(preprocess_dataframe(cycle, filtering), DT)
+    return {"n_samples": len(time_cycle), "lead_distance": lead_distance}
+
+
+def _vehicle_task(vehicle_filename: str) -> dict:
+
+    # Vehicle file read and validated once for all the tasks of the vehicle
+    return {"vehicle_parameters": parameters_vehicle(vehicle_filename)}
+
+
+def _baseline_task(cycle: str, filtering: str, vehicle_filename: str, lead_distance: np.ndarray,
+                   vehicle_parameters: tuple, store=None) -> dict:
+
+    # Standard vehicle driving the cycle itself
+    df = preprocess_dataframe(cycle, filtering)
+    vehicle = Vehicle(*vehicle_parameters, dt=DT)
+
+    speed, acceleration = df[df.columns[1]].values, df[df.columns[2]].values
+    _, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+    power_battery, state_of_charge = vehicle.get_state_of_charge(power_wheel)
+
+    result = {"mpge": vehicle.get_mpge(df[df.columns[0]].values, lead_distance, power_battery),
+              "soc_drop": state_of_charge[0] - state_of_charge[-1]}
+
+    if store is not None:
+        columns = {"distance": lead_distance, "speed": speed, "acceleration": acceleration,
+                   "gap": np.zeros(len(speed)), "power_battery": power_battery, "state_of_charge": state_of_charge}
+        result["run_id"] = store.write(columns, df[df.columns[0]].values, cycle, vehicle_filename, "baseline",
+                                       dt=vehicle.dt, filtering=filtering)
+
+    return result
+
+
+def _simulation_task(cycle: str, filtering: str, vehicle_filename: str, controller: str, parameters: dict,
+                     lead_distance: np.ndarray, vehicle_parameters: tuple, store=None) -> dict:
+
+    df = preprocess_dataframe(cycle, filtering)
+    vehicle = AutonomousVehicle(*vehicle_parameters, dt=DT)
+
+    return run_simulation(vehicle, controller, parameters, df, lead_distance, store=store,
+                          metadata={"cycle": cycle, "vehicle": vehicle_filename, "filtering": filtering})
+
+
+TASKS = {"preprocess": _preprocess_task, "vehicle": _vehicle_task, "baseline": _baseline_task,
+         "simulation": _simulation_task}
+
+
+def _cycles(spec: dict) -> list:
+
+    # "HWY.txt" or {"filename": "HWY.txt", "filtering": "1hz"}
+    cycles = []
+    for cycle in spec["cycles"]:
+        if isinstance(cycle, str):
+            cycle = {"filename": cycle}
+        cycles.append((cycle["filename"], cycle.get("filtering", DEFAULT_FILTERING)))
+
+    return cycles
+
+
+def expand(spec: dict) -> dict:
+
+    # Tasks of the scenario by key: {"kind", "args", "dependencies"}, shared tasks appearing only once
+    tasks = {}
+
+    def add(kind: str, args: tuple, dependencies=()) -> str:
+        key = json.dumps([kind, *args], sort_keys=True)
+        tasks.setdefault(key, {"kind": kind, "args": args, "dependencies": list(dependencies)})
+        return key
+
+    for cycle, filtering in _cycles(spec):
+        preprocess_key = add("preprocess", (cycle, filtering))
+
+        for vehicle_filename in spec["vehicles"]:
+            vehicle_key = add("vehicle", (vehicle_filename,))
+
+            if spec.get("baseline", True):
+                add("baseline", (cycle, filtering, vehicle_filename), [preprocess_key, vehicle_key])
+
+            for controller in spec["controllers"]:
+                for parameters in parameter_grid(**controller.get("parameters", {})):
+                    add("simulation", (cycle, filtering, vehicle_filename, controller["type"], parameters),
+                        [preprocess_key, vehicle_key])
+
+    return tasks
+
+
+def _row(task: dict, result: dict) -> dict:
+
+    args = task["args"]
+    if task["kind"] == "vehicle":
+        return {"kind": "vehicle", "vehicle": args[0], **result}
+
+    row = {"kind": task["kind"], "cycle": args[0], "filtering": args[1]}
+    if len(args) > 2:
+        row["vehicle"] = args[2]
+    if task["kind"] == "simulation":
+        row["controller"], row["parameters"] = args[3], args[4]
+
+    return {**row, **result}
+
+
+def run_scenario(spec: dict, n_workers=None) -> list:
+
+    tasks = expand(spec)
+    remaining = {key: set(task["dependencies"]) for key, task in tasks.items()}
+    shared, failed = {}, set()
+    rows = []
+
+    output_directory = spec.get("output", os.path.join(OUTPUT_DIRECTORY, time.strftime("%Y%m%dT%H%M%S")))
+    os.makedirs(output_directory, exist_ok=True)
+    results_filepath = os.path.join(output_directory, "results.jsonl")
+
+    # Series of the baseline and simulation tasks kept in a results store when the scenario names one
+    store = ResultsStore(spec["store"]) if spec.get("store") else None
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor, open(results_filepath, "w") as results_file:
+        running = {}
+
+        def finish(key: str, result: dict):
+
+            # Row of the task, its dependents being submitted once all their dependencies are finished
+            if "error" in result:
+                failed.add(key)
+            else:
+                shared[key] = {name: result.pop(name) for name in SHARED if name in result}
+
+            row = _row(tasks[key], result)
+            rows.append(row)
+            results_file.write(json.dumps(row, default=float) + "\n")
+
+            for dependencies in remaining.values():
+                dependencies.discard(key)
+
+        while remaining or running:
+
+            # Submitting every task whose dependencies are done, failing those of a failed dependency
+            for key in [key for key, dependencies in remaining.items() if not dependencies]:
+                task = tasks[key]
+                del remaining[key]
+
+                failed_dependencies = [tasks[dependency]["kind"] for dependency in task["dependencies"]
+                                       if dependency in failed]
+                if failed_dependencies:
+                    finish(key, {"error": f"Failed dependencies {failed_dependencies}"})
+                    continue
+
+                kwargs = {"store": store} if store is not None and task["kind"] in ("baseline", "simulation") \
+                    else {}
+                for dependency in task["dependencies"]:
+                    kwargs.update(shared[dependency])
+                running[executor.submit(TASKS[task["kind"]], *task["args"], **kwargs)] = key
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+
+                # A failing task only fails the tasks depending on it, the rest of the scenario goes on
+                try:
+                    result = future.result()
+                except Exception as error:
+                    result = {"error": f"{type(error).__name__}: {error}"}
+                finish(key, result)
+
+    return rows
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Runs the cycles x vehicles x controllers of a scenario file")
+    parser.add_argument("scenario", help="JSON scenario file")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--store", default=None, help="results store directory of the series")
+    args = parser.parse_args()
+
+    with open(args.scenario, "r") as scenario_file:
+        spec = json.load(scenario_file)
+    if args.output is not None:
+        spec["output"] = args.output
+    if args.store is not None:
+        spec["store"] = args.store
+
+    start = time.perf_counter()
+    rows = run_scenario(spec, n_workers=args.workers)
+    errors = [row for row in rows if "error" in row]
+    print(f"{len(rows)} tasks in {time.perf_counter() - start:.2f} s, {len(errors)} failed")
+    for row in errors:
+        print(f"  {row['kind']} {row.get('cycle', '')} {row.get('vehicle', '')}: {row['error']}")
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+import cache
+from pipeline import AUTONOMOUS_FIELDS
+from preprocess import DATASET_DIRECTORY, preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from sweep import CONTROLLERS, run_simulation
+from vehicles import AutonomousVehicle
+
+DT = 0.5
+CACHE_SIZE = 512    # results
+LATENCY_WINDOW = 10000    # requests
+DEFAULT_REQUEST = {"filtering": "1hz", "vehicle": "spark.json5", "parameters": {}}
+DEFAULT_PARAMETERS = {"kp": 0.1, "kd": 1., "headway": False, "horizon": 20}
+
+# Type of every parameter of a request, so that 20 and 20.0 are the same request and the horizon stays an integer
+PARAMETER_TYPES = {"kp": float, "kd": float, "headway": bool, "horizon": int,
+                   **{name: float for name in AUTONOMOUS_FIELDS}}
+COUNTS = {"hit": "hits", "miss": "misses", "coalesced": "coalesced"}
+
+# Preprocessed cycles (dataframe, lead distance) and vehicle parameters kept by every worker process, by content
+# hash of their file as in the keys of the results: an edited file is loaded again
+_hot = {"cycles": {}, "vehicles": {}}
+
+
+def _cycle(cycle: str, filtering: str, source: str) -> tuple:
+
+    if (cycle, filtering, source) not in _hot["cycles"]:
+        df = preprocess_dataframe(cycle, filtering)
+        lead_distance, _ = computing_absolute_distance(df, DT)
+        _hot["cycles"][(cycle, filtering, source)] = (df, lead_distance)
+
+    return _hot["cycles"][(cycle, filtering, source)]
+
+
+def _vehicle_parameters(vehicle: str, source: str) -> tuple:
+
+    if (vehicle, source) not in _hot["vehicles"]:
+        _hot["vehicles"][(vehicle, source)] = parameters_vehicle(vehicle)
+
+    return _hot["vehicles"][(vehicle, source)]
+
+
+def _init_worker(cycles: list, vehicles: list):
+
+    # Cycles and vehicles expected to be asked, loaded before the first request
+    for cycle, filtering in cycles:
+        _cycle(cycle, filtering, cache.file_hash(os.path.join(DATASET_DIRECTORY, cycle)))
+    for vehicle in vehicles:
+        _vehicle_parameters(vehicle, cache.file_hash(os.path.join(DATASET_DIRECTORY, vehicle)))
+
+
+def _finite(values) -> list:
+
+    # NaN and infinities as null, JSON having no literal for them
+    return [value if math.isfinite(value) else None for value in np.asarray(values, dtype=float).tolist()]
+
+
+def _simulate(request: dict, sources: dict) -> tuple:
+
+    # Full result (metrics and series) and metrics only, encoded in the worker rather than in the server threads
+    df, lead_distance = _cycle(request["cycle"], request["filtering"], sources["cycle"])
+    vehicle = AutonomousVehicle(*_vehicle_parameters(request["vehicle"], sources["vehicle"]), dt=DT)
+    result = run_simulation(vehicle, request["controller"], request["parameters"], df, lead_distance, series=True)
+
+    series = {name: _finite(values) for name, values in result.pop("series").items()}
+    metrics = dict(zip(result, _finite(list(result.values()))))
+
+    return (json.dumps({"request": request, "metrics": metrics, "series": series}, allow_nan=False).encode(),
+            json.dumps({"request": request, "metrics": metrics}, allow_nan=False).encode())
+
+
+def _percentiles(latencies) -> dict:
+
+    if not latencies:
+        return {"count": 0}
+    values = 1e3 * np.asarray(latencies)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(values), "p50": p50, "p95": p95, "p99": p99, "max": float(values.max())}
+
+
+class SimulationService:
+
+    def __init__(self, n_workers=None, cache_size=CACHE_SIZE, cycles=(), vehicles=(), latency_window=LATENCY_WINDOW):
+
+        # Misses solved by the worker pool, full results kept in a bounded LRU keyed by the canonical request
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                            initargs=([tuple(cycle) for cycle in cycles], list(vehicles)))
+        self.cache_size = cache_size
+        self.results = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+        self.counts = {"requests": 0, "hits": 0, "misses": 0, "coalesced": 0, "errors": 0, "evictions": 0}
+        self.latencies = {status: deque(maxlen=latency_window) for status in ("hit", "miss", "coalesced")}
+
+        # Hashes of the cycle and vehicle files, computed again only when a file changes
+        self._sources = {}
+
+    def _source(self, filename: str) -> str:
+
+        filepath = os.path.join(DATASET_DIRECTORY, filename)
+        stat = os.stat(filepath)
+        signature = (stat.st_size, stat.st_mtime_ns)
+
+        if self._sources.get(filepath, (None, None))[0] != signature:
+            self._sources[filepath] = (signature, cache.file_hash(filepath))
+        return self._sources[filepath][1]
+
+    @staticmethod
+    def canonical(request: dict) -> dict:
+
+        # Same simulation, same request: defaults filled and parameters converted to their type
+        if not isinstance(request, dict):
+            raise ValueError("Request must be a JSON object")
+        unknown = set(request) - {"cycle", "controller", *DEFAULT_REQUEST}
+        if unknown:
+            raise ValueError(f"Unknown request fields {sorted(unknown)}")
+        if "cycle" not in request:
+            raise ValueError("Missing cycle")
+        if request.get("controller") not in CONTROLLERS:
+            raise ValueError(f"Unknown controller {request.get('controller')}")
+
+        request = {**DEFAULT_REQUEST, **request}
+
+        # Files of the dataset directory only
+        for field in ("cycle", "vehicle"):
+            filename = request[field]
+            if not isinstance(filename, str) or not filename or filename != os.path.basename(filename) or \
+                    "/" in filename or "\\" in filename or filename in (".", ".."):
+                raise ValueError(f"Invalid {field} {filename!r}")
+
+        if not isinstance(request["parameters"], dict):
+            raise ValueError("Parameters must be a JSON object")
+        parameters = {**DEFAULT_PARAMETERS, **request["parameters"]}
+        unknown = set(parameters) - set(PARAMETER_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown parameters {sorted(unknown)}")
+
+        canonical = {}
+        for name, value in sorted(parameters.items()):
+            kind = PARAMETER_TYPES[name]
+            if kind is bool:
+                if not isinstance(value, bool):
+                    raise ValueError(f"Parameter {name} must be a boolean")
+            elif isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                    (kind is int and not float(value).is_integer()):
+                raise ValueError(f"Parameter {name} must be {'an integer' if kind is int else 'a number'}")
+            canonical[name] = kind(value)
+
+        return {**request, "parameters": canonical}
+
+    def sources(self, request: dict) -> dict:
+        return {"cycle": self._source(request["cycle"]), "vehicle": self._source(request["vehicle"])}
+
+    @staticmethod
+    def key(request: dict, sources: dict) -> str:
+
+        # Canonical request and content of the files it reads
+        description = json.dumps({"version": cache.CACHE_VERSION, "request": request, **sources}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+    def _done(self, key: str, future):
+
+        # Stored before leaving the in-flight requests, so that a request always finds one or the other
+        with self.lock:
+            if future.exception() is None:
+                self.results[key] = future.result()
+                while len(self.results) > self.cache_size:
+                    self.results.popitem(last=False)
+                    self.counts["evictions"] += 1
+            del self.in_flight[key]
+
+    def simulate(self, request: dict, series=True) -> tuple:
+
+        # Encoded result and how it was served: hit, miss, or coalesced with the same request in flight
+        start = time.perf_counter()
+        request = self.canonical(request)
+        sources = self.sources(request)
+        key = self.key(request, sources)
+
+        with self.lock:
+            self.counts["requests"] += 1
+            entry = self.results.get(key)
+
+            if entry is not None:
+                self.results.move_to_end(key)
+                status = "hit"
+            elif key in self.in_flight:
+                future = self.in_flight[key]
+                status = "coalesced"
+            else:
+                future = self.executor.submit(_simulate, request, sources)
+                self.in_flight[key] = future
+                status = "miss"
+            self.counts[COUNTS[status]] += 1
+
+        if entry is None:
+            if status == "miss":
+                future.add_done_callback(lambda done: self._done(key, done))
+            try:
+                entry = future.result()
+            except Exception:
+                with self.lock:
+                    self.counts["errors"] += 1
+                raise
+
+        self.latencies[status].append(time.perf_counter() - start)
+        return entry[0] if series else entry[1], status
+
+    def metrics(self) -> dict:
+
+        with self.lock:
+            counts = dict(self.counts)
+            entries, in_flight = len(self.results), len(self.in_flight)
+            latencies = {status: list(values) for status, values in self.latencies.items()}
+
+        return {
+            **counts,
+            "hit_rate": (counts["hits"] + counts["coalesced"]) / counts["requests"] if counts["requests"] else 0.,
+            "entries": entries,
+            "cache_size": self.cache_size,
+            "in_flight": in_flight,
+            "latency_ms": {status: _percentiles(values) for status, values in latencies.items()},
+        }
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # POST /simulate {"cycle", "controller", "filtering", "vehicle", "parameters", "series"}, GET /metrics
+    def _send(self, status: int, body: bytes, cache_status=None):
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if cache_status is not None:
+            self.send_header("X-Cache", cache_status)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        if self.path == "/metrics":
+            self._send(200, json.dumps(self.server.service.metrics()).encode())
+        elif self.path == "/health":
+            self._send(200, b'{"status": "ok"}')
+        else:
+            self._send(404, json.dumps({"error": f"Unknown path {self.path}"}).encode())
+
+    def do_POST(self):
+
+        if self.path != "/simulate":
+            self._send(404, json.dumps({"error": f"Unknown path {self.path}"}).encode())
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            series = request.pop("series", True)
+            if not isinstance(series, bool):
+                raise ValueError("Field series must be a boolean")
+            body, cache_status = self.server.service.simulate(request, series=series)
+        except (ValueError, KeyError, FileNotFoundError) as error:
+            self._send(400, json.dumps({"error": str(error)}).encode())
+        except Exception as error:
+            self._send(500, json.dumps({"error": repr(error)}).encode())
+        else:
+            self._send(200, body, cache_status)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(service: SimulationService, host="127.0.0.1", port=8765) -> ThreadingHTTPServer:
+
+    # Local server, one thread per connection; serve_forever() or a thread of it is up to the caller
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+class SimulationClient:
+
+    def __init__(self, url="http://127.0.0.1:8765", timeout=600.):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def simulate(self, cycle: str, controller: str, series=True, **request) -> dict:
+
+        body = json.dumps({"cycle": cycle, "controller": controller, "series": series, **request}).encode()
+        http_request = Request(f"{self.url}/simulate", data=body, headers={"Content-Type": "application/json"})
+        with urlopen(http_request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def metrics(self) -> dict:
+        with urlopen(f"{self.url}/metrics", timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Local simulation service memoizing the results of the requests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    parser.add_argument("--cycles", nargs="*", default=["HWY.txt"], help="cycles loaded in the workers at start")
+    parser.add_argument("--filtering", default=DEFAULT_REQUEST["filtering"])
+    parser.add_argument("--vehicles", nargs="*", default=[DEFAULT_REQUEST["vehicle"]])
+    args = parser.parse_args()
+
+    service = SimulationService(n_workers=args.workers, cache_size=args.cache_size,
+                                cycles=[(cycle, args.filtering) for cycle in args.cycles], vehicles=args.vehicles)
+    server = serve(service, args.host, args.port)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+import numpy as np
+import math
+import os
+import time
+
+import kernels
+from preprocess import DATASET_DIRECTORY, filtering_time_step, preprocess_chunks
+from mpc import ModelPredictiveController
+from vehicles import AutonomousVehicle
+
+
+class StreamingController:
+
+    def __init__(self, vehicle: AutonomousVehicle, controller="acc", headway=False, kp=0.1, kd=1, horizon=20,
+                 weights=None):
+
+        if controller not in ("ccc", "acc", "mpc"):
+            raise ValueError(f"Unknown controller {controller}")
+
+        self.vehicle = vehicle
+        self.controller = controller
+        self.headway = headway
+        self.kp, self.kd = kp, kd
+
+        # Model predictive controller, warm started from one sample to the next
+        self.mpc = None
+        if controller == "mpc":
+            self.mpc = ModelPredictiveController(vehicle, horizon=horizon, headway=headway, weights=weights)
+
+        self.reset()
+
+    def reset(self):
+
+        # Lead vehicle
+        self.n_samples = 0
+        self.lead_distance = 0.
+        self.lead_speed = 0.
+
+        # Following vehicle
+        self.gap = 1.   # gap initial in meter
+        self.follow_distance = 0.
+        self.follow_speed = 0.
+        self.e_prev = 1
+
+        # Battery
+        self.state_of_charge = self.vehicle.soc_initial
+        self.capacity_supplied = 0.
+        self.power_wheel = 0.
+        self.n_battery_samples = 0
+
+        # CCC sample waiting for the next speed to know its acceleration
+        self.pending = None
+
+        if self.mpc is not None:
+            self.mpc.reset()
+
+    def step(self, lead_distance: float):
+
+        # Consumes one position of the lead vehicle, returns the completed sample (speed, acceleration, gap, soc)
+        # or None when it needs the next position (CCC acceleration is known one sample later)
+        dt = self.vehicle.dt
+        lead_distance = float(lead_distance)
+
+        if self.n_samples == 0:
+            self.follow_distance = lead_distance - self.gap
+            sample = self._first_sample()
+        elif self.controller in ("acc", "mpc"):
+            sample = self._step_acc(lead_distance)
+        else:
+            sample = self._step_ccc()
+
+        # Lead speed by finite differences as in compute_speed_acceleration
+        if self.n_samples > 0:
+            self.lead_speed = (lead_distance - self.lead_distance) / dt
+        self.lead_distance = lead_distance
+        self.n_samples += 1
+
+        if sample is None:
+            return None
+        return self._with_state_of_charge(*sample)
+
+    def process(self, lead_distances: np.ndarray) -> tuple:
+
+        # Consumes a chunk of lead positions, returns the completed speeds, accelerations, gaps and soc: same samples
+        # as step, the ACC and CCC chunks being run by the array kernels from the carried state
+        lead_distances = np.asarray(lead_distances, dtype=float)
+        if len(lead_distances) == 0:
+            return tuple(np.zeros(0) for _ in range(4))
+
+        if self.mpc is not None:
+            return self._process_samples(lead_distances)
+
+        speed, acceleration, gap = self._process_acc(lead_distances) if self.controller == "acc" \
+            else self._process_ccc(lead_distances)
+
+        return speed, acceleration, gap, self._states_of_charge(speed, acceleration)
+
+    def _process_samples(self, lead_distances: np.ndarray) -> tuple:
+
+        # One sample at a time (MPC), written in arrays of the chunk size
+        columns = np.zeros((4, len(lead_distances)))
+        n_completed = 0
+        for lead_distance in lead_distances:
+            sample = self.step(lead_distance)
+            if sample is not None:
+                columns[:, n_completed] = sample
+                n_completed += 1
+
+        return tuple(columns[:, :n_completed])
+
+    def _chunk(self, lead_distances: np.ndarray) -> tuple:
+
+        # Lead positions and speeds of the chunk after the last consumed sample, which comes first
+        lead = np.concatenate([[self.lead_distance], lead_distances])
+        lead_speed = np.empty(len(lead))
+        lead_speed[0] = self.lead_speed
+        lead_speed[1:] = np.diff(lead) / self.vehicle.dt
+
+        self.lead_distance, self.lead_speed = lead[-1], lead_speed[-1]
+        self.n_samples += len(lead_distances)
+
+        return lead, lead_speed
+
+    def _process_acc(self, lead_distances: np.ndarray) -> tuple:
+
+        vehicle = self.vehicle
+        first = None
+        if self.n_samples == 0:
+            self.follow_distance = lead_distances[0] - self.gap
+            first = (self.follow_speed, 0., self.gap)
+            self.lead_distance = lead_distances[0]
+            self.n_samples = 1
+            lead_distances = lead_distances[1:]
+
+        # Arrays of the kernel starting from the state of the last consumed sample
+        lead, lead_speed = self._chunk(lead_distances)
+        follow_distance, follow_speed, follow_acceleration, gap = np.zeros((4, len(lead)))
+        follow_distance[0], follow_speed[0], gap[0] = self.follow_distance, self.follow_speed, self.gap
+
+        kernels.adaptive_cruise_control_kernel(lead, lead_speed, follow_distance, follow_speed, follow_acceleration,
+                                               gap, self.headway, vehicle.gap_target, vehicle.gap_min,
+                                               vehicle.headway_target, vehicle.headway_min, vehicle.acceleration_min,
+                                               vehicle.acceleration_max, vehicle.dt)
+
+        self.follow_distance, self.follow_speed, self.gap = follow_distance[-1], follow_speed[-1], gap[-1]
+
+        columns = (follow_speed[1:], follow_acceleration[1:], gap[1:])
+        if first is not None:
+            columns = tuple(np.concatenate([[value], column]) for value, column in zip(first, columns))
+
+        return columns
+
+    def _process_ccc(self, lead_distances: np.ndarray) -> tuple:
+
+        vehicle = self.vehicle
+        if self.n_samples == 0:
+            self.pending = (self.follow_speed, self.gap)
+            self.lead_distance = lead_distances[0]
+            self.n_samples = 1
+            lead_distances = lead_distances[1:]
+
+        # Pending sample first: its acceleration is known with the speed of the next one
+        lead, lead_speed = self._chunk(lead_distances)
+        follow_speed, follow_acceleration, gap = np.zeros((3, len(lead)))
+        follow_speed[0], gap[0] = self.pending
+
+        self.e_prev = kernels.control_drive_cycle_kernel(lead_speed, follow_speed, follow_acceleration, gap, self.kp,
+                                                         self.kd, vehicle.gap_target, vehicle.acceleration_max,
+                                                         vehicle.dt, float(self.e_prev))
+
+        self.pending = (follow_speed[-1], gap[-1])
+        self.follow_speed, self.gap = follow_speed[-1], gap[-1]
+
+        return follow_speed[:-1], follow_acceleration[:-1], gap[:-1]
+
+    def _states_of_charge(self, speed: np.ndarray, acceleration: np.ndarray) -> np.ndarray:
+
+        # State of charge of the completed samples with the kernel of get_state_of_charge, from the last sample
+        # of the battery (put first, its charge recomputed the same, or held when its discriminant was negative)
+        vehicle = self.vehicle
+        if len(speed) == 0:
+            return np.zeros(0)
+
+        _, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+        carried = self.n_battery_samples > 0
+        if carried:
+            power_wheel = np.concatenate([[self.power_wheel], power_wheel])
+
+        power_battery, capacity_supplied, state_of_charge = np.zeros((3, len(power_wheel)))
+        capacity_supplied[-1] = self.capacity_supplied    # read at the first sample as its previous one
+        state_of_charge[0] = self.state_of_charge
+
+        kernels.state_of_charge_kernel(power_wheel, power_battery, capacity_supplied, state_of_charge,
+                                       vehicle.voltage_nominal, vehicle.resistance, vehicle.capacity,
+                                       vehicle.efficiency_transmission * vehicle.efficiency_motor,
+                                       vehicle.standby_losses, vehicle.dt)
+
+        self.state_of_charge, self.capacity_supplied = state_of_charge[-1], capacity_supplied[-1]
+        self.power_wheel = power_wheel[-1]
+        self.n_battery_samples += len(speed)
+
+        return state_of_charge[int(carried):]
+
+    def flush(self):
+
+        # End of the stream: last CCC sample has no next speed, its acceleration stays zero
+        if self.pending is None:
+            return None
+
+        speed, gap = self.pending
+        self.pending = None
+        return self._with_state_of_charge(speed, 0., gap)
+
+    def _first_sample(self):
+
+        if self.controller == "ccc":
+            self.pending = (self.follow_speed, self.gap)
+            return None
+        return self.follow_speed, 0., self.gap
+
+    def _step_acc(self, lead_distance: float) -> tuple:
+
+        vehicle, dt = self.vehicle, self.vehicle.dt
+        gap, follow_speed, lead_speed = self.gap, self.follow_speed, self.lead_speed
+
+        if self.mpc is not None:
+            acceleration = self.mpc.control(gap, follow_speed, lead_speed)
+        else:
+            acceleration = float(kernels.acc_acceleration(gap, follow_speed, lead_speed, gap < vehicle.gap_min,
+                                                          self.headway, vehicle.gap_target, vehicle.gap_min,
+                                                          vehicle.headway_target, vehicle.headway_min,
+                                                          vehicle.acceleration_min, vehicle.acceleration_max, dt))
+
+        # Next speed, absolute distance and gap
+        self.follow_speed = follow_speed + acceleration * dt
+        self.follow_distance = self.follow_distance + self.follow_speed * dt
+        self.gap = lead_distance - self.follow_distance
+
+        return self.follow_speed, acceleration, self.gap
+
+    def _step_ccc(self):
+
+        vehicle, dt = self.vehicle, self.vehicle.dt
+        lead_speed = self.lead_speed
+        acceleration = 0.
+
+        # Nothing is controlled while the lead vehicle is stopped
+        if lead_speed == 0.:
+            follow_speed, gap = 0., 0.
+
+        else:
+            gap = self.gap + (lead_speed - self.follow_speed) * dt
+
+            follow_speed, e = kernels.ccc_speed(gap, self.follow_speed, lead_speed, self.e_prev, self.kp, self.kd,
+                                                vehicle.gap_target, vehicle.acceleration_max, dt)
+            follow_speed, e = float(follow_speed), float(e)
+
+            acceleration = (follow_speed - self.follow_speed) / dt
+            self.e_prev = e
+
+        # Completing the pending sample with its acceleration
+        speed_previous, gap_previous = self.pending
+        self.pending = (follow_speed, gap)
+        self.follow_speed, self.gap = follow_speed, gap
+
+        return speed_previous, acceleration, gap_previous
+
+    def _with_state_of_charge(self, speed: float, acceleration: float, gap: float) -> tuple:
+
+        vehicle = self.vehicle
+        _, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+
+        efficiency_drivetrain = vehicle.efficiency_transmission * vehicle.efficiency_motor
+        if power_wheel >= 0:
+            power_battery = (1 / efficiency_drivetrain) * power_wheel + vehicle.standby_losses
+        else:
+            power_battery = efficiency_drivetrain * power_wheel + vehicle.standby_losses
+
+        # Battery current (A), previous value when the discriminant is negative
+        discriminant = vehicle.voltage_nominal ** 2 - 4 * vehicle.resistance * power_battery
+        if discriminant >= 0:
+            battery_current = (vehicle.voltage_nominal - math.sqrt(discriminant)) / (2 * vehicle.resistance)
+        else:
+            battery_current = 3600 * self.capacity_supplied / vehicle.dt
+
+        self.capacity_supplied = battery_current * vehicle.dt / 3600
+        self.power_wheel = power_wheel
+
+        if self.n_battery_samples > 0:
+            self.state_of_charge -= self.capacity_supplied / vehicle.capacity
+        self.n_battery_samples += 1
+
+        return speed, acceleration, gap, self.state_of_charge
+
+
+def replay_drive_cycle(filename: str, dt=0.5, filtering="1hz", realtime=False, chunk_size=4096):
+
+    # Replays a dataset cycle as a live feed of lead positions, with the samples of preprocess_dataframe for every
+    # filtering ("1hz", "none" or "<rate>hz"). Unknown filterings raise on the call rather than at the first position
+    filtering_time_step(filtering)
+    filepath = os.path.join(DATASET_DIRECTORY, filename)
+
+    return _replay(preprocess_chunks(filepath, filtering, chunk_size=chunk_size), dt, realtime)
+
+
+def _replay(blocks, dt: float, realtime: bool):
+
+    lead_distance = 0.
+    for _, speeds, _ in blocks:
+        for speed in speeds:
+            # Integration of the position
+            lead_distance += speed * dt
+            yield lead_distance
+
+            if realtime:
+                time.sleep(dt)
+
+
+def simulate_stream(controller: StreamingController, lead_distances):
+
+    # Generator of (speed, acceleration, gap, soc) for an iterable of lead positions
+    for lead_distance in lead_distances:
+        sample = controller.step(lead_distance)
+        if sample is not None:
+            yield sample
+
+    sample = controller.flush()
+    if sample is not None:
+        yield sample
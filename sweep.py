@@ -0,0 +1,182 @@
+import numpy as np
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+from vehicles import AutonomousVehicle
+
+CONTROLLERS = ("ccc", "acc", "mpc")
+METRICS = ["mpge", "soc_drop", "min_gap", "jerk_rms"]
+
+# Lead trajectory and vehicle shared by the runs of a worker process
+_worker = {}
+
+
+def parameter_grid(**grid) -> list:
+
+    # Cartesian product of the swept values: parameter_grid(kp=[0.1, 0.2], kd=[1]) -> [{kp, kd}, ...]
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def _init_worker(shared_name: str, shape: tuple, columns: list, vehicle_parameters: tuple, dt: float, store=None,
+                 metadata=None):
+
+    import pandas as pd
+
+    # Attaching the read-only lead trajectory: time, speed, acceleration, absolute distance
+    shared = shared_memory.SharedMemory(name=shared_name)
+    lead = np.ndarray(shape, dtype=np.float64, buffer=shared.buf)
+    lead.flags.writeable = False
+
+    _worker["shared"] = shared
+    _worker["df"] = pd.DataFrame(lead[:, :3], columns=columns, copy=False)
+    _worker["lead_distance"] = lead[:, 3]
+    _worker["vehicle_parameters"] = vehicle_parameters
+    _worker["dt"] = dt
+    _worker["store"] = store
+    _worker["metadata"] = metadata
+
+
+def run_simulation(vehicle: AutonomousVehicle, controller: str, parameters: dict, df: "pd.DataFrame",
+                   lead_distance: np.ndarray, store=None, metadata=None, series=False) -> dict:
+
+    # Series of the run written in the results store when given, metadata being its cycle and vehicle names, and
+    # returned under "series" when asked
+    stored_parameters = dict(parameters)
+    parameters = dict(parameters)
+    kp, kd = parameters.pop("kp", 0.1), parameters.pop("kd", 1)
+    headway = parameters.pop("headway", False)
+    horizon = parameters.pop("horizon", 20)
+
+    # Gaps, headways and acceleration bounds of the autonomous vehicle, a misspelled name being an error rather than
+    # a new attribute
+    unknown = set(parameters) - set(vars(vehicle))
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}")
+    for name, value in parameters.items():
+        setattr(vehicle, name, value)
+
+    if controller == "ccc":
+        speed, acceleration, gap = vehicle.control_drive_cycle(lead_distance, kp=kp, kd=kd, df=df)
+    elif controller == "acc":
+        _, speed, acceleration, gap = vehicle.adaptive_cruise_control_drive_cycle(lead_distance, headway=headway,
+                                                                                 df=df)
+    elif controller == "mpc":
+        _, speed, acceleration, gap = vehicle.model_predictive_drive_cycle(lead_distance, horizon=horizon,
+                                                                           headway=headway, df=df)
+    else:
+        raise ValueError(f"Unknown controller {controller}")
+
+    # Consumption of the following vehicle
+    _, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+    power_battery, state_of_charge = vehicle.get_state_of_charge(power_wheel)
+    time = df[df.columns[0]].values
+
+    jerk = np.diff(acceleration) / vehicle.dt
+
+    metrics = {
+        "mpge": vehicle.get_mpge(time, lead_distance - gap, power_battery),
+        "soc_drop": state_of_charge[0] - state_of_charge[-1],
+        "min_gap": np.nanmin(gap),
+        "jerk_rms": np.sqrt(np.nanmean(jerk ** 2)),
+    }
+
+    columns = {"distance": lead_distance - gap, "speed": speed, "acceleration": acceleration, "gap": gap,
+               "power_battery": power_battery, "state_of_charge": state_of_charge}
+    if series:
+        metrics["series"] = columns
+
+    if store is not None:
+        metadata = dict(metadata or {})
+        if metadata.get("cycle") is None or metadata.get("vehicle") is None:
+            raise ValueError("Cycle and vehicle names are needed in the metadata of a stored run")
+        metrics["run_id"] = store.write(columns, time, controller=controller, parameters=stored_parameters,
+                                        dt=vehicle.dt, **metadata)
+
+    return metrics
+
+
+def _run_chunk(controller: str, chunk: list) -> list:
+
+    rows = []
+    for index, parameters in chunk:
+
+        # Fresh vehicle for every run so that swept attributes do not leak between runs
+        vehicle = AutonomousVehicle(*_worker["vehicle_parameters"], dt=_worker["dt"])
+        metrics = run_simulation(vehicle, controller, parameters, _worker["df"], _worker["lead_distance"],
+                                 store=_worker["store"], metadata=_worker["metadata"])
+        rows.append({"index": index, **parameters, **metrics})
+
+    return rows
+
+
+def grid_hash(controller: str, grid: list, vehicle_parameters: tuple, dt: float, lead: np.ndarray) -> str:
+
+    # Identity of a sweep: rows of a checkpoint only resume the same grid on the same vehicle and lead trajectory
+    description = json.dumps({"controller": controller, "grid": grid, "vehicle_parameters": vehicle_parameters,
+                              "dt": dt}, sort_keys=True, default=str).encode()
+    return hashlib.sha256(description + np.ascontiguousarray(lead, dtype=np.float64).tobytes()).hexdigest()[:16]
+
+
+def run_sweep(df: "pd.DataFrame", lead_distance: np.ndarray, vehicle_parameters: tuple, controller: str, grid: list,
+              checkpoint=None, n_workers=None, chunk_size=32, dt=0.5, store=None, metadata=None) -> "pd.DataFrame":
+
+    import pandas as pd
+
+    if controller not in CONTROLLERS:
+        raise ValueError(f"Unknown controller {controller}")
+    if not grid:
+        raise ValueError("Empty parameter grid, nothing to sweep")
+    if store is not None and (not metadata or metadata.get("cycle") is None or metadata.get("vehicle") is None):
+        raise ValueError("Cycle and vehicle names are needed in the metadata of a stored sweep")
+
+    lead = np.column_stack([df[df.columns[c]].values.astype(np.float64) for c in range(3)] + [lead_distance])
+    sweep_hash = grid_hash(controller, grid, vehicle_parameters, dt, lead)
+
+    # Resuming from the runs already saved in the checkpoint, written by the same sweep
+    done = set()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        saved = pd.read_csv(checkpoint)
+        hashes = set(saved["grid_hash"].astype(str)) if "grid_hash" in saved else {None}
+        if hashes - {sweep_hash}:
+            raise ValueError(f"Checkpoint {checkpoint} was written by another sweep (grid hash {sweep_hash})")
+        done = set(saved["index"].values)
+
+    pending = [(index, parameters) for index, parameters in enumerate(grid) if index not in done]
+    chunks = [pending[c:c + chunk_size] for c in range(0, len(pending), chunk_size)]
+
+    # Lead trajectory copied once in shared memory for all the workers
+    shared = shared_memory.SharedMemory(create=True, size=lead.nbytes)
+
+    rows = []
+    try:
+        np.ndarray(lead.shape, dtype=np.float64, buffer=shared.buf)[:] = lead
+
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(shared.name, lead.shape, list(df.columns[:3]), vehicle_parameters,
+                                           dt, store, metadata)) as executor:
+
+            futures = [executor.submit(_run_chunk, controller, chunk) for chunk in chunks]
+
+            for future in as_completed(futures):
+                chunk_rows = future.result()
+                rows.extend(chunk_rows)
+
+                # Saving progress after every chunk
+                if checkpoint is not None:
+                    pd.DataFrame(chunk_rows).assign(grid_hash=sweep_hash).to_csv(checkpoint, mode="a", index=False,
+                                                    header=not os.path.exists(checkpoint))
+    finally:
+        shared.close()
+        shared.unlink()
+
+    # Results table of the whole sweep, ordered as the grid
+    results = pd.DataFrame(rows)
+    if checkpoint is not None:
+        results = pd.read_csv(checkpoint).drop(columns="grid_hash")
+
+    return results.sort_values("index").reset_index(drop=True)
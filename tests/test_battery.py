@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import kernels
+from battery import LookupTable
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from vehicles import AutonomousVehicle
+
+BACKENDS = ["python"] + (["numba"] if kernels.NUMBA_INSTALLED else [])
+
+
+@pytest.fixture(scope="module")
+def hwy():
+    # HWY ends with missing speed samples
+    df = preprocess_dataframe("HWY.txt", "1hz")
+    return df, AutonomousVehicle(*parameters_vehicle("spark.json5"))
+
+
+@pytest.fixture
+def backend(request):
+    previous = kernels.BACKEND
+    kernels.set_backend(request.param)
+    yield request.param
+    kernels.set_backend(previous)
+
+
+def test_lookup_table_nan_inputs():
+
+    table = LookupTable([0., 1.], [0., 1.], [[0., 1.], [1., 2.]], resolution=(8, 8))
+    values = table(np.array([0.5, np.nan, 0.5]), np.array([0.5, 0.5, np.nan]))
+
+    assert values[0] == pytest.approx(1.)
+    assert np.isnan(values[1:]).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_equivalent_circuit_holds_missing_samples(hwy, backend):
+
+    df, vehicle = hwy
+    speed, acceleration = df[df.columns[1]].values, df[df.columns[2]].values
+    missing = np.flatnonzero(~np.isfinite(speed) | ~np.isfinite(acceleration))
+    assert missing.size > 0
+
+    power_battery, state_of_charge = vehicle.get_equivalent_circuit_state_of_charge(speed, acceleration)
+
+    assert np.isfinite(state_of_charge).all()
+    assert np.isfinite(power_battery).all()
+
+    # Previous draw held over the missing samples, not the maximum power point
+    previous = missing[0] - 1
+    np.testing.assert_allclose(power_battery[missing], power_battery[previous])
+    assert state_of_charge[-1] < state_of_charge[0]
+
+
+@pytest.mark.skipif(not kernels.NUMBA_INSTALLED, reason="numba is not installed")
+def test_equivalent_circuit_backends_agree(hwy):
+
+    df, vehicle = hwy
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    differences = kernels.check_parity(lead_distance, parameters_vehicle("spark.json5"), df=df)
+
+    assert differences["equivalent_circuit_state_of_charge"] < 1e-8
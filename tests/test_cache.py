@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import cache
+from preprocess import load_drive_cycle
+
+
+@pytest.fixture
+def cycle_file(tmp_path, monkeypatch):
+
+    # Cache of the test only, cycle of 1 Hz speeds in mph
+    monkeypatch.setattr(cache, "CACHE_DIRECTORY", str(tmp_path / "cache"))
+    filepath = tmp_path / "cycle.txt"
+    filepath.write_text("time\tmph\n0\t0\n1\t10\n2\t20\n3\t20\n")
+    return filepath
+
+
+def test_cache_invalidated_when_source_changes(cycle_file):
+
+    time, speed, _, cached = load_drive_cycle(str(cycle_file), "1hz", return_cached=True)
+    assert not cached
+    assert load_drive_cycle(str(cycle_file), "1hz", return_cached=True)[-1]
+
+    # Same name and size, other content: new key, preprocessed again
+    cycle_file.write_text("time\tmph\n0\t0\n1\t10\n2\t30\n3\t20\n")
+    time_edited, speed_edited, _, cached = load_drive_cycle(str(cycle_file), "1hz", return_cached=True)
+
+    assert not cached
+    np.testing.assert_array_equal(time_edited, time)
+    assert np.max(speed_edited) == pytest.approx(30 * 0.44704) and np.max(speed) == pytest.approx(20 * 0.44704)
+    assert load_drive_cycle(str(cycle_file), "1hz", return_cached=True)[-1]
+
+
+def test_cache_keyed_by_parameters(cycle_file):
+
+    load_drive_cycle(str(cycle_file), "1hz")
+
+    assert not load_drive_cycle(str(cycle_file), "none", return_cached=True)[-1]
+    assert not load_drive_cycle(str(cycle_file), "2hz", return_cached=True)[-1]
+    assert load_drive_cycle(str(cycle_file), "1hz", return_cached=True)[-1]
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import kernels
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+
+requires_numba = pytest.mark.skipif(not kernels.NUMBA_INSTALLED, reason="numba is not installed")
+
+
+@requires_numba
+@pytest.mark.parametrize("cycle", ["HWY.txt", "UDDS.txt"])
+@pytest.mark.parametrize("with_df", [True, False])
+def test_backends_parity(cycle, with_df):
+
+    df = preprocess_dataframe(cycle, "1hz")
+    lead_distance, _ = computing_absolute_distance(df, 0.5)
+    differences = kernels.check_parity(lead_distance, parameters_vehicle("spark.json5"), df=df if with_df else None)
+
+    assert set(differences) >= {"control_drive_cycle", "adaptive_cruise_control_drive_cycle",
+                                "adaptive_cruise_control_drive_cycle_headway", "get_state_of_charge",
+                                "equivalent_circuit_state_of_charge"}
+    for name, difference in differences.items():
+        assert difference < 1e-8, name
+
+
+@requires_numba
+def test_set_backend_restored_and_validated():
+
+    backend = kernels.BACKEND
+    with pytest.raises(ValueError):
+        kernels.set_backend("nunba")
+    assert kernels.BACKEND == backend
+
+
+@requires_numba
+@pytest.mark.parametrize("value, valid", [("python", True), ("nunba", False)])
+def test_environment_backend_validated(value, valid):
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", "import kernels; print(kernels.BACKEND)"], cwd=root,
+                            env={**os.environ, "DRIVE_CYCLE_BACKEND": value}, capture_output=True, text=True)
+
+    assert (result.returncode == 0) == valid
+    if valid:
+        assert result.stdout.strip() == value
+    else:
+        assert "Unknown DRIVE_CYCLE_BACKEND" in result.stderr
+
+
+def test_laws_elementwise():
+
+    # Laws on arrays of followers, each one with its own mode, as the same laws sample by sample
+    rng = np.random.default_rng(0)
+    n = 200
+    gap, follow_speed, lead_speed = rng.uniform(0, 10, n), rng.uniform(0, 30, n), rng.uniform(0.1, 30, n)
+    headway, e_prev = rng.random(n) < 0.5, rng.normal(size=n)
+    gap_target, gap_min = rng.uniform(3, 8, n), rng.uniform(0.5, 2, n)
+    parameters = (gap_target, gap_min, np.full(n, 5.), np.full(n, 1.), np.full(n, -3.), np.full(n, 3.))
+
+    acceleration = kernels.acc_acceleration(gap, follow_speed, lead_speed, gap < gap_min, headway, *parameters, 0.5)
+    speed, e = kernels.ccc_speed(gap, follow_speed, lead_speed, e_prev, 0.1, 1, gap_target, 3., 0.5)
+
+    for i in range(n):
+        values = (gap[i], follow_speed[i], lead_speed[i])
+        assert acceleration[i] == kernels.acc_acceleration(*values, gap[i] < gap_min[i], bool(headway[i]),
+                                                           *(p[i] for p in parameters), 0.5)
+        assert (speed[i], e[i]) == kernels.ccc_speed(*values, e_prev[i], 0.1, 1, gap_target[i], 3., 0.5)
+    assert np.all((acceleration >= -3.) & (acceleration <= 3.))
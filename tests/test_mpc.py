@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from mpc import ModelPredictiveController
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from vehicles import AutonomousVehicle
+
+TOLERANCE = 1e-3    # m, m/s
+
+
+@pytest.fixture(scope="module", params=["UDDS.txt", "HWY.txt"])
+def cycle(request):
+    df = preprocess_dataframe(request.param, "1hz")
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    return vehicle, df, lead_distance
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+@pytest.mark.parametrize("headway", [False, True])
+def test_constraints_hold(cycle, headway):
+
+    vehicle, df, lead_distance = cycle
+    _, speed, acceleration, gap = vehicle.model_predictive_drive_cycle(lead_distance, headway=headway, df=df)
+
+    assert np.nanmin(gap) >= vehicle.gap_min - TOLERANCE
+    assert np.nanmin(speed) >= -TOLERANCE
+    assert vehicle.acceleration_min <= np.nanmin(acceleration) <= np.nanmax(acceleration) <= vehicle.acceleration_max
+    if headway:
+        assert np.all(gap[np.isfinite(gap)] >= vehicle.headway_min * speed[np.isfinite(gap)] - TOLERANCE)
+
+
+def test_non_convergence_reported():
+
+    # Gap of 3 m at 15 m/s: the headway constraint cannot hold at the first step of the horizon
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    controller = ModelPredictiveController(vehicle, headway=True)
+    controller.control(3., 15., 10.)
+
+    assert not controller.converged
+    assert controller.n_iterations == controller.max_iterations
+    assert controller.n_not_converged == controller.n_solves == 1
+
+    # Statistics cleared with the warm start
+    controller.reset()
+    assert controller.n_not_converged == controller.n_solves == 0
+    controller.control(20., 10., 10.)
+    assert controller.converged and controller.n_iterations < controller.max_iterations
+    assert controller.n_not_converged == 0 and controller.n_solves == 1
+
+
+def test_factor_solves_system():
+
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    controller = ModelPredictiveController(vehicle, headway=True)
+    system = controller.hessian + controller.sigma * np.eye(controller.horizon) + \
+        controller.rho * controller.constraints.T @ controller.constraints
+    rhs = np.linspace(-1., 1., controller.horizon)
+
+    assert np.allclose(system @ controller._solve(rhs), rhs)
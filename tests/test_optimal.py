@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from vehicles import AutonomousVehicle
+
+TOLERANCE = 1e-9
+
+
+@pytest.fixture(scope="module", params=["UDDS.txt", "HWY.txt"])
+def cycle(request):
+    df = preprocess_dataframe(request.param, "1hz")
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    return vehicle, lead_distance
+
+
+def _check_constraints(vehicle, speed, acceleration, gap, headway):
+
+    gap_constraint = np.maximum(vehicle.gap_min, speed * vehicle.headway_min) if headway else vehicle.gap_min
+    assert np.all(gap >= gap_constraint - TOLERANCE)
+    assert np.min(speed) >= 0
+    assert vehicle.acceleration_min - TOLERANCE <= np.min(acceleration)
+    assert np.max(acceleration) <= vehicle.acceleration_max + TOLERANCE
+
+
+@pytest.mark.parametrize("headway", [False, True])
+def test_constraints_hold(cycle, headway):
+
+    vehicle, lead_distance = cycle
+    _, speed, acceleration, gap = vehicle.energy_optimal_drive_cycle(lead_distance, headway=headway)
+
+    _check_constraints(vehicle, speed, acceleration, gap, headway)
+
+
+@pytest.mark.parametrize("acceleration_step", [0.5, 0.25])
+def test_acceleration_resolution(acceleration_step):
+
+    # Accelerations are multiples of acceleration_step, finer than the 1 m/s2 of a speed grid tied to dt
+    df = preprocess_dataframe("HWY.txt", "1hz")
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    _, speed, acceleration, gap = vehicle.energy_optimal_drive_cycle(lead_distance[:200],
+                                                                     acceleration_step=acceleration_step)
+
+    _check_constraints(vehicle, speed, acceleration, gap, False)
+    levels = acceleration / acceleration_step
+    assert np.allclose(levels, np.round(levels))
+    assert np.any(np.abs(np.round(levels) % (1 / acceleration_step)) > 0)
+
+
+def test_fine_acceleration_step():
+
+    # 201 controls of 0.02 m/s2
+    df = preprocess_dataframe("HWY.txt", "1hz")
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    _, speed, acceleration, gap = vehicle.energy_optimal_drive_cycle(lead_distance[:40], n_gaps=11,
+                                                                     acceleration_step=0.02)
+
+    _check_constraints(vehicle, speed, acceleration, gap, False)
+    assert np.max(acceleration) > 0.6
@@ -0,0 +1,65 @@
+import copy
+
+import pytest
+
+from pipeline import DEFAULT_CONFIG, Pipeline, run_pipeline
+
+
+def _stages(names: list) -> set:
+    return {name for name in names if not name.startswith("figure:")}
+
+
+def _config(**overrides) -> dict:
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    config.update(overrides)
+    return config
+
+
+@pytest.fixture(scope="module")
+def pipeline():
+
+    # Every stage computed once, from the defaults
+    pipeline = Pipeline()
+    run_pipeline(pipeline, _config(), render=False)
+    return pipeline
+
+
+@pytest.mark.parametrize("overrides, recomputed", [
+    ({}, set()),
+    ({"soc_initial": 0.6}, {"state_of_charge:baseline", "state_of_charge:ccc", "state_of_charge:acc",
+                            "mpge:baseline", "mpge:ccc", "mpge:acc"}),
+    ({"vehicle_parameters": {"test_weight": 1500.}}, {"wheel_power:baseline", "wheel_power:ccc", "wheel_power:acc",
+                                                      "state_of_charge:baseline", "state_of_charge:ccc",
+                                                      "state_of_charge:acc", "mpge:baseline", "mpge:ccc",
+                                                      "mpge:acc"}),
+])
+def test_only_later_stages_recomputed(pipeline, overrides, recomputed):
+
+    run_pipeline(pipeline, _config(**overrides), render=False)
+
+    assert _stages(pipeline.computed) == recomputed
+    assert "preprocess" in pipeline.reused and "kinematics" in pipeline.reused
+
+
+def test_controller_input_recomputes_its_stages(pipeline):
+
+    config = _config()
+    config["controllers"][0]["parameters"]["kp"] = 0.2
+    run_pipeline(pipeline, config, render=False)
+
+    assert _stages(pipeline.computed) == {"controller:ccc", "wheel_power:ccc", "state_of_charge:ccc", "mpge:ccc"}
+    assert "controller:acc" in pipeline.reused
+
+
+@pytest.mark.parametrize("headway, title", [(False, "Adaptive Cruise Control"),
+                                            (True, "Adaptive Cruise Control considering headway")])
+def test_headway_in_title(headway, title):
+
+    config = _config()
+    config["controllers"][1]["parameters"]["headway"] = headway
+    pipeline = Pipeline()
+    run_pipeline(pipeline, config, render=False)
+
+    titles = [kwargs["title"] for _, _, (function, _, kwargs) in pipeline._figures
+              if function == "plotting_speed_lead_follow"]
+    assert titles == ["Classical Cruise Control", title]
@@ -0,0 +1,41 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from platoon import run_platoon
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from vehicles import AutonomousVehicle
+
+
+@pytest.fixture(scope="module")
+def cycle():
+    df = preprocess_dataframe("UDDS.txt", "1hz")
+    lead_distance, _ = computing_absolute_distance(df, 0.5)
+    return df, lead_distance
+
+
+def _vehicles(n_followers: int) -> list:
+    return [AutonomousVehicle(*parameters_vehicle("spark.json5")) for _ in range(n_followers)]
+
+
+def test_short_platoon_without_collision(cycle):
+
+    df, lead_distance = cycle
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        outputs = run_platoon(df, lead_distance, _vehicles(3), "acc")
+
+    assert not outputs["collision"].any()
+    assert np.nanmin(outputs["speed"]) >= 0
+
+
+@pytest.mark.parametrize("controllers", ["acc", "ccc"])
+def test_long_platoon_collisions_flagged(cycle, controllers):
+
+    df, lead_distance = cycle
+    with pytest.warns(RuntimeWarning, match="Collision in the platoon"):
+        outputs = run_platoon(df, lead_distance, _vehicles(50), controllers)
+
+    assert outputs["collision"].any() and not outputs["string_stable"]
+    assert np.nanmin(outputs["speed"]) >= 0
@@ -0,0 +1,34 @@
+import numpy as np
+
+from plotting_saving import decimate
+
+
+def test_decimation_keeps_extremes():
+
+    # Spikes of one sample, lost by a stride but kept as the extremes of their column
+    rng = np.random.default_rng(0)
+    n, n_columns = 10007, 100
+    x, y = 0.5 * np.arange(n), rng.normal(size=n)
+    y[1234], y[8765], y[n - 1] = 50., -50., 20.
+    y[4321] = np.nan
+
+    x_decimated, y_decimated = decimate(x, y, n_columns)
+
+    assert len(y_decimated) == 2 * n_columns
+    assert np.all(np.diff(x_decimated) >= 0)
+    np.testing.assert_array_equal(y_decimated, y[np.rint(x_decimated / 0.5).astype(int)])
+    assert {50., -50., 20.} <= set(y_decimated)
+
+    bucket = -(-n // n_columns)
+    for column in range(n_columns):
+        samples = y[column * bucket:(column + 1) * bucket]
+        decimated = y_decimated[2 * column:2 * column + 2]
+        assert np.nanmin(samples) == np.min(decimated) and np.nanmax(samples) == np.max(decimated)
+
+
+def test_short_lines_not_decimated():
+
+    x, y = np.arange(150), np.sin(np.arange(150))
+    x_decimated, y_decimated = decimate(x, y, 100)
+
+    assert x_decimated is x and y_decimated is y
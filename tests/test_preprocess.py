@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocess import filtering_time_step, load_drive_cycle, computing_absolute_distance, cubic_hermite_interpolation
+
+# Time, speed and acceleration of the former iterrows preprocessing, for each cycle and filtering
+REFERENCE_FILEPATH = os.path.join(os.path.dirname(__file__), "data", "preprocess_reference.npz")
+
+
+@pytest.mark.parametrize("filtering, dt", [("1hz", None), ("none", None), ("2hz", 0.5), ("0.5hz", 2.)])
+def test_filtering_time_step(filtering, dt):
+    assert filtering_time_step(filtering, None) == dt
+
+
+@pytest.mark.parametrize("filtering", ["2zh", "fast", "hz", "-1hz", "0hz", None])
+def test_unknown_filtering(filtering):
+    with pytest.raises(ValueError, match="expected one of 1hz, none, <rate>hz"):
+        load_drive_cycle("HWY.txt", filtering, use_cache=False)
+
+
+def test_absolute_distance_integrates_last_sample():
+
+    # Former loop: the first sample added distance[-1] (zero at that point) and the last one was never written
+    speed = np.array([0., 1., 2., 3., 4.])
+    df = pd.DataFrame({"time": 0.5 * np.arange(5), "speed": speed})
+    distance, lead_speed = computing_absolute_distance(df, 0.5)
+
+    previous = np.zeros(5)
+    for p in range(4):
+        previous[p] = speed[p] * 0.5 + previous[p - 1]
+
+    np.testing.assert_array_equal(distance[:-1], previous[:-1])
+    assert previous[-1] == 0. and distance[-1] == distance[-2] + speed[-1] * 0.5 == 5.
+    np.testing.assert_array_equal(lead_speed, speed)
+    np.testing.assert_array_equal(computing_absolute_distance(df, None)[0], distance)
+
+
+@pytest.mark.parametrize("cycle", ["HWY", "UDDS"])
+@pytest.mark.parametrize("filtering", ["1hz", "none"])
+def test_preprocessing_parity(cycle, filtering):
+
+    # Bit for bit, missing speeds (NaN) included
+    reference = np.load(REFERENCE_FILEPATH)
+    arrays = load_drive_cycle(f"{cycle}.txt", filtering, use_cache=False)
+
+    for name, values in zip(["time", "speed", "acceleration"], arrays):
+        np.testing.assert_array_equal(values, reference[f"{cycle}_{filtering}_{name}"])
+
+
+def test_cubic_hermite_interpolation():
+
+    # Slopes from np.gradient: exact for a line, and for a parabola away from the one-sided edge slopes
+    time = np.array([0., 0.5, 1.5, 2., 3., 4.5, 5.])
+    new_time = np.linspace(0., 5., 101)
+
+    line = 3. - 2. * time
+    np.testing.assert_allclose(cubic_hermite_interpolation(new_time, time, line), 3. - 2. * new_time, atol=1e-12)
+
+    parabola = time ** 2 - 4. * time + 1.
+    interpolated = cubic_hermite_interpolation(new_time, time, parabola)
+    inner = (new_time >= time[1]) & (new_time <= time[-2])
+    np.testing.assert_allclose(interpolated[inner], (new_time ** 2 - 4. * new_time + 1.)[inner], atol=1e-12)
+    np.testing.assert_allclose(cubic_hermite_interpolation(time, time, parabola), parabola, atol=1e-12)
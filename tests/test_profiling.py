@@ -0,0 +1,46 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import profiling
+
+
+@pytest.fixture
+def memory_profiling():
+    profiling.reset()
+    profiling.enable(memory=True)
+    yield
+    profiling.disable()
+    profiling.reset()
+
+
+def test_peak_of_freed_arrays(memory_profiling):
+
+    # Temporaries freed before the end of the stage: no net allocation, but a peak
+    with profiling.stage("outer"):
+        with profiling.stage("inner"):
+            temporary = np.ones(2 ** 20)    # 8 MB
+            del temporary
+        kept = np.ones(2 ** 17)    # 1 MB
+
+    stages = profiling.report()["stages"]
+    assert stages["outer;inner"]["peak_bytes"] >= 8 * 2 ** 20
+    assert stages["outer"]["peak_bytes"] >= stages["outer;inner"]["peak_bytes"]
+    assert len(kept) == 2 ** 17
+
+
+def test_tracing_of_caller_kept():
+
+    # Tracing started outside of the profiler is left running, the one of enable() is stopped
+    tracemalloc.start()
+    try:
+        profiling.enable(memory=True)
+        profiling.disable()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    profiling.enable(memory=True)
+    profiling.disable()
+    assert not tracemalloc.is_tracing()
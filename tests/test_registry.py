@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from preprocess import DATASET_DIRECTORY
+from registry import FIELDS, VehicleRegistry, load_vehicle_file, validate
+
+
+@pytest.fixture
+def spark():
+    return dict(load_vehicle_file(os.path.join(DATASET_DIRECTORY, "spark.json5")))
+
+
+def test_zero_bounds(spark):
+
+    # No standby losses is physical, an ideal battery without resistance is not in this model
+    assert validate({**spark, "standby_losses": 0})["standby_losses"] == 0.
+
+    for name, value in [("standby_losses", -1), ("resistance", 0), ("efficiency_motor", 0),
+                        ("efficiency_motor", 1.1)]:
+        with pytest.raises(ValueError, match=f"{name}={value} out of"):
+            validate({**spark, name: value})
+
+
+def test_table_bounds(spark, tmp_path):
+
+    def write(rows: list) -> str:
+        filepath = str(tmp_path / f"vehicles_{len(rows)}.csv")
+        with open(filepath, "w") as table_file:
+            table_file.write(",".join(["name"] + FIELDS) + "\n")
+            for name, parameters in rows:
+                table_file.write(",".join([name] + [str(parameters[field]) for field in FIELDS]) + "\n")
+        return filepath
+
+    registry = VehicleRegistry.from_table(write([("spark", spark), ("ideal", {**spark, "standby_losses": 0})]),
+                                          use_cache=False)
+    assert list(registry.standby_losses) == [spark["standby_losses"], 0.]
+
+    rows = [("spark", spark), ("ideal", {**spark, "standby_losses": 0}), ("broken", {**spark, "resistance": 0})]
+    with pytest.raises(ValueError, match=r"resistance of \['broken'\] out of \(0, None\]"):
+        VehicleRegistry.from_table(write(rows), use_cache=False)
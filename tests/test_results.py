@@ -0,0 +1,72 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from preprocess import DATASET_DIRECTORY
+from results import ResultsStore, SERIES
+
+
+def _columns(n_samples: int, scale=1.) -> dict:
+    generator = np.random.default_rng(0)
+    columns = {name: scale * generator.random(n_samples) for name in SERIES}
+    columns["gap"] += 1
+    return columns
+
+
+def _lines(store: ResultsStore) -> list:
+    with open(store.index_filepath, "r") as index_file:
+        return [json.loads(line) for line in index_file if line.strip()]
+
+
+def test_written_again_replaces_index_record(tmp_path):
+
+    store = ResultsStore(str(tmp_path), chunk_size=64)
+    time = 0.1 * np.arange(1000)
+    first = store.write(_columns(1000), time, "HWY.txt", "spark.json5", "acc", {"kp": 0.1})
+    second = store.write(_columns(1000, scale=2.), time, "HWY.txt", "spark.json5", "acc", {"kp": 0.1})
+    other = store.write(_columns(1000), time, "HWY.txt", "spark.json5", "acc", {"kp": 0.2})
+
+    assert first == second != other
+    lines = _lines(store)
+    assert [line["run_id"] for line in lines] == [first, other]
+    assert lines[0]["energy"] == pytest.approx(2 * lines[1]["energy"])
+
+
+def test_time_column_stored_in_double_precision(tmp_path):
+
+    store = ResultsStore(str(tmp_path), chunk_size=64)
+    time = 1e6 + 0.1 * np.arange(500)
+    run_id = store.write(_columns(500), time, "HWY.txt", "spark.json5", "acc")
+
+    loaded = store.load(run_id, ["time"], start=100, stop=300)["time"]
+    np.testing.assert_array_equal(loaded, time[100:300])
+
+    with pytest.raises(ValueError):
+        store.write(_columns(500), time[:-1], "HWY.txt", "spark.json5", "acc")
+
+
+def test_run_id_follows_vehicle_file_content(tmp_path):
+
+    store = ResultsStore(str(tmp_path))
+    filename = f"test_vehicle_{os.getpid()}.json5"
+    filepath = os.path.join(DATASET_DIRECTORY, filename)
+    with open(os.path.join(DATASET_DIRECTORY, "spark.json5"), "r") as vehicle_file:
+        spark = vehicle_file.read()
+
+    try:
+        with open(filepath, "w") as vehicle_file:
+            vehicle_file.write(spark)
+        first = store.write(_columns(100), np.arange(100.), "HWY.txt", filename, "acc")
+
+        with open(filepath, "w") as vehicle_file:
+            vehicle_file.write(spark.replace('"capacity": 52', '"capacity": 20'))
+        os.utime(filepath, ns=(0, os.stat(filepath).st_mtime_ns + 1))
+        second = store.write(_columns(100), np.arange(100.), "HWY.txt", filename, "acc")
+    finally:
+        os.remove(filepath)
+
+    assert first != second
+    assert store.index()[first]["sources"]["cycle"] == store.index()[second]["sources"]["cycle"]
+    assert len(_lines(store)) == 2
@@ -0,0 +1,24 @@
+import json
+
+from scenarios import run_scenario
+
+
+def test_failed_tasks_do_not_abort_the_scenario(tmp_path):
+
+    spec = {"cycles": ["HWY.txt"], "vehicles": ["spark.json5", "missing.json5"],
+            "controllers": [{"type": "acc"}, {"type": "ccc", "parameters": {"kp": [0.1, 0.2]}}],
+            "output": str(tmp_path)}
+    rows = run_scenario(spec, n_workers=2)
+
+    by_vehicle = {}
+    for row in rows:
+        by_vehicle.setdefault(row.get("vehicle"), []).append(row)
+
+    # preprocess, then vehicle, baseline and 3 simulations of every vehicle
+    assert len(rows) == 1 + 2 * 5
+    assert all("error" not in row for row in by_vehicle[None] + by_vehicle["spark.json5"])
+    assert all("error" in row for row in by_vehicle["missing.json5"])
+    assert all("lead_distance" not in row and "vehicle_parameters" not in row for row in rows)
+
+    with open(tmp_path / "results.jsonl", "r") as results_file:
+        assert len([json.loads(line) for line in results_file]) == len(rows)
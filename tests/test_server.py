@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from preprocess import DATASET_DIRECTORY
+from server import SimulationService, SimulationClient, serve
+
+
+def _strict(body: bytes) -> dict:
+
+    def reject(constant):
+        raise ValueError(f"Invalid JSON constant {constant}")
+
+    return json.loads(body, parse_constant=reject)
+
+
+@pytest.fixture(scope="module")
+def service():
+    service = SimulationService(n_workers=1, cache_size=8)
+    yield service
+    service.close()
+
+
+def test_canonical_keeps_parameter_types():
+
+    request = SimulationService.canonical({"cycle": "HWY.txt", "controller": "mpc",
+                                           "parameters": {"horizon": 20.0, "kd": 1}})
+    assert request["parameters"]["horizon"] == 20 and isinstance(request["parameters"]["horizon"], int)
+    assert isinstance(request["parameters"]["kd"], float)
+    assert request == SimulationService.canonical({"cycle": "HWY.txt", "controller": "mpc"})
+
+    with pytest.raises(ValueError):
+        SimulationService.canonical({"cycle": "HWY.txt", "controller": "mpc", "parameters": {"horizon": 2.5}})
+
+
+@pytest.mark.parametrize("request_body", [["HWY.txt", "acc"], "HWY.txt", None,
+                                          {"cycle": "HWY.txt", "controller": "acc", "parameters": [0.1]},
+                                          {"cycle": "HWY.txt", "controller": "acc", "parameters": None}])
+def test_non_object_request_rejected(request_body):
+    with pytest.raises(ValueError, match="must be a JSON object"):
+        SimulationService.canonical(request_body)
+
+
+@pytest.mark.parametrize("field, filename", [("cycle", "../README.md"), ("cycle", "/etc/passwd"),
+                                             ("vehicle", ".."), ("vehicle", "sub/spark.json5")])
+def test_path_traversal_rejected(field, filename):
+
+    request = {"cycle": "HWY.txt", "controller": "acc", field: filename}
+    with pytest.raises(ValueError):
+        SimulationService.canonical(request)
+
+
+def test_mpc_request_and_valid_json(service):
+
+    body, status = service.simulate({"cycle": "HWY.txt", "controller": "mpc", "parameters": {"horizon": 10}})
+    result = _strict(body)
+
+    assert status == "miss"
+    assert result["metrics"]["mpge"] > 0
+    # HWY ends with missing samples, sent as null
+    assert None in result["series"]["speed"]
+
+    _, status = service.simulate({"cycle": "HWY.txt", "controller": "mpc", "parameters": {"horizon": 10.0}})
+    assert status == "hit"
+
+
+def test_edited_vehicle_file_is_reloaded(service):
+
+    filename = f"test_vehicle_{os.getpid()}.json5"
+    filepath = os.path.join(DATASET_DIRECTORY, filename)
+    with open(os.path.join(DATASET_DIRECTORY, "spark.json5"), "r") as vehicle_file:
+        spark = vehicle_file.read()
+
+    try:
+        with open(filepath, "w") as vehicle_file:
+            vehicle_file.write(spark)
+        body, _ = service.simulate({"cycle": "HWY.txt", "controller": "acc", "vehicle": filename}, series=False)
+        soc_drop = _strict(body)["metrics"]["soc_drop"]
+
+        with open(filepath, "w") as vehicle_file:
+            vehicle_file.write(spark.replace('"capacity": 52', '"capacity": 20'))
+        body, status = service.simulate({"cycle": "HWY.txt", "controller": "acc", "vehicle": filename},
+                                        series=False)
+
+        assert status == "miss"
+        assert _strict(body)["metrics"]["soc_drop"] == pytest.approx(soc_drop * 52 / 20, rel=1e-6)
+    finally:
+        os.remove(filepath)
+
+
+def test_http_hits_and_metrics(service):
+
+    server = serve(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        client = SimulationClient(f"http://127.0.0.1:{server.server_address[1]}")
+        first = client.simulate("HWY.txt", "acc", series=False, parameters={"headway": True})
+        second = client.simulate("HWY.txt", "acc", series=False, parameters={"headway": True})
+        assert first == second
+
+        metrics = client.metrics()
+        assert metrics["hits"] >= 1 and 0 < metrics["hit_rate"] <= 1
+        assert metrics["latency_ms"]["hit"]["count"] >= 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("body, error", [(b'[1, 2]', "Request must be a JSON object"),
+                                         (b'{"cycle": "HWY.txt", "controller": "acc", "parameters": [1]}',
+                                          "Parameters must be a JSON object"),
+                                         (b'{"cycle": "HWY.txt", "controller": "acc", "series": "no"}',
+                                          "Field series must be a boolean"),
+                                         (b'{"cycle": "HWY.txt", "controller": "acc", "series": 0}',
+                                          "Field series must be a boolean")])
+def test_http_malformed_request_is_bad_request(service, body, error):
+
+    server = serve(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        http_request = Request(f"http://127.0.0.1:{server.server_address[1]}/simulate", data=body,
+                               headers={"Content-Type": "application/json"})
+        with pytest.raises(HTTPError) as raised:
+            urlopen(http_request, timeout=60)
+
+        assert raised.value.code == 400
+        assert json.loads(raised.value.read())["error"] == error
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from preprocess import preprocess_dataframe, computing_absolute_distance
+from streaming import replay_drive_cycle
+
+
+@pytest.mark.parametrize("filtering", ["1hz", "none", "2hz", "0.5hz"])
+def test_replay_follows_preprocessing(filtering):
+
+    df = preprocess_dataframe("UDDS.txt", filtering)
+    lead_distance, _ = computing_absolute_distance(df, 0.5)
+    replayed = np.fromiter(replay_drive_cycle("UDDS.txt", dt=0.5, filtering=filtering, chunk_size=100), dtype=float)
+
+    assert len(replayed) == len(df)
+    np.testing.assert_allclose(replayed, lead_distance, rtol=1e-12)
+
+
+def test_replay_unknown_filtering():
+    with pytest.raises(ValueError, match="Unknown filtering"):
+        replay_drive_cycle("UDDS.txt", filtering="2zh")
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from results import ResultsStore
+from sweep import parameter_grid, run_simulation, run_sweep
+from vehicles import AutonomousVehicle
+
+
+@pytest.fixture(scope="module")
+def cycle():
+    df = preprocess_dataframe("HWY.txt", "1hz")
+    lead_distance, _ = computing_absolute_distance(df, 0.5)
+    return df, lead_distance, parameters_vehicle("spark.json5")
+
+
+def test_checkpoint_resumes_only_its_grid(cycle, tmp_path):
+
+    df, lead_distance, vehicle_parameters = cycle
+    checkpoint = str(tmp_path / "sweep.csv")
+    grid = parameter_grid(kp=[0.1, 0.2], kd=[1])
+
+    first = run_sweep(df, lead_distance, vehicle_parameters, "ccc", grid, checkpoint=checkpoint, n_workers=1)
+    resumed = run_sweep(df, lead_distance, vehicle_parameters, "ccc", grid, checkpoint=checkpoint, n_workers=1)
+
+    assert list(first.columns) == list(resumed.columns) and "grid_hash" not in first
+    np.testing.assert_array_equal(first["mpge"].values, resumed["mpge"].values)
+
+    with pytest.raises(ValueError, match="another sweep"):
+        run_sweep(df, lead_distance, vehicle_parameters, "ccc", parameter_grid(kp=[0.3], kd=[1]),
+                  checkpoint=checkpoint, n_workers=1)
+
+
+def test_stored_runs_need_cycle_and_vehicle(cycle, tmp_path):
+
+    df, lead_distance, vehicle_parameters = cycle
+    store = ResultsStore(str(tmp_path))
+
+    with pytest.raises(ValueError, match="Cycle and vehicle"):
+        run_simulation(AutonomousVehicle(*vehicle_parameters), "ccc", {}, df, lead_distance, store=store)
+
+    run_ids = [run_simulation(AutonomousVehicle(*vehicle_parameters), "ccc", {}, df, lead_distance, store=store,
+                              metadata={"cycle": cycle_name, "vehicle": "spark.json5"})["run_id"]
+               for cycle_name in ("HWY.txt", "UDDS.txt")]
+    assert run_ids[0] != run_ids[1]
+
+
+def test_unknown_parameters_rejected(cycle):
+
+    df, lead_distance, vehicle_parameters = cycle
+    vehicle = AutonomousVehicle(*vehicle_parameters)
+
+    with pytest.raises(ValueError, match=r"Unknown parameters \['gap_taget'\]"):
+        run_simulation(vehicle, "acc", {"gap_taget": 3.}, df, lead_distance)
+    assert not hasattr(vehicle, "gap_taget")
+
+    with pytest.raises(ValueError, match="Unknown parameters"):
+        run_sweep(df, lead_distance, vehicle_parameters, "acc", parameter_grid(gap_taget=[3.]), n_workers=1)
+
+
+def test_empty_grid(cycle, tmp_path):
+
+    df, lead_distance, vehicle_parameters = cycle
+
+    with pytest.raises(ValueError, match="Empty parameter grid"):
+        run_sweep(df, lead_distance, vehicle_parameters, "ccc", parameter_grid(kp=[], kd=[1]),
+                  checkpoint=str(tmp_path / "sweep.csv"), n_workers=1)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from vehicles import AutonomousVehicle
+
+
+@pytest.fixture(scope="module", params=["UDDS.txt", "HWY.txt"])
+def cycle(request):
+    df = preprocess_dataframe(request.param, "1hz")
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    return vehicle, df, lead_distance
+
+
+@pytest.mark.parametrize("headway", [False, True])
+def test_adaptive_takes_fewer_steps_than_fixed(cycle, headway):
+
+    vehicle, df, lead_distance = cycle
+    n_fixed = int(np.isfinite(lead_distance).sum()) - 1
+    outputs = vehicle.adaptive_drive_cycle(lead_distance, headway=headway, df=df, tolerance=1e-2)
+
+    assert outputs["n_steps"] + outputs["n_rejected"] < n_fixed
+    assert outputs["n_rejected"] < 0.2 * outputs["n_steps"]
+
+
+def test_adaptive_converges_with_tolerance(cycle):
+
+    vehicle, df, lead_distance = cycle
+    reference = vehicle.adaptive_drive_cycle(lead_distance, df=df, tolerance=1e-5, dt_min=1e-4)
+    coarse = vehicle.adaptive_drive_cycle(lead_distance, df=df, tolerance=1e-2)
+    fine = vehicle.adaptive_drive_cycle(lead_distance, df=df, tolerance=1e-3)
+
+    errors = [np.nanmax(np.abs(outputs["speed"] - reference["speed"])) for outputs in (coarse, fine)]
+    assert errors[1] < errors[0] < 0.5
+    assert coarse["mpge"] == pytest.approx(reference["mpge"], rel=1e-2)
+    assert np.nanmin(coarse["gap"]) >= vehicle.gap_min - 0.05
+
+
+@pytest.mark.parametrize("controller, controller_dt", [("acc", 0.5), ("acc", 1.), ("mpc", 0.5), ("mpc", 1.)])
+def test_multirate_gap_non_negative(cycle, controller, controller_dt):
+
+    vehicle, df, lead_distance = cycle
+    outputs = vehicle.multirate_drive_cycle(lead_distance, controller, df=df, controller_dt=controller_dt,
+                                            dynamics_dt=0.5)
+
+    assert not outputs["collision"]
+    assert np.nanmin(outputs["gap"]) >= 0
+
+
+def test_multirate_coarse_controller_warns(cycle):
+
+    vehicle, df, lead_distance = cycle
+    with pytest.warns(RuntimeWarning, match="Negative gap"):
+        outputs = vehicle.multirate_drive_cycle(lead_distance, "ccc", df=df, controller_dt=2., dynamics_dt=0.5)
+
+    assert outputs["collision"] and outputs["min_gap"] < 0
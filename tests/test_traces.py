@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+
+from preprocess import DATASET_DIRECTORY, preprocess_dataframe, computing_absolute_distance, parameters_vehicle, \
+    preprocess_arrays, preprocess_chunks
+from streaming import StreamingController, simulate_stream
+from traces import convert_drive_cycle, simulate_trace
+from vehicles import AutonomousVehicle
+
+
+@pytest.fixture(scope="module")
+def cycle():
+    df = preprocess_dataframe("UDDS.txt", "1hz")
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    lead_distance[1000:1003] = np.nan
+    return vehicle, lead_distance
+
+
+@pytest.mark.parametrize("controller, headway", [("acc", False), ("acc", True), ("ccc", False)])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_process_by_chunks_matches_steps(cycle, controller, headway, chunk_size):
+
+    vehicle, lead_distance = cycle
+    expected = np.array(list(simulate_stream(StreamingController(vehicle, controller, headway=headway),
+                                             lead_distance))).T
+
+    streaming = StreamingController(vehicle, controller, headway=headway)
+    chunks = [streaming.process(lead_distance[start:start + chunk_size])
+              for start in range(0, len(lead_distance), chunk_size)]
+    samples = [np.concatenate([chunk[column] for chunk in chunks]) for column in range(4)]
+    last_sample = streaming.flush()
+    if last_sample is not None:
+        samples = [np.append(column, value) for column, value in zip(samples, last_sample)]
+
+    np.testing.assert_array_equal(np.array(samples), expected)
+
+
+@pytest.mark.parametrize("filtering", ["1hz", "none", "2hz", "0.7hz"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_chunked_reader_matches_arrays(filtering, chunk_size):
+
+    filepath = os.path.join(DATASET_DIRECTORY, "HWY.txt")
+    expected = preprocess_arrays(filepath, filtering)
+    blocks = list(preprocess_chunks(filepath, filtering, chunk_size=chunk_size))
+
+    for column, values in enumerate(expected):
+        np.testing.assert_array_equal(np.concatenate([block[column] for block in blocks]), values)
+
+
+def test_simulated_trace_matches_stream(cycle, tmp_path):
+
+    vehicle, _ = cycle
+    lead = convert_drive_cycle("UDDS.txt", "1hz", str(tmp_path / "lead.trace"), dt=vehicle.dt, chunk_size=500)
+    follow = simulate_trace(lead, StreamingController(vehicle, "ccc"), str(tmp_path / "follow.trace"))
+
+    expected = np.array(list(simulate_stream(StreamingController(vehicle, "ccc"), np.array(lead["distance"])))).T
+    for column, name in enumerate(["speed", "acceleration", "gap", "state_of_charge"]):
+        np.testing.assert_array_equal(follow[name], expected[column])
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from preprocess import preprocess_dataframe, computing_absolute_distance, parameters_vehicle
+from uncertainty import monte_carlo, simulate_noisy
+from vehicles import AutonomousVehicle
+
+
+@pytest.fixture(scope="module", params=["UDDS.txt", "HWY.txt"])
+def cycle(request):
+    df = preprocess_dataframe(request.param, "1hz")
+    vehicle = AutonomousVehicle(*parameters_vehicle("spark.json5"))
+    lead_distance, _ = computing_absolute_distance(df, vehicle.dt)
+    return vehicle, df, lead_distance
+
+
+@pytest.mark.parametrize("headway", [False, True])
+def test_zero_noise_acc_is_deterministic_run(cycle, headway):
+
+    vehicle, df, lead_distance = cycle
+    noisy = simulate_noisy(vehicle, "acc", lead_distance, {}, 3, np.random.default_rng(0), df=df, headway=headway)
+    expected = vehicle.adaptive_cruise_control_drive_cycle(lead_distance, headway=headway, df=df)
+
+    for realizations, values in zip(noisy, expected):
+        for realization in realizations:
+            np.testing.assert_array_equal(realization, values)
+
+
+def test_zero_noise_ccc_is_deterministic_run(cycle):
+
+    vehicle, df, lead_distance = cycle
+    _, speed, acceleration, gap = simulate_noisy(vehicle, "ccc", lead_distance, {}, 3, np.random.default_rng(0),
+                                                 df=df, kp=0.1, kd=1)
+    expected = vehicle.control_drive_cycle(lead_distance, kp=0.1, kd=1, df=df)
+
+    for realizations, values in zip((speed, acceleration, gap), expected):
+        for realization in realizations:
+            np.testing.assert_array_equal(realization, values)
+
+
+def test_zero_noise_monte_carlo_has_no_spread(cycle):
+
+    vehicle, df, lead_distance = cycle
+    _, speed, acceleration, gap = vehicle.adaptive_cruise_control_drive_cycle(lead_distance, df=df)
+    _, power_wheel = vehicle.get_power_wheel(speed, acceleration)
+    power_battery, _ = vehicle.get_state_of_charge(power_wheel)
+    mpge = vehicle.get_mpge(df[df.columns[0]].values, lead_distance - gap, power_battery)
+
+    result = monte_carlo(vehicle, "acc", lead_distance, df=df, n_realizations=8, chunk_size=3)
+
+    np.testing.assert_allclose(result["min_gap"], np.nanmin(gap), rtol=1e-12)
+    np.testing.assert_allclose(result["realizations"]["mpge"], mpge, rtol=1e-12)
+    assert result["collision_probability"] == float(np.nanmin(gap) < 0)
@@ -0,0 +1,312 @@
+import numpy as np
+import copy
+import math
+import warnings
+
+import kernels
+from kinematics import differentiate
+from mpc import ModelPredictiveController
+
+MULTIRATE_CONTROLLERS = ("ccc", "acc", "mpc")
+
+# Error scales of the adaptive state: distance (m), speed (m/s), charge drawn (Ah), energy drawn (J), charge and
+# energy being also controlled relatively to their value. A speed error of 1 m/s held over the ~1 s steps moves the
+# gap by about the distance scale: a tighter speed scale only shortens the steps without changing the outputs
+ERROR_SCALES = np.array([1., 1., 1e-3, 1e3])
+RELATIVE_ERROR = np.array([0., 0., 1., 1.])
+
+# Step size controller: safety factor, bounds of the step change, PI exponents (of the error of the step and of
+# the previous accepted one) over the order of the embedded solution
+SAFETY = 0.9
+FACTOR_MIN, FACTOR_MAX = 0.2, 2.
+PI_EXPONENTS = (0.6, 0.2)
+ORDER = 3
+
+
+def _lead(vehicle, lead_distance: np.ndarray, df=None) -> tuple:
+
+    # Time and speed of the lead samples, true speed when df is given
+    lead_distance = np.asarray(lead_distance, dtype=float)
+    if df is None:
+        lead_speed, _ = vehicle.compute_speed_acceleration(lead_distance)
+        return np.arange(len(lead_distance)) * vehicle.dt, lead_speed
+
+    return np.asarray(df[df.columns[0]].values, dtype=float), np.asarray(df[df.columns[1]].values, dtype=float)
+
+
+def _bin_mean(time: np.ndarray, values: np.ndarray, grid: np.ndarray, closed="right") -> np.ndarray:
+
+    # Mean of the samples falling in every interval of the grid: (grid[k - 1], grid[k]] when closed on the right,
+    # [grid[k], grid[k + 1]) on the left, the sample of the grid point itself for empty intervals
+    side = "left" if closed == "right" else "right"
+    bins = np.clip(np.searchsorted(grid, time, side=side) - (closed == "left"), 0, len(grid) - 1)
+
+    counts = np.bincount(bins, minlength=len(grid))
+    sums = np.bincount(bins, weights=values, minlength=len(grid))
+    point = np.interp(grid, time, values)
+
+    return np.where(counts > 0, sums / np.maximum(counts, 1), point)
+
+
+def resample(time: np.ndarray, columns: dict, grid: np.ndarray, closed="right") -> dict:
+
+    # States (distance, speed, gap, soc) interpolated, rates (acceleration, battery power) averaged over every
+    # interval so that the energy is kept; nothing is changed on the same grid
+    if len(time) == len(grid) and np.allclose(time, grid):
+        return dict(columns)
+
+    resampled = {}
+    for name, values in columns.items():
+        if name == "acceleration":
+            resampled[name] = _bin_mean(time, values, grid, closed)
+        elif name == "power_battery":
+            resampled[name] = _bin_mean(time, values, grid, "right")
+        else:
+            resampled[name] = np.interp(grid, time, values)
+
+    return resampled
+
+
+def multirate_drive_cycle(vehicle, lead_distance: np.ndarray, controller="acc", df=None, controller_dt=None,
+                          dynamics_dt=None, output_time=None, headway=False, kp=0.1, kd=1, horizon=20,
+                          weights=None) -> dict:
+
+    # Controller updated every controller_dt, its command held while the vehicle and battery are integrated every
+    # dynamics_dt, outputs on the lead grid (output_time). Same results as the single rate methods at vehicle.dt
+    if controller not in MULTIRATE_CONTROLLERS:
+        raise ValueError(f"Unknown controller {controller}")
+
+    controller_dt = controller_dt or vehicle.dt
+    dynamics_dt = dynamics_dt or controller_dt
+    n_substeps = int(round(controller_dt / dynamics_dt))
+    if n_substeps < 1 or not math.isclose(n_substeps * dynamics_dt, controller_dt):
+        raise ValueError(f"controller_dt {controller_dt} is not a multiple of dynamics_dt {dynamics_dt}")
+
+    lead_time, lead_speed = _lead(vehicle, lead_distance, df)
+    n_steps = int(round((lead_time[-1] - lead_time[0]) / dynamics_dt)) + 1
+    time = lead_time[0] + np.arange(n_steps) * dynamics_dt
+    lead_x = np.interp(time, lead_time, lead_distance)
+    lead_v = np.interp(time, lead_time, lead_speed)
+
+    predictive = None
+    if controller == "mpc":
+        controlled = copy.copy(vehicle)
+        controlled.dt = controller_dt
+        predictive = ModelPredictiveController(controlled, horizon=horizon, headway=headway, weights=weights)
+
+    gap = np.zeros(n_steps)
+    gap[0] = 1    # gap initial in meter
+    follow_distance = np.zeros(n_steps)
+    follow_distance[0] = lead_x[0] - gap[0]
+    follow_speed = np.zeros(n_steps)
+    follow_acceleration = np.zeros(n_steps)
+
+    v, dt, h = vehicle, controller_dt, dynamics_dt
+    acceleration, stopped, e_prev = 0., False, 1
+
+    for j in range(n_steps - 1):
+
+        # Controller update from the state at its own rate
+        if j % n_substeps == 0:
+            gap_j, speed_j, lead_speed_j = gap[j], follow_speed[j], lead_v[j]
+
+            if controller == "ccc":
+                # Nothing is controlled while the lead vehicle is stopped
+                stopped = lead_speed_j == 0.
+                acceleration = 0.
+                if not stopped:
+                    speed_next, e_prev = kernels.ccc_speed(gap_j + (lead_speed_j - speed_j) * dt, speed_j,
+                                                           lead_speed_j, e_prev, kp, kd, v.gap_target,
+                                                           v.acceleration_max, dt)
+                    acceleration = float(speed_next - speed_j) / dt
+
+            elif controller == "mpc":
+                acceleration = predictive.control(gap_j, speed_j, lead_speed_j)
+
+            else:
+                acceleration = float(kernels.acc_acceleration(gap_j, speed_j, lead_speed_j, gap_j < v.gap_min, headway,
+                                                              v.gap_target, v.gap_min, v.headway_target,
+                                                              v.headway_min, v.acceleration_min, v.acceleration_max,
+                                                              dt))
+
+        # Vehicle integrated at its own rate with the held command: as control_drive_cycle for the CCC (integrated
+        # gap, acceleration of the current sample), as adaptive_cruise_control_drive_cycle otherwise
+        if controller == "ccc":
+            follow_acceleration[j] = acceleration
+            if not stopped:
+                gap[j + 1] = gap[j] + (lead_v[j] - follow_speed[j]) * h
+                follow_speed[j + 1] = follow_speed[j] + acceleration * h
+        else:
+            follow_acceleration[j + 1] = acceleration
+            follow_speed[j + 1] = follow_speed[j] + acceleration * h
+            follow_distance[j + 1] = follow_distance[j] + follow_speed[j + 1] * h
+            gap[j + 1] = lead_x[j + 1] - follow_distance[j + 1]
+
+    if controller == "ccc":
+        follow_distance = lead_x - gap
+
+    # Battery at the rate of the dynamics
+    dynamics = copy.copy(vehicle)
+    dynamics.dt = dynamics_dt
+    _, power_wheel = dynamics.get_power_wheel(follow_speed, follow_acceleration)
+    power_battery, state_of_charge = dynamics.get_state_of_charge(power_wheel)
+
+    # The command held over a coarse controller_dt can drive the follower into the lead vehicle: reported rather than
+    # corrected, the held command being what is studied
+    min_gap = np.nanmin(gap) if np.isfinite(gap).any() else np.nan
+    collision = bool(min_gap < 0)
+    if collision:
+        warnings.warn(f"Negative gap with the {controller} controller updated every {controller_dt} s "
+                      f"(min {min_gap:.2f} m, {int(np.sum(gap < 0))} of {n_steps} steps)", RuntimeWarning)
+
+    grid = lead_time if output_time is None else np.asarray(output_time, dtype=float)
+    outputs = resample(time, {"distance": follow_distance, "speed": follow_speed,
+                              "acceleration": follow_acceleration, "gap": gap, "power_battery": power_battery,
+                              "state_of_charge": state_of_charge},
+                       grid, closed="left" if controller == "ccc" else "right")
+
+    return {"time": grid, **outputs, "mpge": vehicle.get_mpge(grid, outputs["distance"], outputs["power_battery"]),
+            "n_steps": n_steps, "n_controller_updates": -(-(n_steps - 1) // n_substeps), "min_gap": min_gap,
+            "collision": collision}
+
+
+def _hermite(times: np.ndarray, states: np.ndarray, derivatives: np.ndarray, grid: np.ndarray) -> np.ndarray:
+
+    # Cubic Hermite interpolation of the accepted steps on the grid, every column of the states at once
+    k = np.clip(np.searchsorted(times, grid, side="right") - 1, 0, len(times) - 2)
+    h = (times[k + 1] - times[k])[:, None]
+    s = ((grid - times[k]) / (times[k + 1] - times[k]))[:, None]
+
+    return (2 * s ** 3 - 3 * s ** 2 + 1) * states[k] + (s ** 3 - 2 * s ** 2 + s) * h * derivatives[k] + \
+        (-2 * s ** 3 + 3 * s ** 2) * states[k + 1] + (s ** 3 - s ** 2) * h * derivatives[k + 1]
+
+
+def adaptive_drive_cycle(vehicle, lead_distance: np.ndarray, df=None, headway=False, tolerance=1e-2, dt_min=0.01,
+                         dt_max=5., output_time=None) -> dict:
+
+    # ACC law in continuous time, its gains being those of the discrete law at vehicle.dt, integrated with the
+    # Bogacki-Shampine 3(2) pair: long steps on steady segments, short ones where the error grows (transients,
+    # saturations) and before the gap reaches gap_min. The law (safe under gap_min, target above) is the one of
+    # the start of every step: switching inside a step would make every step across gap_min fail
+    lead_time, lead_speed = _lead(vehicle, lead_distance, df)
+    lead_distance = np.asarray(lead_distance, dtype=float)
+    v, dt = vehicle, vehicle.dt
+
+    # Integrated up to the last valid lead sample, the outputs past it being NaN as in the single rate methods
+    finite = np.isfinite(lead_time) & np.isfinite(lead_distance) & np.isfinite(lead_speed)
+    n_valid = len(finite) if finite.all() else int(np.argmin(finite))
+    if n_valid < 2:
+        raise ValueError("Less than two valid lead samples")
+    grid = lead_time if output_time is None else np.asarray(output_time, dtype=float)
+    lead_time, lead_speed, lead_distance = lead_time[:n_valid], lead_speed[:n_valid], lead_distance[:n_valid]
+
+    a, b, c = vehicle.target_abc
+    modeled_mass = 1.03 * vehicle.test_weight
+    efficiency_drivetrain = vehicle.efficiency_transmission * vehicle.efficiency_motor
+    voltage, resistance = vehicle.voltage_nominal, vehicle.resistance
+
+    def derivative(t: float, state: np.ndarray, safe: bool) -> np.ndarray:
+
+        # State: distance, speed, charge drawn (Ah), energy drawn (J)
+        distance, speed = state[0], state[1]
+        lead_speed_t = np.interp(t, lead_time, lead_speed)
+        gap = np.interp(t, lead_time, lead_distance) - distance
+
+        acceleration = float(kernels.acc_acceleration(gap, speed, lead_speed_t, safe, headway, v.gap_target, v.gap_min,
+                                                      v.headway_target, v.headway_min, v.acceleration_min,
+                                                      v.acceleration_max, dt))
+
+        # Battery power and current as get_state_of_charge, current of the maximum power point past it
+        speed_mph = 2.23694 * speed
+        power_wheel = (modeled_mass * acceleration + (a + b * speed_mph + c * speed_mph ** 2) * 4.44822) * speed
+        if power_wheel >= 0:
+            power_battery = power_wheel / efficiency_drivetrain + vehicle.standby_losses
+        else:
+            power_battery = efficiency_drivetrain * power_wheel + vehicle.standby_losses
+
+        discriminant = voltage ** 2 - 4 * resistance * power_battery
+        current = (voltage - math.sqrt(max(discriminant, 0.))) / (2 * resistance)
+
+        return np.array([speed, acceleration, current / 3600, power_battery])
+
+    t, t_end = float(lead_time[0]), float(lead_time[-1])
+    state = np.array([lead_distance[0] - 1., 0., 0., 0.])    # gap initial in meter
+    safe = bool(lead_distance[0] - state[0] < v.gap_min)
+    k1 = derivative(t, state, safe)
+    times, states, derivatives = [t], [state], [k1]
+    h_next, error_previous, n_rejected, n_evaluations = min(dt, dt_max), 1., 0, 1
+
+    while t < t_end - 1e-12:
+
+        # Step proposed by the controller, shortened to the end of the cycle and to about half the time for the gap
+        # to close down to gap_min at the current closing speed, the proposal being kept for the next step. The
+        # overshoot of tolerance * distance scale keeps the steps from shrinking geometrically along gap_min
+        h = min(h_next, t_end - t)
+        gap = np.interp(t, lead_time, lead_distance) - state[0]
+        closing_speed = state[1] - np.interp(t, lead_time, lead_speed)
+        if closing_speed > 0 and gap > v.gap_min:
+            h = min(h, max(dt_min, (0.5 * (gap - v.gap_min) + tolerance * ERROR_SCALES[0]) / closing_speed))
+
+        # Law of the step, k1 evaluated again when it switched at the end of the previous step
+        if (gap < v.gap_min) != safe:
+            safe = not safe
+            k1 = derivative(t, state, safe)
+            derivatives[-1] = k1
+            n_evaluations += 1
+
+        k2 = derivative(t + h / 2, state + h / 2 * k1, safe)
+        k3 = derivative(t + 3 * h / 4, state + 3 * h / 4 * k2, safe)
+        state_next = state + h * (2 * k1 + 3 * k2 + 4 * k3) / 9
+        k4 = derivative(t + h, state_next, safe)
+        n_evaluations += 3
+
+        # Difference with the embedded second order solution, root mean square over the scaled components
+        error_scale = tolerance * (ERROR_SCALES + RELATIVE_ERROR * np.maximum(np.abs(state), np.abs(state_next)))
+        error = np.sqrt(np.mean((h * (-5 / 72 * k1 + 1 / 12 * k2 + 1 / 9 * k3 - 1 / 8 * k4) / error_scale) ** 2))
+        error = np.inf if np.isnan(error) else max(error, 1e-10)
+
+        if error <= 1 or h <= dt_min:
+
+            # PI control of the next step: smoother steps than the error of the step alone, fewer rejections
+            factor = SAFETY * error ** (-PI_EXPONENTS[0] / ORDER) * error_previous ** (PI_EXPONENTS[1] / ORDER)
+            h_controlled = h * min(FACTOR_MAX, max(FACTOR_MIN, factor))
+            h_next = max(h_next, h_controlled) if h < h_next else h_controlled
+            error_previous = max(error, 1e-4)
+
+            t, state, k1 = t + h, state_next, k4
+            times.append(t)
+            states.append(state)
+            derivatives.append(k1)
+        else:
+            # No growth after a rejection
+            h_next = h * min(1., max(FACTOR_MIN, SAFETY * error ** (-1 / ORDER)))
+            n_rejected += 1
+
+        h_next = min(max(h_next, dt_min), dt_max)
+
+    # Outputs on the lead grid (output_time): battery power averaged over every interval from the energy drawn
+    times, states, derivatives = np.array(times), np.array(states), np.array(derivatives)
+    distance, speed, charge, energy = _hermite(times, states, derivatives, grid).T
+    outside = (grid < times[0]) | (grid > times[-1])
+    for values in (distance, speed, charge, energy):
+        values[outside] = np.nan
+
+    power_battery = np.empty(len(grid))
+    power_battery[0] = derivatives[0, 3]
+    power_battery[1:] = np.diff(energy) / np.diff(grid)
+    gap = np.interp(grid, lead_time, lead_distance) - distance
+
+    return {
+        "time": grid,
+        "distance": distance,
+        "speed": speed,
+        "acceleration": differentiate(speed, time=grid, scheme="backward"),
+        "gap": gap,
+        "power_battery": power_battery,
+        "state_of_charge": vehicle.soc_initial - charge / vehicle.capacity,
+        "mpge": vehicle.get_mpge(grid, distance, power_battery),
+        "step_time": times,
+        "n_steps": len(times) - 1,
+        "n_rejected": n_rejected,
+        "n_evaluations": n_evaluations,
+    }
@@ -0,0 +1,179 @@
+import numpy as np
+import json
+import os
+import shutil
+import struct
+
+from preprocess import DATASET_DIRECTORY, preprocess_chunks
+from streaming import StreamingController
+
+# Layout: magic, header length (uint64), JSON header, then one contiguous block per column, all 64 bytes aligned
+MAGIC = b"ADCTRACE"
+VERSION = 1
+ALIGNMENT = 64
+CHUNK_SIZE = 1 << 20    # samples
+DTYPE = "<f8"
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class TraceWriter:
+
+    def __init__(self, filepath: str, columns: list, dt: float, chunk_size=CHUNK_SIZE, dtype=DTYPE):
+
+        self.filepath = filepath
+        self.columns = list(columns)
+        self.dt = dt
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        self.n_samples = 0
+
+        # Columns are appended to temporary files, assembled in the trace when closing
+        self.parts = {name: open(f"{filepath}.{name}.part", "wb") for name in self.columns}
+
+    def append(self, **columns):
+
+        lengths = {len(columns[name]) for name in self.columns}
+        if len(lengths) != 1:
+            raise ValueError(f"Columns of different lengths {lengths}")
+
+        for name in self.columns:
+            self.parts[name].write(np.ascontiguousarray(columns[name], dtype=self.dtype).tobytes())
+        self.n_samples += lengths.pop()
+
+    def close(self):
+
+        for part in self.parts.values():
+            part.close()
+
+        chunks = [[start, min(start + self.chunk_size, self.n_samples)]
+                  for start in range(0, self.n_samples, self.chunk_size)]
+        header = {"version": VERSION, "dt": self.dt, "sample_rate": 1 / self.dt, "n_samples": self.n_samples,
+                  "dtype": self.dtype.str, "columns": self.columns, "chunk_size": self.chunk_size, "chunks": chunks}
+
+        # Column offsets depend on the header length, which depends on the offsets: fixed point on the length
+        column_bytes = self.n_samples * self.dtype.itemsize
+        header_length = 0
+        while True:
+            offset = _aligned(len(MAGIC) + 8 + header_length)
+            header["column_offsets"] = {}
+            for name in self.columns:
+                header["column_offsets"][name] = offset
+                offset = _aligned(offset + column_bytes)
+            encoded = json.dumps(header).encode()
+            if len(encoded) <= header_length:
+                break
+            header_length = len(encoded) + ALIGNMENT
+
+        with open(self.filepath, "wb") as trace_file:
+            trace_file.write(MAGIC + struct.pack("<Q", header_length) + encoded.ljust(header_length))
+
+            for name in self.columns:
+                trace_file.seek(header["column_offsets"][name])
+                with open(f"{self.filepath}.{name}.part", "rb") as part:
+                    shutil.copyfileobj(part, trace_file, 16 * 1024 ** 2)
+                os.remove(f"{self.filepath}.{name}.part")
+
+            trace_file.truncate(offset)
+
+        return Trace(self.filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for name, part in self.parts.items():
+                part.close()
+                os.remove(f"{self.filepath}.{name}.part")
+
+
+class Trace:
+
+    def __init__(self, filepath: str):
+
+        self.filepath = filepath
+
+        with open(filepath, "rb") as trace_file:
+            if trace_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filepath} is not a drive cycle trace")
+            header_length, = struct.unpack("<Q", trace_file.read(8))
+            self.header = json.loads(trace_file.read(header_length))
+
+        self.dt = self.header["dt"]
+        self.n_samples = self.header["n_samples"]
+        self.columns = self.header["columns"]
+        self.chunks = [tuple(chunk) for chunk in self.header["chunks"]]
+
+        # Lazily mapped columns, nothing is read before being accessed
+        self._columns = {}
+
+    def column(self, name: str) -> np.ndarray:
+
+        if name not in self._columns:
+            self._columns[name] = np.memmap(self.filepath, dtype=self.header["dtype"], mode="r",
+                                            offset=self.header["column_offsets"][name], shape=(self.n_samples,))
+        return self._columns[name]
+
+    def window(self, start: int, stop: int) -> dict:
+
+        # Views on the memory mapped columns, without copy
+        return {name: self.column(name)[start:stop] for name in self.columns}
+
+    def windows(self):
+        for start, stop in self.chunks:
+            yield self.window(start, stop)
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.column(name)
+
+
+def convert_drive_cycle(filename: str, filtering: str, output_filepath: str, dt=0.5, chunk_size=CHUNK_SIZE) -> Trace:
+
+    # Lead trace of a dataset cycle: time, speed, acceleration and absolute distance, read chunk by chunk
+    filepath = os.path.join(DATASET_DIRECTORY, filename)
+    blocks = preprocess_chunks(filepath, filtering, chunk_size=chunk_size)
+
+    return write_lead_trace(output_filepath, blocks, dt, chunk_size=chunk_size)
+
+
+def write_lead_trace(output_filepath: str, blocks, dt: float, chunk_size=CHUNK_SIZE) -> Trace:
+
+    # Blocks of (time, speed, acceleration) of any size (e.g. read_csv chunks of a fleet log)
+    with TraceWriter(output_filepath, ["time", "speed", "acceleration", "distance"], dt,
+                     chunk_size=chunk_size) as writer:
+
+        # Absolute distance integrated block by block, carrying the last position
+        position = 0.
+        for time, speed, acceleration in blocks:
+            distance = position + np.cumsum(speed * dt)
+            if len(distance):
+                position = distance[-1]
+            writer.append(time=time, speed=speed, acceleration=acceleration, distance=distance)
+
+    return Trace(output_filepath)
+
+
+def simulate_trace(trace: Trace, controller: StreamingController, output_filepath: str) -> Trace:
+
+    # Following vehicle simulated window by window: memory bounded by the chunk size of the trace
+    controller.reset()
+    names = ["speed", "acceleration", "gap", "state_of_charge"]
+
+    with TraceWriter(output_filepath, names, trace.dt, chunk_size=trace.header["chunk_size"]) as writer:
+        for window in trace.windows():
+            samples = controller.process(window["distance"])
+            writer.append(**dict(zip(names, samples)))
+
+        last_sample = controller.flush()
+        if last_sample is not None:
+            writer.append(**{name: [value] for name, value in zip(names, last_sample)})
+
+    return Trace(output_filepath)
@@ -0,0 +1,185 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import kernels
+from profiling import profiled
+from vehicles import AutonomousVehicle, batch_state_of_charge
+
+CONTROLLERS = ("ccc", "acc")
+
+# Range noise (m) and lead speed noise (m/s) standard deviations, latency (s) and probability of a dropped sample
+NOISE = {"range": 0., "speed": 0., "latency": 0., "dropout": 0.}
+
+
+def sensor_realizations(lead_distance: np.ndarray, lead_speed, noise: dict, n_realizations: int, rng, dt=0.5) -> tuple:
+
+    # Time major arrays (n_steps, n_realizations) of what the follower receives at every step:
+    # range noise, lead speed measured and index of the sample it was measured at
+    noise = {**NOISE, **noise}
+    n_steps = len(lead_distance)
+    shape = (n_steps, n_realizations)
+
+    range_noise = noise["range"] * rng.standard_normal(shape) if noise["range"] else np.zeros(shape)
+
+    # Lead speed: true one plus noise when known, differentiated noisy positions otherwise
+    if lead_speed is not None:
+        measured_speed = np.repeat(np.asarray(lead_speed, dtype=float)[:, None], n_realizations, axis=1)
+    else:
+        measured_speed = np.zeros(shape)
+        measured_speed[1:] = np.diff(lead_distance[:, None] + range_noise, axis=0) / dt
+    if noise["speed"]:
+        measured_speed += noise["speed"] * rng.standard_normal(shape)
+
+    # Dropped samples hold the last received one, then every sample arrives latency later
+    steps = np.arange(n_steps)
+    received = rng.random(shape) >= noise["dropout"] if noise["dropout"] else np.ones(shape, dtype=bool)
+    received[0] = True
+    last_received = np.maximum.accumulate(np.where(received, steps[:, None], 0), axis=0)
+
+    latency = int(round(noise["latency"] / dt))
+    source = last_received[np.maximum(steps - latency, 0)]
+
+    return range_noise, measured_speed, source
+
+
+def simulate_noisy(vehicle: AutonomousVehicle, controller: str, lead_distance: np.ndarray, noise: dict,
+                   n_realizations: int, rng, df=None, headway=False, kp=0.1, kd=1) -> tuple:
+
+    if controller not in CONTROLLERS:
+        raise ValueError(f"Unknown controller {controller}")
+
+    dt = vehicle.dt
+    lead_distance = np.asarray(lead_distance, dtype=float)
+
+    # True lead speed: known one or backward difference of the true positions
+    if df is None:
+        lead_speed, _ = vehicle.compute_speed_acceleration(lead_distance)
+    else:
+        lead_speed = df[df.columns[1]].values
+
+    range_noise, measured_speed, source = sensor_realizations(lead_distance, None if df is None else lead_speed,
+                                                              noise, n_realizations, rng, dt=dt)
+
+    # Time major arrays (n_steps, n_realizations): every step writes one contiguous row
+    n_steps = len(lead_distance)
+    realizations = np.arange(n_realizations)
+    gap = np.zeros((n_steps, n_realizations))
+    gap[0] = 1    # gap initial in meter
+    follow_distance = np.zeros((n_steps, n_realizations))
+    follow_distance[0] = lead_distance[0] - gap[0]
+    follow_speed = np.zeros((n_steps, n_realizations))
+    follow_acceleration = np.zeros((n_steps, n_realizations))
+
+    if controller == "acc":
+        for d in range(n_steps - 1):
+
+            # Measured gap and lead speed, as received at step d
+            gap_measured = gap[source[d], realizations] + range_noise[source[d], realizations]
+            speed_measured = measured_speed[source[d], realizations]
+            speed = follow_speed[d]
+
+            follow_acceleration[d + 1] = kernels.acc_acceleration(gap_measured, speed, speed_measured,
+                                                                  gap_measured < vehicle.gap_min, headway,
+                                                                  vehicle.gap_target, vehicle.gap_min,
+                                                                  vehicle.headway_target, vehicle.headway_min,
+                                                                  vehicle.acceleration_min, vehicle.acceleration_max,
+                                                                  dt)
+
+            # Speed, absolute distance and true gap
+            follow_speed[d + 1] = speed + follow_acceleration[d + 1] * dt
+            follow_distance[d + 1] = follow_distance[d] + follow_speed[d + 1] * dt
+            gap[d + 1] = lead_distance[d + 1] - follow_distance[d + 1]
+
+    else:
+        # CCC has no range sensor: its gap is integrated from the measured lead speed, the true one from the true
+        # lead speed, both reset to zero while the lead is stopped as in control_drive_cycle
+        gap_estimated = gap[0].copy()
+        e_prev = np.ones(n_realizations)
+
+        for s in range(n_steps - 1):
+
+            speed_measured = measured_speed[source[s], realizations]
+            speed = follow_speed[s]
+            moving = speed_measured != 0.
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                gap_next = gap_estimated + (speed_measured - speed) * dt
+                speed_next, e = kernels.ccc_speed(gap_next, speed, speed_measured, e_prev, kp, kd, vehicle.gap_target,
+                                                  vehicle.acceleration_max, dt)
+
+            follow_speed[s + 1] = np.where(moving, speed_next, 0.)
+            follow_acceleration[s] = np.where(moving, (speed_next - speed) / dt, 0.)
+            gap_estimated = np.where(moving, gap_next, 0.)
+            e_prev = np.where(moving, e, e_prev)
+
+            gap[s + 1] = gap[s] + (lead_speed[s] - speed) * dt if lead_speed[s] != 0. else 0.
+
+        follow_distance = lead_distance[:, None] - gap
+
+    # Arrays of shape (n_realizations, n_steps)
+    return follow_distance.T, follow_speed.T, follow_acceleration.T, gap.T
+
+
+def _run_chunk(vehicle: AutonomousVehicle, controller: str, lead_distance: np.ndarray, time: np.ndarray, df,
+               noise: dict, n_realizations: int, seed, headway: bool, kp: float, kd: float) -> tuple:
+
+    rng = np.random.default_rng(seed)
+    follow_distance, follow_speed, follow_acceleration, gap = simulate_noisy(
+        vehicle, controller, lead_distance, noise, n_realizations, rng, df=df, headway=headway, kp=kp, kd=kd)
+
+    # Consumption of every realization
+    _, power_wheel = vehicle.get_power_wheel(follow_speed, follow_acceleration)
+    power_battery, _ = batch_state_of_charge(power_wheel, vehicle.voltage_nominal, vehicle.resistance,
+                                             vehicle.capacity, vehicle.efficiency_transmission,
+                                             vehicle.efficiency_motor, vehicle.standby_losses,
+                                             soc_initial=vehicle.soc_initial, dt=vehicle.dt)
+    mpge = np.array([vehicle.get_mpge(time, distance, power) for distance, power in
+                     zip(follow_distance, power_battery)])
+
+    return np.nanmin(gap, axis=1), np.any(gap < 0, axis=1), mpge
+
+
+@profiled()
+def monte_carlo(vehicle: AutonomousVehicle, controller: str, lead_distance: np.ndarray, noise=None, df=None,
+                n_realizations=1000, seed=0, chunk_size=1000, n_workers=None, percentiles=(5, 50, 95),
+                headway=False, kp=0.1, kd=1) -> dict:
+
+    # Seeded realizations by chunks of chunk_size, in worker processes when n_workers > 1
+    noise = {**NOISE, **(noise or {})}
+    unknown = set(noise) - set(NOISE)
+    if unknown:
+        raise ValueError(f"Unknown noise parameters {sorted(unknown)}")
+
+    lead_distance = np.asarray(lead_distance, dtype=float)
+    time = df[df.columns[0]].values if df is not None else np.arange(len(lead_distance)) * vehicle.dt
+
+    sizes = [min(chunk_size, n_realizations - c) for c in range(0, n_realizations, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = [(vehicle, controller, lead_distance, time, df, noise, size, chunk_seed, headway, kp, kd)
+                 for size, chunk_seed in zip(sizes, seeds)]
+
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunks = list(executor.map(_run_chunk, *zip(*arguments)))
+    else:
+        chunks = [_run_chunk(*chunk_arguments) for chunk_arguments in arguments]
+
+    min_gap, collision, mpge = (np.concatenate(values) for values in zip(*chunks))
+
+    # Wilson score interval (95%) of the collision probability, normal interval of the mean MPGe
+    z, n = 1.96, n_realizations
+    probability = collision.mean()
+    center = (probability + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    half_width = z * np.sqrt(probability * (1 - probability) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    mpge_error = z * np.nanstd(mpge) / np.sqrt(n)
+
+    return {
+        "percentiles": np.asarray(percentiles),
+        "min_gap": np.nanpercentile(min_gap, percentiles),
+        "mpge": np.nanpercentile(mpge, percentiles),
+        "collision_probability": float(probability),
+        "collision_interval": (float(center - half_width), float(center + half_width)),
+        "mpge_mean": float(np.nanmean(mpge)),
+        "mpge_interval": (float(np.nanmean(mpge) - mpge_error), float(np.nanmean(mpge) + mpge_error)),
+        "realizations": {"min_gap": min_gap, "collision": collision, "mpge": mpge},
+    }
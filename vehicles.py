@@ -1,4 +1,9 @@
 import numpy as np
+import warnings
+
+import kernels
+from kinematics import differentiate
+from profiling import profiled
 
 
 class Vehicle:
@@ -26,22 +31,16 @@ class Vehicle:
         # Experiment
         self.dt = dt
 
+    @profiled()
     def compute_speed_acceleration(self, vehicle_distance: np.ndarray) -> tuple:
 
-        vehicle_speed = np.zeros(vehicle_distance.shape)
-        vehicle_acceleration = np.zeros(vehicle_distance.shape)
-
-        # Computing speed of the vehicle
-        for p, _ in enumerate(vehicle_distance[:-1]):
-            vehicle_speed[p + 1] = (vehicle_distance[p + 1] - vehicle_distance[p]) / self.dt
-
-        # Computing acceleration of the vehicle
-        for s, _ in enumerate(vehicle_speed[:-1]):
-            dv = vehicle_speed[s + 1] - vehicle_speed[s]
-            vehicle_acceleration[s] = dv / self.dt
+        # Backward difference for the speed, forward difference for the acceleration
+        vehicle_speed = differentiate(vehicle_distance, dt=self.dt, scheme="backward")
+        vehicle_acceleration = differentiate(vehicle_speed, dt=self.dt, scheme="forward")
 
         return vehicle_speed, vehicle_acceleration
 
+    @profiled()
     def get_power_wheel(self, speed: np.ndarray, acceleration: np.ndarray) -> tuple:
 
         a, b, c = self.target_abc
@@ -61,6 +60,7 @@ class Vehicle:
         return force_road_load, power_wheel
 
     @staticmethod
+    @profiled()
     def get_mpge(time: np.ndarray, total_distance: np.ndarray, power_battery: np.ndarray) -> float:
 
         total_distance = np.nan_to_num(total_distance)
@@ -74,6 +74,7 @@ class Vehicle:
 
         return distance / power_net_consumption
 
+    @profiled()
     def get_state_of_charge(self, power_wheel: np.ndarray) -> tuple:
 
         power_battery = np.zeros(power_wheel.shape)
@@ -85,6 +86,12 @@ class Vehicle:
 
         efficiency_drivetrain = self.efficiency_transmission * self.efficiency_motor
 
+        if kernels.compiled():
+            kernels.state_of_charge_kernel(np.ascontiguousarray(power_wheel, dtype=float), power_battery,
+                                           capacity_supplied, state_of_charge, self.voltage_nominal, self.resistance,
+                                           self.capacity, efficiency_drivetrain, self.standby_losses, self.dt)
+            return power_battery, state_of_charge
+
         for t, p_w in enumerate(power_wheel):
 
             if p_w >= 0:
@@ -110,6 +117,16 @@ class Vehicle:
 
         return power_battery, state_of_charge
 
+    @profiled()
+    def get_equivalent_circuit_state_of_charge(self, speed: np.ndarray, acceleration: np.ndarray, battery=None,
+                                               motor=None, temperature=25.) -> tuple:
+
+        # Equivalent circuit battery and motor efficiency map, defaults built from the vehicle parameters
+        from battery import equivalent_circuit_state_of_charge
+
+        return equivalent_circuit_state_of_charge(self, speed, acceleration, battery=battery, motor=motor,
+                                                  temperature=temperature)
+
 
 class AutonomousVehicle(Vehicle):
 
@@ -126,6 +143,7 @@ class AutonomousVehicle(Vehicle):
         # Acceleration min and max
         self.acceleration_min, self.acceleration_max = -3, 3.     # m.s^2
         
+    @profiled()
     def control_drive_cycle(self, lead_vehicle_distance: np.ndarray, kp=1, kd=1, df=None) -> tuple:
 
         # Perfect access to the position of the lead vehicle (perfect range sensor)
@@ -149,6 +167,12 @@ class AutonomousVehicle(Vehicle):
         gap_vehicles[0] = 1     # gap initial in meter
         e_prev = 1
 
+        if kernels.compiled():
+            kernels.control_drive_cycle_kernel(np.ascontiguousarray(lead_vehicle_speed, dtype=float), following_speed,
+                                               following_acceleration, gap_vehicles, kp, kd, self.gap_target,
+                                               self.acceleration_max, self.dt, float(e_prev))
+            return following_speed, following_acceleration, gap_vehicles
+
         for s, lead_speed in enumerate(lead_vehicle_speed[:-1]):
 
             if lead_speed == 0. or lead_speed is np.nan:
@@ -156,23 +180,10 @@ class AutonomousVehicle(Vehicle):
 
             # New gap between vehicles
             gap_vehicles[s + 1] = gap_vehicles[s] + (lead_speed - following_speed[s]) * self.dt
-        
-            # Errors
-            velocity_error = (lead_speed - following_speed[s])
-            gap_error = self.gap_target - gap_vehicles[s + 1]
-        
-            tw = self.gap_target / lead_speed    
-            e = gap_vehicles[s + 1] - tw * following_speed[s]
-            e_dot = (e - e_prev) / self.dt
-            
-            following_speed[s + 1] = following_speed[s] + kp * e + kd * e_dot
-            
-            # Acceleration bounds
-            if following_speed[s + 1] - following_speed[s] < - 0.5 * self.acceleration_max * self.dt:
-                following_speed[s + 1] = following_speed[s] - 0.5 * self.acceleration_max * self.dt
-
-            elif following_speed[s + 1] - following_speed[s] > self.acceleration_max * self.dt:
-                following_speed[s + 1] = following_speed[s] + 0.5 * self.acceleration_max * self.dt
+
+            # Next speed from the gap error, within the acceleration bounds
+            following_speed[s + 1], e = kernels.ccc_speed(gap_vehicles[s + 1], following_speed[s], lead_speed, e_prev,
+                                                          kp, kd, self.gap_target, self.acceleration_max, self.dt)
 
             # Computing acceleration
             dv = following_speed[s + 1] - following_speed[s]
@@ -182,6 +193,7 @@ class AutonomousVehicle(Vehicle):
 
         return following_speed, following_acceleration, gap_vehicles
 
+    @profiled()
     def adaptive_cruise_control_drive_cycle(self, lead_distance: np.ndarray, headway=False, df=None) -> tuple:
 
         # Lead speed and acceleration
@@ -202,73 +214,188 @@ class AutonomousVehicle(Vehicle):
         follow_speed = np.zeros(lead_speed.shape)
         follow_acceleration = np.zeros(lead_acceleration.shape)
 
-        # Taking into account headway target
-        if headway:
-            for d, _ in enumerate(lead_distance[:-1]):
+        if kernels.compiled():
+            kernels.adaptive_cruise_control_kernel(np.ascontiguousarray(lead_distance, dtype=float),
+                                                   np.ascontiguousarray(lead_speed, dtype=float), follow_distance,
+                                                   follow_speed, follow_acceleration, gap, headway, self.gap_target,
+                                                   self.gap_min, self.headway_target, self.headway_min,
+                                                   self.acceleration_min, self.acceleration_max, self.dt)
+            return follow_distance, follow_speed, follow_acceleration, gap
+
+        for d, _ in enumerate(lead_distance[:-1]):
+
+            # Computing next acceleration: safe one under the minimum gap, reaching the target gap otherwise
+            follow_acceleration[d + 1] = kernels.acc_acceleration(gap[d], follow_speed[d], lead_speed[d],
+                                                                  gap[d] < self.gap_min, headway, self.gap_target,
+                                                                  self.gap_min, self.headway_target, self.headway_min,
+                                                                  self.acceleration_min, self.acceleration_max, self.dt)
+
+            # Computing speed
+            follow_speed[d + 1] = follow_speed[d] + follow_acceleration[d + 1] * self.dt
 
-                # Constraint on te gap - imposed by space (gap min) or time (headway_min)
-                gap_constraint = np.maximum(self.gap_min, follow_speed[d] * self.headway_min)
+            # Computing absolute distance
+            follow_distance[d + 1] = follow_distance[d] + follow_speed[d + 1] * self.dt
 
-                # Next acceleration needed to reach the minimum safe distance
-                acceleration_safe = gap[d] / (self.dt ** 2) + \
-                                    (lead_speed[d] - follow_speed[d]) / self.dt - gap_constraint / (self.dt ** 2)
+            # Computing gap
+            gap[d + 1] = lead_distance[d + 1] - follow_distance[d + 1]
+
+        return follow_distance, follow_speed, follow_acceleration, gap
+
+    @profiled()
+    def adaptive_cruise_control_batch(self, lead_distance: np.ndarray, headway=False, df=None, **parameters) -> tuple:
+
+        # Followers parameters: gap_target, gap_min, headway_target, headway_min, acceleration_min, acceleration_max
+        # given as arrays of n followers (attributes of the vehicle when missing)
+        names = ("gap_target", "gap_min", "headway_target", "headway_min", "acceleration_min", "acceleration_max")
+        unknown = set(parameters) - set(names)
+        if unknown:
+            raise ValueError(f"Unknown parameters {sorted(unknown)}")
+
+        values = [np.atleast_1d(np.asarray(parameters.get(name, getattr(self, name)), dtype=float)) for name in names]
+        values = np.broadcast_arrays(*values)
+        gap_target, gap_min, headway_target, headway_min, acceleration_min, acceleration_max = values
+        n_followers = gap_target.shape[0]
+
+        # Lead speed and acceleration
+        if df is None:
+            lead_speed, _ = self.compute_speed_acceleration(lead_distance)
+        else:
+            lead_speed = df[df.columns[1]].values
+
+        # Time major arrays (n_steps, n_followers): every step writes one contiguous row
+        n_steps = lead_speed.shape[0]
+        gap = np.zeros((n_steps, n_followers))
+        gap[0] = 1    # gap initial in meter
+
+        follow_distance = np.zeros((n_steps, n_followers))
+        follow_distance[0] = lead_distance[0] - gap[0]
+        follow_speed = np.zeros((n_steps, n_followers))
+        follow_acceleration = np.zeros((n_steps, n_followers))
 
-                # Acceleration needed to reach the target gap
-                acceleration_target = ((gap[d] + (lead_speed[d] - follow_speed[d]) * self.dt) *
-                                       self.headway_target - follow_speed[d]) / (1 + (self.dt ** 2) *
-                                                                                 self.headway_target)
+        dt = self.dt
+        for d in range(n_steps - 1):
 
-                # Computing next acceleration
-                if gap[d] < self.gap_min:
-                    follow_acceleration[d + 1] = self.bound_acceleration(acceleration_safe, self.acceleration_max,
-                                                                         self.acceleration_min)
-                else:
-                    follow_acceleration[d + 1] = self.bound_acceleration(acceleration_target, self.acceleration_max,
-                                                                         self.acceleration_min)
+            # Next acceleration of every follower
+            follow_acceleration[d + 1] = kernels.acc_acceleration(gap[d], follow_speed[d], lead_speed[d],
+                                                                  gap[d] < gap_min, headway, gap_target, gap_min,
+                                                                  headway_target, headway_min, acceleration_min,
+                                                                  acceleration_max, dt)
 
-                # Computing speed
-                follow_speed[d + 1] = follow_speed[d] + follow_acceleration[d + 1] * self.dt
+            # Speed, absolute distance and gap
+            np.add(follow_speed[d], follow_acceleration[d + 1] * dt, out=follow_speed[d + 1])
+            np.add(follow_distance[d], follow_speed[d + 1] * dt, out=follow_distance[d + 1])
+            np.subtract(lead_distance[d + 1], follow_distance[d + 1], out=gap[d + 1])
 
-                # Computing absolute distance
-                follow_distance[d + 1] = follow_distance[d] + follow_speed[d + 1] * self.dt
+        # Arrays of shape (n_followers, n_steps)
+        return follow_distance.T, follow_speed.T, follow_acceleration.T, gap.T
 
-                # Computing gap
-                gap[d + 1] = lead_distance[d + 1] - follow_distance[d + 1]
+    @profiled()
+    def model_predictive_drive_cycle(self, lead_distance: np.ndarray, horizon=20, headway=False, df=None,
+                                     weights=None) -> tuple:
 
-        # Only considering gap target
+        # Lead speed, true one when df is given
+        if df is None:
+            lead_speed, _ = self.compute_speed_acceleration(lead_distance)
         else:
-            for d, _ in enumerate(lead_distance[:-1]):
+            lead_speed = df[df.columns[1]].values
 
-                # Next acceleration needed to reach the minimum safe distance
-                acceleration_safe = gap[d] / (self.dt ** 2) + \
-                                    (lead_speed[d] - follow_speed[d]) / self.dt - self.gap_min / (self.dt ** 2)
+        from mpc import ModelPredictiveController
 
-                # Acceleration needed to reach the target gap
-                acceleration_target = gap[d] / (self.dt ** 2) + \
-                                    (lead_speed[d] - follow_speed[d]) / self.dt - self.gap_target / (self.dt ** 2)
+        controller = ModelPredictiveController(self, horizon=horizon, headway=headway, weights=weights)
 
-                # Computing next acceleration
-                if gap[d] < self.gap_min:
-                    follow_acceleration[d + 1] = self.bound_acceleration(acceleration_safe, self.acceleration_max,
-                                                                         self.acceleration_min)
-                else:
-                    follow_acceleration[d + 1] = self.bound_acceleration(acceleration_target, self.acceleration_max,
-                                                                         self.acceleration_min)
+        gap = np.zeros(lead_speed.shape)
+        gap[0] = 1    # gap initial in meter
+
+        follow_distance = np.zeros(lead_speed.shape)
+        follow_distance[0] = lead_distance[0] - gap[0]
+        follow_speed = np.zeros(lead_speed.shape)
+        follow_acceleration = np.zeros(lead_speed.shape)
 
-                # Computing speed
-                next_follow_speed = follow_speed[d] + follow_acceleration[d + 1] * self.dt
-                follow_speed[d + 1] = next_follow_speed
+        for d in range(len(lead_distance) - 1):
 
-                # Computing absolute distance
-                next_follow_x = follow_distance[d] + follow_speed[d + 1] * self.dt
-                follow_distance[d + 1] = follow_distance[d] + follow_speed[d + 1] * self.dt
+            # Acceleration of the first step of the horizon, then same integration as the ACC
+            follow_acceleration[d + 1] = controller.control(gap[d], follow_speed[d], lead_speed[d])
+            follow_speed[d + 1] = follow_speed[d] + follow_acceleration[d + 1] * self.dt
+            follow_distance[d + 1] = follow_distance[d] + follow_speed[d + 1] * self.dt
+            gap[d + 1] = lead_distance[d + 1] - follow_distance[d + 1]
 
-                # Computing gap
-                next_gap = lead_distance[d + 1] - follow_distance[d + 1]
-                gap[d + 1] = next_gap
+        if controller.n_not_converged:
+            warnings.warn(f"MPC solver stopped at {controller.max_iterations} iterations without converging at "
+                          f"{controller.n_not_converged} of {controller.n_solves} steps", RuntimeWarning)
 
         return follow_distance, follow_speed, follow_acceleration, gap
 
+    @profiled()
+    def energy_optimal_drive_cycle(self, lead_distance: np.ndarray, headway=False, gap_max=40., n_gaps=21,
+                                   acceleration_step=0.5) -> tuple:
+
+        # Follower trajectory minimizing the battery charge, within the gap (headway) and acceleration bounds
+        from optimal import energy_optimal_trajectory
+
+        return energy_optimal_trajectory(self, lead_distance, headway=headway, gap_max=gap_max, n_gaps=n_gaps,
+                                         acceleration_step=acceleration_step)
+
+    @profiled()
+    def multirate_drive_cycle(self, lead_distance: np.ndarray, controller="acc", df=None, controller_dt=None,
+                              dynamics_dt=None, **parameters) -> dict:
+
+        # Controller every controller_dt, vehicle and battery every dynamics_dt, outputs on the lead grid
+        from timestepping import multirate_drive_cycle
+
+        return multirate_drive_cycle(self, lead_distance, controller, df=df, controller_dt=controller_dt,
+                                     dynamics_dt=dynamics_dt, **parameters)
+
+    @profiled()
+    def adaptive_drive_cycle(self, lead_distance: np.ndarray, headway=False, df=None, tolerance=1e-2,
+                             **parameters) -> dict:
+
+        # ACC integrated with error control on its step, outputs on the lead grid
+        from timestepping import adaptive_drive_cycle
+
+        return adaptive_drive_cycle(self, lead_distance, df=df, headway=headway, tolerance=tolerance, **parameters)
+
     @staticmethod
     def bound_acceleration(x: float, y: float, z: float):
         return np.maximum((np.minimum(x, y)), z)
+
+
+@profiled()
+def batch_state_of_charge(power_wheel: np.ndarray, nominal_voltage, resistance, capacity, efficiency_transmission,
+                          efficiency_motor, standby_losses, soc_initial=0.5, dt=0.5) -> tuple:
+
+    # Power at the wheel of n vehicles (n_vehicles, n_steps), parameters are scalars or arrays of n_vehicles
+    power_wheel = np.atleast_2d(power_wheel)
+    n_vehicles, n_steps = power_wheel.shape
+
+    def column(parameter):
+        return np.broadcast_to(np.asarray(parameter, dtype=float).reshape(-1, 1), (n_vehicles, 1))
+
+    voltage, resistance, capacity = column(nominal_voltage), column(resistance), column(capacity)
+    standby_losses, soc_initial = column(standby_losses), column(soc_initial)
+    efficiency_drivetrain = column(efficiency_transmission) * column(efficiency_motor)
+
+    # Traction or regenerative braking
+    power_battery = np.where(power_wheel >= 0, power_wheel / efficiency_drivetrain, efficiency_drivetrain * power_wheel)
+    power_battery += standby_losses
+
+    # Battery current (A) where the discriminant is valid
+    discriminant = voltage ** 2 - 4 * resistance * power_battery
+    valid = discriminant >= 0
+    with np.errstate(invalid="ignore"):
+        battery_current = (voltage - np.sqrt(np.where(valid, discriminant, 0.))) / (2 * resistance)
+
+    # Previous value is chosen otherwise: forward filling the last valid current (0 before any valid one)
+    steps = np.broadcast_to(np.arange(n_steps), (n_vehicles, n_steps))
+    last_valid = np.maximum.accumulate(np.where(valid, steps, -1), axis=1)
+    battery_current = np.where(last_valid >= 0,
+                               np.take_along_axis(battery_current, np.maximum(last_valid, 0), axis=1), 0.)
+
+    # Capacity supplied (Ah)
+    capacity_supplied = battery_current * dt / 3600
+
+    # State of charge (%), first sample kept at its initial value
+    state_of_charge = np.empty(power_battery.shape)
+    state_of_charge[:, 0] = soc_initial[:, 0]
+    state_of_charge[:, 1:] = soc_initial - np.cumsum(capacity_supplied[:, 1:], axis=1) / capacity
+
+    return power_battery, state_of_charge